@@ -3,12 +3,19 @@ import threading
 import sys
 from argparse import Namespace, ArgumentParser
 
+from a1_chat_client.batch import run_batch
+from a1_chat_client.refrac import send_all
+from lab_common.framing import LineFramer, LineTooLongError
+
 def parse_arguments() -> Namespace:
     """
     Parse command line arguments for the chat client.
-    The two valid options are:
+    The valid options are:
         --address: The host to connect to. Default is "0.0.0.0"
         --port: The port to connect to. Default is 5378
+        --batch: Read commands from a file ("-" for stdin) instead of interactively
+        --username: The login for --batch mode
+        --window: The maximum number of pipelined requests in --batch mode. Default is 1024
     :return: The parsed arguments in a Namespace object.
     """
 
@@ -21,28 +28,33 @@ def parse_arguments() -> Namespace:
                       type=str, help="Set server address", default="0.0.0.0")
     parser.add_argument("-p", "--port",
                       type=int, help="Set server port", default=5378)
-    return parser.parse_args()
+    parser.add_argument("-b", "--batch",
+                      type=str, help="Run non-interactively, reading commands from a file or - for stdin")
+    parser.add_argument("-u", "--username",
+                      type=str, help="Set the login used in batch mode")
+    parser.add_argument("-w", "--window",
+                      type=int, help="Set the maximum number of pipelined requests in batch mode", default=1024)
+    args = parser.parse_args()
+    if args.batch is not None and not args.username:
+        parser.error("--batch requires --username")
+    return args
 
-def handleReceive(sock):
+def handleReceive(sock, framer):
     try:
         while True:
-            buff = ""
-            while "\n" not in buff:
+            # Lines that arrived together with the login reply are already in the framer
+            try:
+                lines = list(framer.lines())
+            except LineTooLongError:
+                print("Error: Message from server is too long.")
+                return
+
+            for raw_line in lines:
                 try:
-                    data = sock.recv(4096)
-                    if not data:
-                        print("Connection closed by server.")
-                        return
-                    buff += data.decode("utf-8")
+                    line = raw_line.decode("utf-8").strip()
                 except UnicodeDecodeError:
                     print("Error decoding message from server.")
-                    return
-                except (socket.error, ConnectionResetError, BrokenPipeError) as e:
-                    print(f"Connection error: {e}")
-                    return
-            
-            for line in buff.splitlines():
-                line = line.strip()
+                    continue
                 if not line:
                     continue
                 
@@ -65,6 +77,13 @@ def handleReceive(sock):
                         print("\nThere are 0 online users.")
                         
                 elif header == "DELIVERY":
+                    if len(parts) > 1 and parts[1].startswith("#"):
+                        # A channel message: DELIVERY #<channel> <sender> <message>
+                        if len(parts) < 4:
+                            print("Error: Invalid DELIVERY message format.")
+                            continue
+                        print(f"From {parts[2]} in {parts[1]}: {' '.join(parts[3:])}")
+                        continue
                     if len(parts) < 3:
                         print("Error: Invalid DELIVERY message format.")
                         continue
@@ -72,6 +91,12 @@ def handleReceive(sock):
                     message = " ".join(parts[2:])
                     print(f"From {sender}: {message}")
                     
+                elif header == "JOIN-OK" and len(parts) > 1:
+                    print(f"Joined {parts[1]}")
+
+                elif header == "LEAVE-OK" and len(parts) > 1:
+                    print(f"Left {parts[1]}")
+                    
                 elif header == "SEND-OK":
                     print("The message was sent successfully")
                     
@@ -86,6 +111,14 @@ def handleReceive(sock):
                     
                 else:
                     print(f"Error: Unknown message header '{header}'")
+
+            try:
+                if not framer.recv_into(sock):
+                    print("Connection closed by server.")
+                    return
+            except (socket.error, ConnectionResetError, BrokenPipeError) as e:
+                print(f"Connection error: {e}")
+                return
     finally:
         sock.close()
 
@@ -103,18 +136,30 @@ def handleSend(sock):
                 
             if message == "!quit":
                 try:
-                    sock.send("QUIT\n".encode("utf-8"))
+                    send_all(sock, "QUIT\n".encode("utf-8"))
                 except (socket.error, BrokenPipeError, ConnectionResetError):
                     print("Connection lost. Exiting...")
                 break
             
             elif message == "!who":
                 try:
-                    sock.send("LIST\n".encode("utf-8"))
+                    send_all(sock, "LIST\n".encode("utf-8"))
                 except (socket.error, BrokenPipeError, ConnectionResetError):
                     print("Failed to send LIST request. Connection lost.")
                     break
                     
+            elif message.startswith("!join ") or message.startswith("!leave "):
+                command, _, channel = message.partition(" ")
+                channel = channel.strip()
+                if not channel.startswith("#"):
+                    channel = "#" + channel
+                request = "JOIN" if command == "!join" else "LEAVE"
+                try:
+                    send_all(sock, f"{request} {channel}\n".encode("utf-8"))
+                except (socket.error, BrokenPipeError, ConnectionResetError):
+                    print(f"Failed to send {request} request. Connection lost.")
+                    break
+
             elif message.startswith("@"):
                 parts = message.split(maxsplit=1)
                 if len(parts) < 2:
@@ -126,13 +171,14 @@ def handleSend(sock):
 
                 full_message = f"SEND {destUser} {textOfMessage}\n"
                 try:
-                    sock.send(full_message.encode("utf-8"))
+                    send_all(sock, full_message.encode("utf-8"))
                 except (socket.error, BrokenPipeError, ConnectionResetError):
                     print("Failed to send message. Connection lost.")
                     break
                     
             else:
-                print("Invalid format. Use '@username message' or commands (!quit, !who)")
+                print("Invalid format. Use '@username message', '@#channel message' or commands "
+                      "(!quit, !who, !join #channel, !leave #channel)")
     finally:
         sock.close()
 
@@ -141,7 +187,10 @@ def main() -> None:
     args: Namespace = parse_arguments()
     port: int = args.port
     host: str = args.address
-    
+
+    if args.batch is not None:
+        sys.exit(run_batch(host, port, args.username, args.batch, args.window))
+
     print("Welcome to Chat Client. Enter your login: ")
     
     while True:
@@ -188,31 +237,33 @@ def main() -> None:
             print(f"Failed to send login request: {e}")
             chatSocket.close()
             continue
-            E
-        # Wait for server response
-        buff = ""
-        while "\n" not in buff:
+
+        # Wait for server response; lines that follow it stay in the framer for handleReceive
+        framer = LineFramer()
+        reply = None
+        while reply is None:
             try:
-                data = chatSocket.recv(4096)
-                if not data:
+                if not framer.recv_into(chatSocket):
                     print("Connection closed by server during login.")
                     chatSocket.close()
                     break
-                buff += data.decode("utf-8")
-            except UnicodeDecodeError:
-                print("Error decoding server response.")
-                chatSocket.close()
-                break
-            except (socket.error, ConnectionResetError) as e:
+                reply = next(framer.lines(), None)
+            except (socket.error, ConnectionResetError, LineTooLongError) as e:
                 print(f"Connection error: {e}")
                 chatSocket.close()
                 break
-                
-        if not buff:
+
+        if reply is None:
+            print("Enter your login: ")
+            continue
+
+        try:
+            response = reply.decode("utf-8").strip()
+        except UnicodeDecodeError:
+            print("Error decoding server response.")
+            chatSocket.close()
             print("Enter your login: ")
             continue
-            
-        response = buff.strip()
         
         if response.startswith("HELLO"):
             print(f"Successfully logged in as {user_name}!")
@@ -231,7 +282,7 @@ def main() -> None:
             chatSocket.close()
             print("Enter your login:")
 
-    receive_thread = threading.Thread(target=handleReceive, args=(chatSocket,))
+    receive_thread = threading.Thread(target=handleReceive, args=(chatSocket, framer))
     receive_thread.daemon = True
     receive_thread.start()
 
@@ -0,0 +1,226 @@
+import selectors
+import socket
+import sys
+import time
+from collections import deque
+from typing import Iterable, TextIO
+
+from a1_chat_client.refrac import send_all
+from lab_common.framing import LineFramer, LineTooLongError
+from lab_common.sendqueue import SendQueue
+
+class BatchClient:
+    """
+    Non-interactive chat client for scripts and bots.
+
+    Commands use the interactive syntax (`@user message`, `@#channel message`, `!who`,
+    `!join #channel`, `!leave #channel`, `!quit`) and are pipelined:
+    up to `window` requests are in flight without waiting for their replies. Frames are queued
+    in a SendQueue and written with one vectored send per loop iteration, and because the
+    server answers requests in order, every SEND-OK/BAD-DEST-USER/LIST-OK/JOIN-OK/LEAVE-OK is
+    matched to the oldest outstanding request. DELIVERY lines are unsolicited and printed as
+    they arrive.
+    """
+
+    def __init__(self, sock: socket.socket, framer: LineFramer, window: int = 1024,
+                 out: TextIO = sys.stdout) -> None:
+        """
+        :param sock: A connected, logged in socket.
+        :param framer: The framer used during login; it may already hold buffered lines.
+        :param window: The maximum number of requests awaiting a reply.
+        :param out: Where to print replies and deliveries.
+        """
+        self.sock: socket.socket = sock
+        self.framer: LineFramer = framer
+        self.window: int = window
+        self.out: TextIO = out
+        self.queue: SendQueue = SendQueue()
+        self.outstanding: deque[str] = deque()
+        self.requests: int = 0
+        self.failures: int = 0
+        self.closed: bool = False
+
+    def run(self, commands: Iterable[str]) -> None:
+        """
+        Send every command, then wait until all replies have arrived and say QUIT.
+        :param commands: Lines in the interactive command syntax.
+        """
+        self.sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        events = selectors.EVENT_READ
+        commands = iter(commands)
+        exhausted = False
+        # Replies that arrived together with the login reply
+        self._handle_lines()
+
+        try:
+            while not self.closed:
+                while not exhausted and len(self.outstanding) < self.window:
+                    command = next(commands, None)
+                    if command is None or command.strip() == "!quit":
+                        exhausted = True
+                    else:
+                        self._queue_command(command.strip())
+                if exhausted and not self.outstanding:
+                    break
+
+                if self.queue:
+                    self.queue.flush(self.sock)
+                wanted = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.queue else 0)
+                if wanted != events:
+                    selector.modify(self.sock, wanted)
+                    events = wanted
+                for _, mask in selector.select():
+                    if mask & selectors.EVENT_READ:
+                        self._on_readable()
+        finally:
+            selector.close()
+
+        if not self.closed:
+            self.queue.push(b"QUIT\n")
+            self.sock.setblocking(True)
+            while self.queue:
+                self.queue.flush(self.sock)
+
+    def _queue_command(self, command: str) -> None:
+        if not command:
+            return
+        if command == "!who":
+            self.queue.push(b"LIST\n")
+            self.outstanding.append(command)
+        elif command.startswith("!join ") or command.startswith("!leave "):
+            name, _, channel = command.partition(" ")
+            channel = channel.strip()
+            if not channel.startswith("#"):
+                channel = "#" + channel
+            self.queue.push(f"{'JOIN' if name == '!join' else 'LEAVE'} {channel}\n".encode("utf-8"))
+            self.outstanding.append(command)
+        elif command.startswith("@"):
+            destination, _, text = command[1:].partition(" ")
+            self.queue.push(f"SEND {destination} {text}\n".encode("utf-8"))
+            self.outstanding.append(command)
+        else:
+            print(f"Invalid format, skipped: {command}", file=self.out)
+            return
+        self.requests += 1
+
+    def _on_readable(self) -> None:
+        try:
+            received = self.framer.recv_into(self.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"Connection error: {e}", file=self.out)
+            self.closed = True
+            return
+        if not received:
+            print("Connection closed by server.", file=self.out)
+            self.closed = True
+            return
+        self._handle_lines()
+
+    def _handle_lines(self) -> None:
+        try:
+            lines = list(self.framer.lines())
+        except LineTooLongError:
+            print("Error: Message from server is too long.", file=self.out)
+            self.closed = True
+            return
+        for raw_line in lines:
+            line = raw_line.decode("utf-8", errors="replace")
+            header, _, body = line.partition(" ")
+            if header == "DELIVERY":
+                sender, _, message = body.partition(" ")
+                if sender.startswith("#"):
+                    channel = sender
+                    sender, _, message = message.partition(" ")
+                    print(f"From {sender} in {channel}: {message}", file=self.out)
+                else:
+                    print(f"From {sender}: {message}", file=self.out)
+                continue
+            command = self.outstanding.popleft() if self.outstanding else ""
+            if header == "SEND-OK":
+                print("The message was sent successfully", file=self.out)
+            elif header == "JOIN-OK":
+                print(f"Joined {body}", file=self.out)
+            elif header == "LEAVE-OK":
+                print(f"Left {body}", file=self.out)
+            elif header == "LIST-OK":
+                users = [user for user in body.split(",") if user]
+                print(f"There are {len(users)} online users:", file=self.out)
+                for user in users:
+                    print(user, file=self.out)
+            else:
+                self.failures += 1
+                if header == "BAD-DEST-USER":
+                    print(f"The destination user or channel does not exist: {command}", file=self.out)
+                elif header == "BAD-RQST-HDR":
+                    print(f"Error: Unknown issue in previous message header: {command}", file=self.out)
+                elif header == "BAD-RQST-BODY":
+                    print(f"Error: Unknown issue in previous message body: {command}", file=self.out)
+                else:
+                    print(f"Error: Unknown message header '{header}'", file=self.out)
+
+
+def login(sock: socket.socket, username: str) -> LineFramer | None:
+    """
+    Perform the HELLO-FROM handshake without prompting.
+    :param sock: A connected socket.
+    :param username: The username to log in as.
+    :return: The framer holding any lines received after the reply, or None if login failed.
+    """
+    framer = LineFramer()
+    send_all(sock, f"HELLO-FROM {username}\n".encode("utf-8"))
+    reply = None
+    while reply is None:
+        if not framer.recv_into(sock):
+            print("Connection closed by server during login.", file=sys.stderr)
+            return None
+        reply = next(framer.lines(), None)
+    header = reply.decode("utf-8", errors="replace").split(" ", 1)[0]
+    if header == "HELLO":
+        return framer
+    if header == "IN-USE":
+        print(f"Cannot log in as {username}. That username is already in use.", file=sys.stderr)
+    elif header == "BUSY":
+        print("Cannot log in. The server is full!", file=sys.stderr)
+    else:
+        print(f"Cannot log in as {username}. That username contains disallowed characters.", file=sys.stderr)
+    return None
+
+
+def run_batch(host: str, port: int, username: str, script: str, window: int) -> int:
+    """
+    Log in and pipeline every command of a script.
+    :param host: The server address.
+    :param port: The server port.
+    :param username: The username to log in as.
+    :param script: Path of the command file, or "-" for stdin.
+    :param window: The maximum number of requests awaiting a reply.
+    :return: The process exit code.
+    """
+    try:
+        sock = socket.create_connection((host, port))
+    except OSError as e:
+        print(f"Cannot connect to server: {e}", file=sys.stderr)
+        return 1
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        framer = login(sock, username)
+        if framer is None:
+            return 1
+        client = BatchClient(sock, framer, window=window)
+        start = time.perf_counter()
+        if script == "-":
+            client.run(sys.stdin)
+        else:
+            with open(script, encoding="utf-8") as commands:
+                client.run(commands)
+        elapsed = time.perf_counter() - start
+        rate = client.requests / elapsed if elapsed > 0 else 0.0
+        print(f"Sent {client.requests} requests ({client.failures} failed) in {elapsed:.3f}s, "
+              f"{rate:.0f} requests/s", file=sys.stderr)
+        return 1 if client.closed else 0
+    finally:
+        sock.close()
@@ -3,6 +3,8 @@ import threading
 import sys
 from argparse import Namespace, ArgumentParser
 
+from lab_common.framing import LineFramer
+
 def parse_arguments() -> Namespace:
     """
     Parse command line arguments for the chat client.
@@ -26,7 +28,8 @@ def parse_arguments() -> Namespace:
 def send_all(sock, data) -> None: 
     """
     Custom function for sending data chunks through a socket replacing sendall().
-    Allowing partial sends until all data is transmitted.
+    Allowing partial sends until all data is transmitted, re-slicing a memoryview so the
+    unsent tail is never copied.
 
     Args:
         sock: Socket object for data transmission
@@ -36,10 +39,11 @@ def send_all(sock, data) -> None:
         RuntimeError: Broken connection error during transimission
         ConnectionError: Other network related errors including BrokenPipeError, ConnectionResetError and OSError
     """
+    view = memoryview(data)
     total_sent = 0
-    while total_sent < len(data):
+    while total_sent < len(view):
         try:
-            sent = sock.send(data[total_sent:])
+            sent = sock.send(view[total_sent:])
             # Raise connection error after handing 0 bytes data
             if sent == 0:
                 raise RuntimeError("Socket connection broken")
@@ -49,12 +53,13 @@ def send_all(sock, data) -> None:
             raise
 
 # Login phase of the chat client
-def login(sock) -> bool:
+def login(sock, framer) -> bool:
     """
     Server authetication function implementing RA1 to RA8, see inline comments for specific requirements.
 
     Args:
         sock: Socket object for data transmission
+        framer: LineFramer buffering the server's lines, including any that follow the login reply
     
     Returns:
         bool: True if login successful, False otherwise.
@@ -80,20 +85,20 @@ def login(sock) -> bool:
 
             send_all(sock, f"HELLO-FROM {username}\n".encode("UTF-8")) # Convert string to bytes
             # Receive server response
-            response = ''
-            while '\n' not in response: # Waiting for complete message
+            line = None
+            while line is None: # Waiting for complete message
                 try:
-                    chunk = sock.recv(4096).decode("utf-8", errors="replace") # Convert bytes to strings, handles alien bytes instead of crashing
-                    if not chunk: # Graceful closure
+                    if not framer.recv_into(sock): # Graceful closure
                         print("Connection closed by server.")
                         return False
-                    response += chunk
+                    line = next(framer.lines(), None) # Later lines stay buffered in the framer
                 except (ConnectionResetError, OSError): # Abrupt closure
                     print("Connection lost")
                     return False
-    	    
+            response = line.decode("utf-8", errors="replace") # Handles alien bytes instead of crashing
+
             # Retrieve header
-            header = response.split('\n', 1)[0].split(' ', 1)[0]
+            header = response.split(' ', 1)[0]
             # Process header
             if header == 'HELLO':
                 print(f"Successfully logged in as {username}")
@@ -136,7 +141,8 @@ def main() -> None:
         print(f"A connection error has occurred: {e}")
         return
     # Close connection if login was not detected
-    if not login(sock):
+    framer = LineFramer()
+    if not login(sock, framer):
         sock.close()
         return
     
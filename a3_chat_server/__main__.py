@@ -1,12 +1,36 @@
+import logging
+import signal
+import sys
 from argparse import Namespace, ArgumentParser
 
+from a3_chat_server.cluster import serve_workers
+from a3_chat_server.server import (DEFAULT_MAX_QUEUE_BYTES, DEFAULT_MAX_QUEUE_MESSAGES, POLICIES, POLICY_DROP_OLDEST,
+                                   ChatServer)
+from a3_chat_server.store import MessageStore
+from lab_common.metrics import Exporter, Metrics, parse_address
+from lab_common.resources import raise_fd_limit
+
 
 def parse_arguments() -> Namespace:
     """
     Parse command line arguments for the chat server.
-    The two valid options are:
+    The valid options are:
         --address: The host to listen at. Default is "0.0.0.0"
         --port: The port to listen at. Default is 5378
+        --max-clients: The number of concurrent connections before answering BUSY. Default is 16
+        --workers: The number of worker processes sharing the port. Default is 1
+        --max-queue-bytes: Bytes of undelivered messages queued per client. Default is 1048576
+        --max-queue-messages: Undelivered messages queued per client. Default is 1024
+        --queue-policy: What to do when a client's queue is full: drop-oldest, disconnect or
+                        backpressure. Default is "drop-oldest"
+        --store: Keep messages for offline users in this directory and replay them when they
+                 log in again; only with a single worker. Default is none
+        --metrics: Serve Prometheus metrics at [host]:port or a Unix socket path; workers after
+                   the first at the next ports or at the path suffixed with their number.
+                   Default is none
+        --profile: Sample the stacks of the event loop and write them, folded for flame graphs,
+                   to this file on exit. Default is none
+    Send SIGUSR1 to log the queue and drop statistics.
     :return: The parsed arguments in a Namespace object.
     """
 
@@ -19,7 +43,26 @@ def parse_arguments() -> Namespace:
                       type=str, help="Set server address", default="0.0.0.0")
     parser.add_argument("-p", "--port",
                       type=int, help="Set server port", default=5378)
-    return parser.parse_args()
+    parser.add_argument("-m", "--max-clients",
+                      type=int, help="Set the maximum number of concurrent connections", default=16)
+    parser.add_argument("-w", "--workers",
+                      type=int, help="Set the number of worker processes", default=1)
+    parser.add_argument("--max-queue-bytes",
+                      type=int, help="Set the bytes of messages queued per client", default=DEFAULT_MAX_QUEUE_BYTES)
+    parser.add_argument("--max-queue-messages",
+                      type=int, help="Set the messages queued per client", default=DEFAULT_MAX_QUEUE_MESSAGES)
+    parser.add_argument("--queue-policy", choices=POLICIES,
+                      help="Set what happens when a client's queue is full", default=POLICY_DROP_OLDEST)
+    parser.add_argument("--store",
+                      type=str, help="Set the directory storing messages for offline users")
+    parser.add_argument("--metrics",
+                      type=parse_address, help="Set the address serving Prometheus metrics")
+    parser.add_argument("--profile",
+                      type=str, help="Set the file the sampled stacks are written to")
+    args = parser.parse_args()
+    if args.store is not None and args.workers > 1:
+        parser.error("--store requires a single worker")
+    return args
 
 
 # Execute using `python -m a3_chat_server`
@@ -28,7 +71,34 @@ def main() -> None:
     port: int = args.port
     host: str = args.address
 
-    # TODO: Your implementation here
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s - %(levelname)s] %(message)s")
+    raise_fd_limit()
+
+    options = {"max_queue_bytes": args.max_queue_bytes, "max_queue_messages": args.max_queue_messages,
+               "queue_policy": args.queue_policy}
+    if args.workers > 1:
+        serve_workers(host, port, args.max_clients, args.workers, args.metrics, args.profile, **options)
+        return
+
+    store = None
+    if args.store is not None:
+        store = MessageStore(args.store)
+        store.open()
+    metrics = Metrics("chat") if args.metrics else None
+    server = ChatServer(host, port, max_clients=args.max_clients, store=store, metrics=metrics, **options)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: server.request_stats())
+    # Unwind on SIGTERM, so that the store and the profile are written out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    exporter = Exporter(metrics, args.metrics, args.profile)
+    exporter.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        exporter.close()
+        if store is not None:
+            store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,357 @@
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+import zlib
+
+from a3_chat_server.server import ChatServer, Connection
+from lab_common.framing import DEFAULT_MAX_LINE_LENGTH, LineFramer
+from lab_common.metrics import Exporter, Metrics, worker_address
+
+logger = logging.getLogger(__name__)
+
+# A peer line carries a client's line together with a username from another client line, so a
+# link accepts twice the client limit plus room for the command and separators
+PEER_MAX_LINE_LENGTH = 2 * DEFAULT_MAX_LINE_LENGTH + 64
+
+
+class ShardedChatServer(ChatServer):
+    """
+    One worker of a multi-process chat server.
+
+    Every worker accepts clients on the shared port and keeps a full-mesh of Unix socket links
+    to the other workers. Usernames are sharded by CRC32 over the workers: the owning worker
+    arbitrates HELLO-FROM claims for its shard, so IN-USE stays exact across processes.
+    Successful logins and logouts are broadcast as JOIN/LEAVE so that every worker holds a
+    replica of the user directory, which answers LIST and locates the worker owning the
+    destination of a SEND. Messages for remote users travel as one ROUTE line over the link.
+
+    A worker tells the others when a channel gains its first or loses its last local member
+    (SUBSCRIBE/UNSUBSCRIBE), so each worker knows which workers have members of a channel. A
+    channel message is then relayed as one CAST line per such worker, and every worker fans it
+    out to its own members, encoding the DELIVERY once.
+
+    Peer lines:
+        CLAIM <token> <username>, answered with CLAIMED or TAKEN <token> <username>
+        JOIN <username> / LEAVE <username>
+        ROUTE <destination> <sender> <message>
+        SUBSCRIBE <channel> / UNSUBSCRIBE <channel>
+        CAST <channel> <sender> <message>
+    """
+
+    def __init__(self, host: str, port: int, max_clients: int, worker_id: int, workers: int,
+                 peers: dict[int, socket.socket], listener: socket.socket | None = None, **options) -> None:
+        super().__init__(host, port, max_clients=max_clients, **options)
+        self.worker_id: int = worker_id
+        self.workers: int = workers
+        self.shared_listener: socket.socket | None = listener
+        # Username -> id of the worker holding that user's connection, for every worker
+        self.directory: dict[bytes, int] = {}
+        # Usernames of this worker's shard that are currently taken anywhere
+        self.claims: set[bytes] = set()
+        # Channel -> ids of the other workers with members in it
+        self.subscribers: dict[bytes, set[int]] = {}
+        self.pending: dict[bytes, Connection] = {}
+        # Lines a client pipelined behind a HELLO-FROM whose claim is still in flight
+        self.held: dict[Connection, list[bytes]] = {}
+        self.next_token: int = 0
+        self.peers: dict[int, Connection] = {}
+        self.peer_ids: dict[Connection, int] = {}
+        for peer_id, sock in peers.items():
+            sock.setblocking(False)
+            link = Connection(sock, f"worker-{peer_id}")
+            link.framer = LineFramer(PEER_MAX_LINE_LENGTH)
+            self.peers[peer_id] = link
+            self.peer_ids[link] = peer_id
+            self.selector.register(sock, selectors.EVENT_READ, link)
+
+    def bind(self) -> None:
+        """
+        Use the listening socket inherited from the supervisor or, where the platform supports
+        it, bind an own SO_REUSEPORT socket so the kernel balances new connections over workers.
+        """
+        listener = self.shared_listener
+        if listener is None:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            listener.bind((self.host, self.port))
+            listener.listen(self.backlog)
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ)
+        self.listener = listener
+        logger.info("Worker %d listening on %s:%d", self.worker_id, self.host, self.port)
+
+    def shard_of(self, username: bytes) -> int:
+        """
+        :param username: The username to look up.
+        :return: The id of the worker arbitrating claims for the username.
+        """
+        return zlib.crc32(username) % self.workers
+
+    def is_full(self) -> bool:
+        return len(self.connections) >= self.max_clients or len(self.directory) >= self.max_clients
+
+    def is_backlogged(self, conn: Connection) -> bool:
+        # A link to another worker is always read: if both ends stopped reading while their
+        # queues to each other were full, neither would ever drain
+        return conn not in self.peer_ids and super().is_backlogged(conn)
+
+    def list_users(self):
+        return self.directory
+
+    def handle_line(self, conn: Connection, line: bytes) -> None:
+        peer_id = self.peer_ids.get(conn)
+        if peer_id is not None:
+            self._handle_peer_line(peer_id, line)
+        elif conn in self.held:
+            self.held[conn].append(line)
+        else:
+            super().handle_line(conn, line)
+
+    def reserve(self, conn: Connection, username: bytes) -> None:
+        if username in self.directory:
+            self.reject_login(conn)
+            return
+        owner = self.shard_of(username)
+        if owner == self.worker_id:
+            if username in self.claims:
+                self.reject_login(conn)
+            else:
+                self.claims.add(username)
+                self.login(conn, username)
+            return
+        token = b"%d" % self.next_token
+        self.next_token += 1
+        self.pending[token] = conn
+        self.held[conn] = []
+        self.send(self.peers[owner], b"CLAIM " + token + b" " + username + b"\n")
+
+    def login(self, conn: Connection, username: bytes) -> None:
+        super().login(conn, username)
+        self.directory[username] = self.worker_id
+        self._broadcast(b"JOIN " + username + b"\n")
+
+    def logout(self, conn: Connection) -> None:
+        super().logout(conn)
+        username = conn.username
+        if self.directory.get(username) == self.worker_id:
+            del self.directory[username]
+        self.claims.discard(username)
+        self._broadcast(b"LEAVE " + username + b"\n")
+
+    def deliver(self, destination: bytes, sender: bytes, message: bytes,
+                origin: Connection | None = None) -> bool:
+        if super().deliver(destination, sender, message, origin):
+            return True
+        owner = self.directory.get(destination)
+        if owner is None or owner == self.worker_id:
+            return False
+        self.send(self.peers[owner], b"ROUTE " + destination + b" " + sender + b" " + message + b"\n")
+        return True
+
+    def join_channel(self, conn: Connection, channel: bytes) -> None:
+        first = channel not in self.channels
+        super().join_channel(conn, channel)
+        if first:
+            self._broadcast(b"SUBSCRIBE " + channel + b"\n")
+
+    def leave_channel(self, conn: Connection, channel: bytes) -> None:
+        existed = channel in self.channels
+        super().leave_channel(conn, channel)
+        if existed and channel not in self.channels:
+            self._broadcast(b"UNSUBSCRIBE " + channel + b"\n")
+
+    def publish(self, channel: bytes, sender: bytes, message: bytes, origin: Connection | None = None) -> None:
+        super().publish(channel, sender, message, origin)
+        workers = self.subscribers.get(channel)
+        if workers:
+            line = b"CAST " + channel + b" " + sender + b" " + message + b"\n"
+            for peer_id in workers:
+                self.send(self.peers[peer_id], line)
+
+    def _broadcast(self, line: bytes) -> None:
+        for link in self.peers.values():
+            self.send(link, line)
+
+    def _handle_peer_line(self, peer_id: int, line: bytes) -> None:
+        header, _, body = line.partition(b" ")
+        if header == b"ROUTE":
+            destination, _, rest = body.partition(b" ")
+            sender, _, message = rest.partition(b" ")
+            # The user may have left after the sender's directory replica was read; drop it then
+            super().deliver(destination, sender, message)
+        elif header == b"CAST":
+            channel, _, rest = body.partition(b" ")
+            sender, _, message = rest.partition(b" ")
+            # Only to the local members; the sending worker relays to every other worker itself
+            super().publish(channel, sender, message)
+        elif header == b"SUBSCRIBE":
+            self.subscribers.setdefault(body, set()).add(peer_id)
+        elif header == b"UNSUBSCRIBE":
+            workers = self.subscribers.get(body)
+            if workers is not None:
+                workers.discard(peer_id)
+                if not workers:
+                    del self.subscribers[body]
+        elif header == b"JOIN":
+            self.directory[body] = peer_id
+        elif header == b"LEAVE":
+            if self.directory.get(body) == peer_id:
+                del self.directory[body]
+            if self.shard_of(body) == self.worker_id:
+                self.claims.discard(body)
+        elif header == b"CLAIM":
+            token, _, username = body.partition(b" ")
+            if username in self.claims:
+                reply = b"TAKEN "
+            else:
+                self.claims.add(username)
+                reply = b"CLAIMED "
+            self.send(self.peers[peer_id], reply + body + b"\n")
+        elif header in (b"CLAIMED", b"TAKEN"):
+            token, _, username = body.partition(b" ")
+            conn = self.pending.pop(token, None)
+            held = self.held.pop(conn, ())
+            if header == b"TAKEN":
+                if conn is not None:
+                    self.reject_login(conn)
+            elif conn is None or conn.closed:
+                # The client went away while waiting, hand the claim back
+                self.send(self.peers[peer_id], b"LEAVE " + username + b"\n")
+            else:
+                self.login(conn, username)
+                for line in held:
+                    if conn.closed:
+                        break
+                    self.handle_line(conn, line)
+        else:
+            logger.warning("Unknown line from worker %d: %r", peer_id, line)
+
+    def close_connection(self, conn: Connection) -> None:
+        peer_id = self.peer_ids.pop(conn, None)
+        if peer_id is None:
+            self.held.pop(conn, None)
+            super().close_connection(conn)
+            return
+        # A worker died: forget its users so LIST and SEND stop pointing at it
+        logger.error("Lost link to worker %d", peer_id)
+        conn.closed = True
+        del self.peers[peer_id]
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        for username, owner in list(self.directory.items()):
+            if owner == peer_id:
+                del self.directory[username]
+        for channel, workers in list(self.subscribers.items()):
+            workers.discard(peer_id)
+            if not workers:
+                del self.subscribers[channel]
+
+
+def serve_workers(host: str, port: int, max_clients: int, workers: int, metrics_address: str | None = None,
+                  profile: str | None = None, **options) -> None:
+    """
+    Fork the worker processes, connect them pairwise with Unix socket links and supervise them.
+    If any worker exits the rest are stopped as well, since the shard it owned is gone.
+    SIGUSR1 is passed on to the workers, which then log their statistics.
+    :param host: The host to listen at.
+    :param port: The port to listen at.
+    :param max_clients: The maximum number of logged in users over all workers.
+    :param workers: The number of worker processes.
+    :param metrics_address: Where worker 0 serves its metrics; worker n at the port plus n, or
+                            at the socket path suffixed with ".n".
+    :param profile: The file worker 0 writes its profile to; worker n appends ".n".
+    :param options: Further keyword arguments for every worker's server, such as the queue limits.
+    """
+    links: dict[tuple[int, int], tuple[socket.socket, socket.socket]] = {
+        (i, j): socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        for i in range(workers) for j in range(i + 1, workers)
+    }
+    listener: socket.socket | None = None
+    if not hasattr(socket, "SO_REUSEPORT"):
+        # Fall back to one listening socket inherited by every worker
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+        listener.listen(1024)
+
+    children: dict[int, int] = {}
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(_run_worker(host, port, max_clients, worker_id, workers, links, listener, options,
+                                 worker_address(metrics_address, worker_id),
+                                 f"{profile}.{worker_id}" if profile and worker_id else profile))
+        children[pid] = worker_id
+
+    for a, b in links.values():
+        a.close()
+        b.close()
+    if listener is not None:
+        listener.close()
+
+    def forward_signal(signum, frame) -> None:
+        for child in children:
+            os.kill(child, signum)
+
+    signal.signal(signal.SIGUSR1, forward_signal)
+    # Unwind on SIGTERM too, so that the workers are stopped and write their profiles
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        pid, status = os.wait()
+        logger.error("Worker %d exited with status %d, stopping", children.pop(pid), status)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
+def _run_worker(host: str, port: int, max_clients: int, worker_id: int, workers: int,
+                links: dict[tuple[int, int], tuple[socket.socket, socket.socket]],
+                listener: socket.socket | None, options: dict, metrics_address: str | None,
+                profile: str | None) -> int:
+    peers: dict[int, socket.socket] = {}
+    for (i, j), (a, b) in links.items():
+        if i == worker_id:
+            peers[j] = a
+            b.close()
+        elif j == worker_id:
+            peers[i] = b
+            a.close()
+        else:
+            a.close()
+            b.close()
+    metrics = Metrics("chat") if metrics_address else None
+    exporter = Exporter(metrics, metrics_address, profile)
+    if profile is None:
+        # Exit quietly on the supervisor's SIGTERM
+        signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+    else:
+        # Unwind on the supervisor's SIGTERM, so that the profile is written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server = ShardedChatServer(host, port, max_clients, worker_id, workers, peers, listener, metrics=metrics,
+                                   **options)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: server.request_stats())
+        exporter.start()
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        return 0
+    except Exception:
+        logger.exception("Worker %d crashed", worker_id)
+        return 1
+    finally:
+        exporter.close()
+    return 0
@@ -0,0 +1,665 @@
+import heapq
+import logging
+import selectors
+import socket
+
+from a3_chat_server.store import MessageStore
+from lab_common.framing import LineFramer, LineTooLongError
+from lab_common.metrics import Metrics
+from lab_common.sendqueue import SendQueue
+
+logger = logging.getLogger(__name__)
+
+# Characters that may not appear in a username (mirrors the A1 client checks)
+FORBIDDEN_USERNAME_CHARS = frozenset(b" !@#$%^&*,")
+# Channel names are a "#" followed by characters allowed in a username, so they never clash with one
+CHANNEL_PREFIX = b"#"
+
+# What happens when a DELIVERY would take a client's outbound queue past its limits
+POLICY_DROP_OLDEST = "drop-oldest"
+POLICY_DISCONNECT = "disconnect"
+POLICY_BACKPRESSURE = "backpressure"
+POLICIES = (POLICY_DROP_OLDEST, POLICY_DISCONNECT, POLICY_BACKPRESSURE)
+DEFAULT_MAX_QUEUE_BYTES = 1 << 20
+DEFAULT_MAX_QUEUE_MESSAGES = 1024
+# Longest wait in select(), so that statistics requested by a signal are not delayed for long
+POLL_INTERVAL = 1.0
+# Connections listed by their queue depth in stats()
+DEEPEST_QUEUES = 5
+
+
+class Connection:
+    """
+    State for a single client socket: the line framer holding bytes that have not yet formed
+    a complete line, the send queue holding bytes the kernel did not accept yet, and the
+    username once the HELLO-FROM handshake succeeded.
+
+    Under the backpressure policy a connection whose messages filled another client's queue is
+    paused: it is not read from until that queue drains, and `waiters` holds the connections
+    paused on this one's queue. A connection is `backlogged`, and paused as well, while the
+    replies to its own requests are over the queue limits. `channels` holds the channels the
+    user has joined, and `replaying` is set while messages stored for the user are still being
+    replayed.
+    """
+
+    __slots__ = ("sock", "address", "username", "framer", "queue", "events", "paused", "backlogged", "waiters",
+                 "channels", "replaying", "closed")
+
+    def __init__(self, sock: socket.socket, address) -> None:
+        self.sock: socket.socket = sock
+        self.address = address
+        self.username: bytes | None = None
+        self.framer: LineFramer = LineFramer()
+        self.queue: SendQueue = SendQueue()
+        self.events: int = selectors.EVENT_READ
+        self.paused: bool = False
+        self.backlogged: bool = False
+        self.waiters: dict[Connection, None] = {}
+        self.channels: set[bytes] = set()
+        self.replaying: bool = False
+        self.closed: bool = False
+
+
+class ChatServer:
+    """
+    Single-threaded chat server multiplexing every client socket on one selector.
+
+    All sockets are non-blocking: reads are drained into per-connection buffers and complete lines
+    are handled immediately. Replies are appended to the per-connection SendQueue and every
+    queue touched during one loop iteration is flushed with a single vectored send at the end
+    of it, so a burst of requests costs one syscall per destination rather than one per reply.
+
+    DELIVERY messages are bounded per connection by `max_queue_bytes` and `max_queue_messages`,
+    so that a client that stops reading cannot grow the server's memory without limit. When a
+    message would exceed them, the `queue_policy` decides:
+        drop-oldest: older undelivered DELIVERY messages are discarded to make room
+        disconnect: the slow client is disconnected
+        backpressure: the message is queued, but its sender is not read from until the queue
+                      has drained to half its limits, so the sender is slowed down to the pace
+                      of the slow reader. Messages relayed by other workers have no sender
+                      connection to pause and fall back to drop-oldest.
+    Replies to a client's own requests are never dropped; instead, whatever the policy, a client
+    whose unsent replies alone are over the limits is not read from until they have drained to
+    half of them, so pipelining requests without reading the replies cannot grow it either.
+    Queue depths and drop counters are reported by stats(), which is logged on request_stats()
+    (SIGUSR1).
+
+    Besides one-to-one messages users can talk in channels:
+        JOIN #<channel>, answered with JOIN-OK #<channel>
+        LEAVE #<channel>, answered with LEAVE-OK #<channel>, or BAD-DEST-USER if not a member
+        SEND #<channel> <message>, answered with SEND-OK, or BAD-DEST-USER if not a member
+    A channel exists while it has members. Every other member receives
+    `DELIVERY #<channel> <sender> <message>`; that line is built once per message and the same
+    bytes object is queued for every member, without encoding or copying it per member.
+    Members are kept per channel in a dict used as an ordered set, so joining, leaving and
+    membership checks take constant time.
+
+    With a MessageStore, messages for users who logged in before but are offline now are
+    stored and acknowledged with SEND-OK instead of BAD-DEST-USER, and replayed when the user
+    logs in again. The replay is queued in batches of up to half the queue limits, the next
+    one once the previous has drained; until the last one, new messages for the user are
+    stored as well, so that they arrive in order.
+
+    With a Metrics object the statistics are exported as counters and gauges, and handling a
+    line, routing a message, fanning out a channel message and writing the queues are timed.
+    """
+
+    def __init__(self, host: str, port: int, max_clients: int = 16, backlog: int = 1024,
+                 max_queue_bytes: int = DEFAULT_MAX_QUEUE_BYTES, max_queue_messages: int = DEFAULT_MAX_QUEUE_MESSAGES,
+                 queue_policy: str = POLICY_DROP_OLDEST, store: MessageStore | None = None,
+                 metrics: Metrics | None = None) -> None:
+        if queue_policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy {queue_policy}")
+        self.host: str = host
+        self.port: int = port
+        self.max_clients: int = max_clients
+        self.backlog: int = backlog
+        self.max_queue_bytes: int = max_queue_bytes
+        self.max_queue_messages: int = max_queue_messages
+        self.queue_policy: str = queue_policy
+        self.store: MessageStore | None = store
+        self.selector: selectors.BaseSelector = selectors.DefaultSelector()
+        self.listener: socket.socket | None = None
+        self.connections: dict[socket.socket, Connection] = {}
+        self.users: dict[bytes, Connection] = {}
+        # Channel name -> its members on this server
+        self.channels: dict[bytes, dict[Connection, None]] = {}
+        self.dirty: dict[Connection, None] = {}
+        self.stats_requested: bool = False
+        self.counters: dict[str, int] = {
+            "deliveries": 0, "channel_messages": 0, "dropped_messages": 0, "dropped_bytes": 0,
+            "slow_disconnects": 0, "backpressure_pauses": 0, "queue_high_water_bytes": 0,
+        }
+        if metrics is not None:
+            # The high water mark is a level rather than a count of events; rate() means nothing for it
+            counters = [name for name in self.counters if name != "queue_high_water_bytes"]
+            if self.store is not None:
+                counters += self.store.counters
+            metrics.collect(self.stats, counters=counters)
+            # Parsing is timed per batch of lines read, so that only routing adds a timer per message
+            metrics.instrument(self, {"_process": "parse", "deliver": "route", "publish": "fanout",
+                                      "flush_pending": "send"})
+
+    def bind(self) -> None:
+        """
+        Create the non-blocking listening socket and register it with the selector.
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(self.backlog)
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ)
+        self.listener = listener
+        logger.info("Server listening on %s:%d", self.host, self.port)
+
+    def serve_forever(self) -> None:
+        """
+        Run the event loop until interrupted.
+        """
+        if self.listener is None:
+            self.bind()
+        try:
+            while True:
+                for key, mask in self.selector.select(POLL_INTERVAL):
+                    conn = key.data
+                    if conn is None:
+                        self._accept()
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self._on_readable(conn)
+                    if mask & selectors.EVENT_WRITE and not conn.closed:
+                        self._flush(conn)
+                self.flush_pending()
+                if self.stats_requested:
+                    self.stats_requested = False
+                    logger.info("Statistics: %s", self.stats())
+        finally:
+            self.shutdown()
+
+    def request_stats(self) -> None:
+        """
+        Log the statistics at the next iteration of the event loop. Safe to call from a signal
+        handler.
+        """
+        self.stats_requested = True
+
+    def stats(self) -> dict[str, int | list]:
+        """
+        :return: The delivery and drop counters, the bytes and messages queued over all
+                 connections, and the connections with the deepest queues.
+        """
+        connections = self.connections.values()
+        deepest = heapq.nlargest(DEEPEST_QUEUES, (conn for conn in connections if conn.queue),
+                                 key=lambda conn: len(conn.queue))
+        stats = {
+            **self.counters,
+            "connections": len(self.connections),
+            "channels": len(self.channels),
+            "queued_bytes": sum(len(conn.queue) for conn in connections),
+            "queued_messages": sum(conn.queue.frames for conn in connections),
+            "paused": sum(conn.paused for conn in connections),
+            "deepest_queues": [{"user": (conn.username or b"").decode(errors="replace") or str(conn.address),
+                                "bytes": len(conn.queue), "messages": conn.queue.frames} for conn in deepest],
+        }
+        if self.store is not None:
+            stats["store"] = self.store.stats()
+        return stats
+
+    def shutdown(self) -> None:
+        """
+        Close every client socket and the listening socket.
+        """
+        for conn in list(self.connections.values()):
+            self.close_connection(conn)
+        if self.listener is not None:
+            self.selector.unregister(self.listener)
+            self.listener.close()
+            self.listener = None
+        self.selector.close()
+
+    def _accept(self) -> None:
+        # Drain the whole accept queue so a connection burst costs one wakeup
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Typically EMFILE: leave the rest in the backlog until descriptors free up
+                logger.warning("Failed to accept connection: %s", e)
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.is_full():
+                try:
+                    sock.send(b"BUSY\n")
+                except OSError:
+                    pass
+                sock.close()
+                continue
+            conn = Connection(sock, address)
+            self.connections[sock] = conn
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+            logger.debug("Accepted connection from %s", address)
+
+    def is_full(self) -> bool:
+        """
+        :return: Whether a newly accepted connection should be refused with BUSY.
+        """
+        return len(self.connections) >= self.max_clients
+
+    def is_backlogged(self, conn: Connection) -> bool:
+        """
+        :return: Whether the replies queued for a connection are over the queue limits, so that
+                 it is not read from until they have drained.
+        """
+        queue = conn.queue
+        return queue.kept > self.max_queue_messages or queue.kept_bytes > self.max_queue_bytes
+
+    def _on_readable(self, conn: Connection) -> None:
+        try:
+            received = conn.framer.recv_into(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close_connection(conn)
+            return
+        if not received:
+            self.close_connection(conn)
+            return
+        self._process(conn)
+
+    def _process(self, conn: Connection) -> None:
+        """
+        Handle the complete lines buffered for a connection until it is closed or paused.
+        """
+        try:
+            for line in conn.framer.lines():
+                self.handle_line(conn, line)
+                if conn.closed or conn.paused:
+                    break
+                if self.is_backlogged(conn):
+                    # The client does not read its replies; wait for them to drain
+                    conn.backlogged = True
+                    self._pause(conn)
+                    break
+        except LineTooLongError:
+            self.send(conn, b"BAD-RQST-BODY\n")
+            self.close_connection(conn)
+
+    def handle_line(self, conn: Connection, line: bytes) -> None:
+        """
+        Dispatch one protocol line received from a client.
+        :param conn: The connection the line arrived on.
+        :param line: The line without its trailing newline.
+        """
+        header, _, body = line.partition(b" ")
+
+        if conn.username is None:
+            if header != b"HELLO-FROM":
+                self.send(conn, b"BAD-RQST-HDR\n")
+                self.close_connection(conn)
+                return
+            self._handle_hello(conn, body)
+        elif header == b"SEND":
+            self._handle_send(conn, body)
+        elif header == b"JOIN":
+            self._handle_join(conn, body)
+        elif header == b"LEAVE":
+            self._handle_leave(conn, body)
+        elif header == b"LIST":
+            self.send(conn, b"LIST-OK " + b",".join(self.list_users()) + b"\n")
+        elif header == b"QUIT":
+            self.close_connection(conn)
+        else:
+            self.send(conn, b"BAD-RQST-HDR\n")
+
+    def _handle_hello(self, conn: Connection, username: bytes) -> None:
+        if not username or any(char in FORBIDDEN_USERNAME_CHARS for char in username):
+            self.send(conn, b"BAD-RQST-BODY\n")
+            self.close_connection(conn)
+            return
+        self.reserve(conn, username)
+
+    def reserve(self, conn: Connection, username: bytes) -> None:
+        """
+        Claim a validated username for a connection, then log it in or reject it as IN-USE.
+        :param conn: The connection that sent HELLO-FROM.
+        :param username: The requested username.
+        """
+        if username in self.users:
+            self.reject_login(conn)
+        else:
+            self.login(conn, username)
+
+    def login(self, conn: Connection, username: bytes) -> None:
+        """
+        Complete the handshake for a connection whose username has been validated and reserved.
+        :param conn: The connection that sent HELLO-FROM.
+        :param username: The accepted username.
+        """
+        conn.username = username
+        self.users[username] = conn
+        self.send(conn, b"HELLO " + username + b"\n")
+        logger.debug("User %s authenticated", username.decode(errors="replace"))
+        if self.store is not None:
+            self.store.register(username)
+            if self.store.has_pending(username):
+                self._replay(conn)
+
+    def _replay(self, conn: Connection) -> None:
+        """
+        Queue the next batch of the messages stored for a user, as one write.
+        """
+        frames = self.store.take(conn.username, self.max_queue_bytes // 2, max(1, self.max_queue_messages // 2))
+        if frames:
+            self.send(conn, b"".join(frames))
+        conn.replaying = self.store.has_pending(conn.username)
+
+    def reject_login(self, conn: Connection) -> None:
+        """
+        Refuse a handshake because the username is taken and drop the connection.
+        :param conn: The connection that sent HELLO-FROM.
+        """
+        self.send(conn, b"IN-USE\n")
+        self.close_connection(conn)
+
+    def logout(self, conn: Connection) -> None:
+        """
+        Forget the username of a connection that is being closed.
+        :param conn: The connection being closed.
+        """
+        if self.users.get(conn.username) is conn:
+            del self.users[conn.username]
+
+    def list_users(self):
+        """
+        :return: The usernames reported by LIST.
+        """
+        return self.users
+
+    def _handle_send(self, conn: Connection, body: bytes) -> None:
+        destination, _, message = body.partition(b" ")
+        if not destination or not message.strip():
+            self.send(conn, b"BAD-RQST-BODY\n")
+            return
+        if destination.startswith(CHANNEL_PREFIX):
+            if destination not in conn.channels:
+                self.send(conn, b"BAD-DEST-USER\n")
+                return
+            self.publish(destination, conn.username, message, conn)
+        elif not self.deliver(destination, conn.username, message, conn):
+            self.send(conn, b"BAD-DEST-USER\n")
+            return
+        self.send(conn, b"SEND-OK\n")
+
+    def deliver(self, destination: bytes, sender: bytes, message: bytes,
+                origin: Connection | None = None) -> bool:
+        """
+        Queue a DELIVERY for a user.
+        :param destination: The receiving username.
+        :param sender: The sending username.
+        :param message: The message body.
+        :param origin: The connection the message came from, paused under the backpressure
+                       policy if the destination's queue is full.
+        :return: False if the destination user is not logged in, nor known to the store.
+        """
+        target = self.users.get(destination)
+        frame = b"DELIVERY " + sender + b" " + message + b"\n"
+        if target is not None and not target.replaying:
+            self.send_bounded(target, frame, origin)
+            return True
+        if self.store is not None and self.store.append(destination, frame):
+            return True
+        if target is None:
+            return False
+        self.send_bounded(target, frame, origin)
+        return True
+
+    def publish(self, channel: bytes, sender: bytes, message: bytes, origin: Connection | None = None) -> None:
+        """
+        Queue a DELIVERY for every member of a channel on this server except the sender.
+        :param channel: The channel name, including the "#".
+        :param sender: The sending username.
+        :param message: The message body.
+        :param origin: The sender's connection; it receives no copy, and is paused under the
+                       backpressure policy if a member's queue is full.
+        """
+        members = self.channels.get(channel)
+        if not members:
+            return
+        counters = self.counters
+        counters["channel_messages"] += 1
+        # Encoded once; every member's queue holds this same view of the same bytes
+        frame = memoryview(b"DELIVERY " + channel + b" " + sender + b" " + message + b"\n")
+        # The common case of send_bounded() and send() inlined, as this loop runs once per member
+        max_bytes = self.max_queue_bytes - len(frame)
+        max_messages = self.max_queue_messages
+        dirty = self.dirty
+        deepest = 0
+        fast = 0
+        # Iterate over a copy, as a member may be disconnected by the queue policy meanwhile
+        for member in tuple(members):
+            if member is origin or member.closed:
+                continue
+            queue = member.queue
+            depth = len(queue)
+            if depth > max_bytes or queue.frames >= max_messages:
+                self.send_bounded(member, frame, origin)
+                continue
+            if not depth and not member.events & selectors.EVENT_WRITE:
+                dirty[member] = None
+            queue.push(frame, True)
+            if depth > deepest:
+                deepest = depth
+            fast += 1
+        counters["deliveries"] += fast
+        if fast and deepest + len(frame) > counters["queue_high_water_bytes"]:
+            counters["queue_high_water_bytes"] = deepest + len(frame)
+
+    def _handle_join(self, conn: Connection, channel: bytes) -> None:
+        if not self._is_channel(channel):
+            self.send(conn, b"BAD-RQST-BODY\n")
+            return
+        if channel not in conn.channels:
+            self.join_channel(conn, channel)
+        self.send(conn, b"JOIN-OK " + channel + b"\n")
+
+    def _handle_leave(self, conn: Connection, channel: bytes) -> None:
+        if not self._is_channel(channel):
+            self.send(conn, b"BAD-RQST-BODY\n")
+        elif channel not in conn.channels:
+            self.send(conn, b"BAD-DEST-USER\n")
+        else:
+            self.leave_channel(conn, channel)
+            self.send(conn, b"LEAVE-OK " + channel + b"\n")
+
+    @staticmethod
+    def _is_channel(name: bytes) -> bool:
+        return (len(name) > 1 and name.startswith(CHANNEL_PREFIX)
+                and not any(char in FORBIDDEN_USERNAME_CHARS for char in name[1:]))
+
+    def join_channel(self, conn: Connection, channel: bytes) -> None:
+        """
+        Add a connection to a channel, creating the channel if it has no members yet.
+        :param conn: The joining connection.
+        :param channel: The channel name, including the "#".
+        """
+        members = self.channels.get(channel)
+        if members is None:
+            members = self.channels[channel] = {}
+        members[conn] = None
+        conn.channels.add(channel)
+
+    def leave_channel(self, conn: Connection, channel: bytes) -> None:
+        """
+        Remove a connection from a channel, which is forgotten once its last member left.
+        :param conn: The leaving connection.
+        :param channel: The channel name, including the "#".
+        """
+        conn.channels.discard(channel)
+        members = self.channels.get(channel)
+        if members is None:
+            return
+        members.pop(conn, None)
+        if not members:
+            del self.channels[channel]
+
+    def send_bounded(self, conn: Connection, data: bytes, origin: Connection | None = None) -> None:
+        """
+        Queue a message that may be dropped, subject to the queue limits and policy.
+        :param conn: The destination connection.
+        :param data: The message.
+        :param origin: The connection to pause under the backpressure policy.
+        """
+        if conn.closed:
+            return
+        counters = self.counters
+        counters["deliveries"] += 1
+        queue = conn.queue
+        if self._fits(queue, len(data)):
+            self.send(conn, data, droppable=True)
+            return
+        policy = self.queue_policy
+        if policy == POLICY_BACKPRESSURE and origin is not None and origin is not conn:
+            self.send(conn, data, droppable=True)
+            if not origin.paused:
+                self._pause(origin)
+            conn.waiters[origin] = None
+            return
+        if policy == POLICY_DISCONNECT:
+            counters["slow_disconnects"] += 1
+            logger.warning("Disconnecting slow consumer %s with %d bytes queued", conn.address, len(queue))
+            self.close_connection(conn)
+            return
+        while not self._fits(queue, len(data)):
+            dropped = queue.drop_oldest()
+            if not dropped:
+                # Only replies are queued; drop the new message instead
+                counters["dropped_messages"] += 1
+                counters["dropped_bytes"] += len(data)
+                return
+            counters["dropped_messages"] += 1
+            counters["dropped_bytes"] += dropped
+        self.send(conn, data, droppable=True)
+
+    def _fits(self, queue: SendQueue, size: int) -> bool:
+        return len(queue) + size <= self.max_queue_bytes and queue.frames < self.max_queue_messages
+
+    def send(self, conn: Connection, data: bytes, droppable: bool = False) -> None:
+        """
+        Queue data for a connection; it is written at the end of the current loop iteration.
+        Whatever the kernel does not accept stays in the send queue and is flushed once the
+        socket becomes writable, so a slow reader never blocks the event loop.
+        :param conn: The destination connection.
+        :param data: The bytes to send.
+        :param droppable: Whether the data is a message the queue policy may drop; see
+                          send_bounded.
+        """
+        if conn.closed:
+            return
+        if not conn.queue and not conn.events & selectors.EVENT_WRITE:
+            self.dirty[conn] = None
+        conn.queue.push(data, droppable)
+        if len(conn.queue) > self.counters["queue_high_water_bytes"]:
+            self.counters["queue_high_water_bytes"] = len(conn.queue)
+
+    def flush_pending(self) -> None:
+        """
+        Write out every buffer that received data during the current loop iteration.
+        """
+        while self.dirty:
+            dirty, self.dirty = self.dirty, {}
+            for conn in dirty:
+                if not conn.closed:
+                    self._flush(conn)
+
+    def _flush(self, conn: Connection) -> None:
+        try:
+            conn.queue.flush(conn.sock)
+        except OSError:
+            self.close_connection(conn)
+            return
+        if (conn.waiters or conn.replaying) and len(conn.queue) <= self.max_queue_bytes // 2 \
+                and conn.queue.frames <= self.max_queue_messages // 2:
+            if conn.replaying:
+                self._replay(conn)
+            if conn.waiters:
+                self._resume_waiters(conn)
+        if conn.backlogged and conn.queue.kept <= self.max_queue_messages // 2 \
+                and conn.queue.kept_bytes <= self.max_queue_bytes // 2:
+            conn.backlogged = False
+            conn.paused = False
+            self._update_events(conn)
+            self._process(conn)
+        self._update_events(conn)
+
+    def _pause(self, conn: Connection) -> None:
+        """
+        Stop reading from a connection until the queue it filled has drained.
+        """
+        conn.paused = True
+        self.counters["backpressure_pauses"] += 1
+        self._update_events(conn)
+
+    def _resume_waiters(self, conn: Connection) -> None:
+        """
+        Resume the connections paused on a queue that has drained or gone away, and handle the
+        lines they sent in the meantime.
+        """
+        waiters = conn.waiters
+        conn.waiters = {}
+        for waiter in waiters:
+            if waiter.closed or not waiter.paused or waiter.backlogged:
+                continue
+            waiter.paused = False
+            self._update_events(waiter)
+            self._process(waiter)
+
+    def _update_events(self, conn: Connection) -> None:
+        """
+        Watch a connection for input unless it is paused, and for writability while it has
+        output queued.
+        """
+        if conn.closed:
+            return
+        events = 0 if conn.paused else selectors.EVENT_READ
+        if conn.queue:
+            events |= selectors.EVENT_WRITE
+        if conn.events == events:
+            return
+        if not events:
+            self.selector.unregister(conn.sock)
+        elif not conn.events:
+            self.selector.register(conn.sock, events, conn)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def close_connection(self, conn: Connection) -> None:
+        """
+        Unregister and close a client socket, logging the user out if needed.
+        Pending output is flushed best-effort so final replies like IN-USE still reach the client.
+        :param conn: The connection to close.
+        """
+        if conn.closed:
+            return
+        conn.closed = True
+        self.connections.pop(conn.sock, None)
+        if conn.queue:
+            try:
+                conn.queue.flush(conn.sock)
+            except OSError:
+                pass
+            conn.queue.clear()
+        for channel in list(conn.channels):
+            self.leave_channel(conn, channel)
+        if conn.username is not None:
+            self.logout(conn)
+        if conn.events:
+            self.selector.unregister(conn.sock)
+        conn.sock.close()
+        if conn.waiters:
+            self._resume_waiters(conn)
+        logger.debug("Connection closed by %s", conn.address)
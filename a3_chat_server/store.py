@@ -0,0 +1,435 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+INDEX_MAGIC = b"A3IX"
+INDEX_VERSION = 1
+# Magic and version
+INDEX_HEADER = struct.Struct("<4sI")
+# User number, segment number, position in the segment, length and CRC32 of the record, state
+ENTRY = struct.Struct("<IIIIIB3x")
+STATE_OFFSET = 20
+PENDING = 0
+DELIVERED = 1
+# Entries the index file grows by at a time
+INDEX_GROWTH = 1 << 16
+SEGMENT_BYTES = 64 << 20
+# Compact the index at startup once at least this many entries were delivered, and at least
+# as many as are still pending
+COMPACT_MIN_DELIVERED = 1024
+
+
+class MessageStore:
+    """
+    Durable store of messages for users who are offline, and of the usernames ever seen.
+
+    Messages are appended as complete DELIVERY lines to a log of numbered segment files, which
+    roll over at `segment_bytes`. The log itself is never read back sequentially: an index of
+    fixed-size entries, one per message, records whom each message is for, where its record
+    lies and whether it has been delivered. The index is memory-mapped, so marking a message
+    delivered is a single byte write, and recovery only reads the index and the users file;
+    the time it takes grows with the number of messages indexed, not with their size. At
+    startup the index is compacted once most of it is delivered, and segments holding no
+    pending message are deleted.
+
+    The event loop never waits for the disk on writes: append() and register() hand their data
+    to a writer thread. While that thread is in fsync() new messages pile up, and the next
+    round writes and syncs all of them together (group commit), so the number of fsyncs does
+    not grow with the message rate. Each round syncs the users file and the log before the
+    index entries pointing into them are written, so the index never refers to data that was
+    lost. Messages are acknowledged to their sender before they are synced; a crash can lose
+    the last round. Until written, a message is kept in memory so it can be replayed meanwhile.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = SEGMENT_BYTES) -> None:
+        """
+        :param directory: The directory holding the store; created if missing.
+        :param segment_bytes: The size at which the log rolls over to a new segment.
+        """
+        self.directory: str = directory
+        self.segment_bytes: int = segment_bytes
+        self.usernames: list[bytes] = []
+        self.user_numbers: dict[bytes, int] = {}
+        # Pending messages per user number: (entry, segment, position, length, crc)
+        self.pending: dict[int, deque[tuple[int, int, int, int, int]]] = {}
+        self.pending_count: int = 0
+        # Where the next record goes, and the number of the next index entry
+        self.segment: int = 0
+        self.position: int = 0
+        self.entries: int = 0
+        self.counters: dict[str, int] = {
+            "stored": 0, "replayed": 0, "commits": 0, "committed_messages": 0, "bytes_written": 0,
+            "recovered": 0, "corrupt": 0,
+        }
+        self.error: Exception | None = None
+        # Shared with the writer thread, guarded by `lock`
+        self.lock: threading.Lock = threading.Lock()
+        self.wakeup: threading.Condition = threading.Condition(self.lock)
+        self.queued_users: list[bytes] = []
+        # User, segment, position, length, CRC32, entry and the record itself
+        self.queued_records: list[tuple[int, int, int, int, int, int, bytes]] = []
+        self.flags_dirty: bool = False
+        self.closing: bool = False
+        # Entries below this have been written to the index, and entries at or above it marked
+        # delivered before that
+        self.indexed: int = 0
+        self.delivered_early: set[int] = set()
+        # Records not written to their segment yet, by entry
+        self.unwritten: dict[int, bytes] = {}
+        self.index_file = None
+        self.index: mmap.mmap | None = None
+        self.readers: dict[int, int] = {}
+        self.thread: threading.Thread | None = None
+
+    def open(self) -> None:
+        """
+        Recover the store from its directory and start the writer thread.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_users()
+        self._recover()
+        self.thread = threading.Thread(target=self._write_loop, name="message-store", daemon=True)
+        self.thread.start()
+        logger.info("Message store at %s: %d users, %d pending messages", self.directory,
+                    len(self.usernames), self.pending_count)
+
+    def close(self) -> None:
+        """
+        Write out everything queued, stop the writer thread and close the files.
+        """
+        if self.thread is not None:
+            with self.wakeup:
+                self.closing = True
+                self.wakeup.notify()
+            self.thread.join()
+            self.thread = None
+        for fd in self.readers.values():
+            os.close(fd)
+        self.readers.clear()
+        if self.index is not None:
+            self.index.flush()
+            self.index.close()
+            self.index = None
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+    def knows(self, username: bytes) -> bool:
+        """
+        :return: Whether the user has ever logged in, so that messages for them are kept.
+        """
+        return username in self.user_numbers
+
+    def register(self, username: bytes) -> None:
+        """
+        Remember a user who logged in, if not known yet.
+        """
+        if username in self.user_numbers:
+            return
+        self.usernames.append(username)
+        self.user_numbers[username] = len(self.usernames)
+        with self.wakeup:
+            self.queued_users.append(username)
+            self.wakeup.notify()
+
+    def append(self, recipient: bytes, frame: bytes) -> bool:
+        """
+        Store a message for a known user until it can be replayed.
+        :param recipient: The receiving username.
+        :param frame: The complete DELIVERY line.
+        :return: False if the user is unknown or the store failed.
+        """
+        user = self.user_numbers.get(recipient)
+        if user is None or self.error is not None:
+            return False
+        if self.position and self.position + len(frame) > self.segment_bytes:
+            self.segment += 1
+            self.position = 0
+        entry = self.entries
+        self.entries += 1
+        location = (entry, self.segment, self.position, len(frame), zlib.crc32(frame))
+        self.position += len(frame)
+        self.unwritten[entry] = frame
+        queue = self.pending.get(user)
+        if queue is None:
+            queue = self.pending[user] = deque()
+        queue.append(location)
+        self.pending_count += 1
+        self.counters["stored"] += 1
+        with self.wakeup:
+            self.queued_records.append((user, *location[1:], entry, frame))
+            # The writer only sleeps while it has nothing to do
+            if len(self.queued_records) == 1:
+                self.wakeup.notify()
+        return True
+
+    def has_pending(self, username: bytes) -> bool:
+        """
+        :return: Whether messages are waiting for the user.
+        """
+        return self.user_numbers.get(username) in self.pending
+
+    def take(self, username: bytes, max_bytes: int, max_messages: int) -> list[bytes]:
+        """
+        Remove the oldest pending messages of a user and mark them delivered.
+        :param username: The user to replay messages to.
+        :param max_bytes: Stop before exceeding this many bytes, though one message is
+                          always returned.
+        :param max_messages: The most messages to return.
+        :return: The DELIVERY lines, oldest first.
+        """
+        user = self.user_numbers.get(username)
+        queue = self.pending.get(user)
+        if queue is None:
+            return []
+        frames: list[bytes] = []
+        taken: list[int] = []
+        size = 0
+        while queue and len(frames) < max_messages:
+            entry, segment, position, length, crc = queue[0]
+            if frames and size + length > max_bytes:
+                break
+            queue.popleft()
+            taken.append(entry)
+            frame = self._read(entry, segment, position, length)
+            if zlib.crc32(frame) != crc:
+                self.counters["corrupt"] += 1
+                logger.warning("Dropping corrupt message %d for %s", entry, username.decode(errors="replace"))
+                continue
+            frames.append(frame)
+            size += length
+        if not queue:
+            del self.pending[user]
+        self.pending_count -= len(taken)
+        self.counters["replayed"] += len(frames)
+        self._mark_delivered(taken)
+        return frames
+
+    def stats(self) -> dict[str, int]:
+        """
+        :return: The store counters, the pending messages and the average messages per fsync.
+        """
+        commits = self.counters["commits"]
+        return {
+            **self.counters,
+            "users": len(self.usernames),
+            "pending": self.pending_count,
+            "messages_per_commit": self.counters["committed_messages"] / commits if commits else 0,
+        }
+
+    def _read(self, entry: int, segment: int, position: int, length: int) -> bytes:
+        frame = self.unwritten.get(entry)
+        if frame is not None:
+            return frame
+        fd = self.readers.get(segment)
+        if fd is None:
+            fd = self.readers[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        return os.pread(fd, length, position)
+
+    def _mark_delivered(self, entries: list[int]) -> None:
+        if not entries:
+            return
+        with self.wakeup:
+            index = self.index
+            for entry in entries:
+                if entry < self.indexed:
+                    index[INDEX_HEADER.size + entry * ENTRY.size + STATE_OFFSET] = DELIVERED
+                else:
+                    self.delivered_early.add(entry)
+            self.flags_dirty = True
+            self.wakeup.notify()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:08d}.log")
+
+    def _segments(self) -> list[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith(".log") and name[:-4].isdigit())
+
+    def _load_users(self) -> None:
+        path = os.path.join(self.directory, "users")
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            data = b""
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            # A name cut short by a crash; its messages were never indexed
+            with open(path, "r+b") as file:
+                file.truncate(complete)
+        self.usernames = data[:complete].split(b"\n")[:-1]
+        self.user_numbers = {name: number for number, name in enumerate(self.usernames, 1)}
+
+    def _recover(self) -> None:
+        """
+        Rebuild the pending messages from the index, compact it if worthwhile and cut off log
+        data that was written but never indexed.
+        """
+        path = os.path.join(self.directory, "index")
+        entries: list[tuple[int, int, int, int, int, int]] = []
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+            try:
+                if data[:INDEX_HEADER.size] != INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION):
+                    raise ValueError(f"{path} is not a message index")
+                # Entries are written in order, and the file is zero beyond the last one
+                end = INDEX_HEADER.size + (len(data) - INDEX_HEADER.size) // ENTRY.size * ENTRY.size
+                for entry in ENTRY.iter_unpack(data[INDEX_HEADER.size:end]):
+                    if not entry[0]:
+                        break
+                    entries.append(entry)
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+        # The log ends after the last indexed record, or is empty if nothing was indexed
+        segments = self._segments()
+        if entries:
+            _, self.segment, position, length, _, _ = max(entries, key=lambda entry: (entry[1], entry[2]))
+            self.position = position + length
+        else:
+            self.segment = segments[-1] if segments else 0
+            self.position = 0
+        pending = [entry for entry in entries if entry[5] == PENDING and entry[0] <= len(self.usernames)]
+        if len(entries) - len(pending) >= max(COMPACT_MIN_DELIVERED, len(pending)) or not entries:
+            self._write_index(path, pending)
+            entries = pending
+        for number, (user, segment, position, length, crc, state) in enumerate(entries):
+            if state == PENDING and user <= len(self.usernames):
+                queue = self.pending.get(user)
+                if queue is None:
+                    queue = self.pending[user] = deque()
+                queue.append((number, segment, position, length, crc))
+                self.pending_count += 1
+        self.entries = self.indexed = len(entries)
+        self.counters["recovered"] = self.pending_count
+        first_needed = min((queue[0][1] for queue in self.pending.values()), default=self.segment)
+        for segment in segments:
+            if segment < first_needed or segment > self.segment:
+                os.remove(self._segment_path(segment))
+        with open(self._segment_path(self.segment), "ab") as file:
+            file.truncate(self.position)
+        self.index_file = open(path, "r+b")
+        self._map_index(self.entries + INDEX_GROWTH)
+
+    def _write_index(self, path: str, entries: list[tuple[int, int, int, int, int, int]]) -> None:
+        """
+        Replace the index atomically with one holding only the given entries.
+        """
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION))
+            file.write(b"".join(ENTRY.pack(*entry) for entry in entries))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+        self._sync_directory()
+
+    def _sync_directory(self) -> None:
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:  # Directories cannot be opened on Windows
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _map_index(self, capacity: int) -> None:
+        """
+        Grow the index file to hold `capacity` entries and map it. Called with the lock held.
+        """
+        if self.index is not None:
+            self.index.flush()
+            self.index.close()
+        size = INDEX_HEADER.size + capacity * ENTRY.size
+        if os.path.getsize(self.index_file.name) < size:
+            self.index_file.truncate(size)
+        self.index = mmap.mmap(self.index_file.fileno(), size)
+
+    def _write_loop(self) -> None:
+        users_file = open(os.path.join(self.directory, "users"), "ab")
+        segment = self.segment
+        log_fd = os.open(self._segment_path(segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            while True:
+                with self.wakeup:
+                    while not (self.queued_users or self.queued_records or self.flags_dirty or self.closing):
+                        self.wakeup.wait()
+                    users, self.queued_users = self.queued_users, []
+                    records, self.queued_records = self.queued_records, []
+                    self.flags_dirty = False
+                    closing = self.closing
+                if users:
+                    users_file.write(b"".join(name + b"\n" for name in users))
+                    users_file.flush()
+                    os.fsync(users_file.fileno())
+                if records:
+                    segment, log_fd = self._write_records(records, segment, log_fd)
+                with self.wakeup:
+                    if records:
+                        self._index_records(records)
+                    index = self.index
+                    index.flush()
+                for record in records:
+                    del self.unwritten[record[5]]
+                if records:
+                    self.counters["commits"] += 1
+                    self.counters["committed_messages"] += len(records)
+                if closing:
+                    return
+        except Exception as e:
+            logger.exception("Message store failed, no further messages are stored")
+            self.error = e
+        finally:
+            users_file.close()
+            os.close(log_fd)
+
+    def _write_records(self, records: list[tuple[int, int, int, int, int, int, bytes]], segment: int,
+                       log_fd: int) -> tuple[int, int]:
+        """
+        Write a round of records to their segments and sync them.
+        :return: The segment written last and its file descriptor.
+        """
+        start = 0
+        while start < len(records):
+            end = start
+            while end < len(records) and records[end][1] == records[start][1]:
+                end += 1
+            if records[start][1] != segment:
+                # The previous segment is complete; it was synced with the round that filled it
+                os.close(log_fd)
+                segment = records[start][1]
+                log_fd = os.open(self._segment_path(segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                self._sync_directory()
+            data = b"".join(record[6] for record in records[start:end])
+            view = memoryview(data)
+            while view:
+                view = view[os.write(log_fd, view):]
+            os.fsync(log_fd)
+            self.counters["bytes_written"] += len(data)
+            start = end
+        return segment, log_fd
+
+    def _index_records(self, records: list[tuple[int, int, int, int, int, int, bytes]]) -> None:
+        """
+        Write the index entries of a round of synced records. Called with the lock held.
+        """
+        last = records[-1][5]
+        if INDEX_HEADER.size + (last + 1) * ENTRY.size > len(self.index):
+            self._map_index(last + 1 + INDEX_GROWTH)
+        index = self.index
+        early = self.delivered_early
+        for user, segment, position, length, crc, entry, _ in records:
+            state = DELIVERED if entry in early else PENDING
+            early.discard(entry)
+            ENTRY.pack_into(index, INDEX_HEADER.size + entry * ENTRY.size, user, segment, position, length, crc,
+                            state)
+        self.indexed = last + 1
@@ -1,13 +1,30 @@
+import logging
+import signal
 from argparse import Namespace, ArgumentParser
 
+from a5_http_server.server import HTTPServer
+from a5_http_server.workers import serve_workers
+from lab_common.metrics import Exporter, Metrics, parse_address
+
 
 def parse_arguments() -> Namespace:
     """
     Parse command line arguments for the http server.
-    The three valid options are:
+    The valid options are:
         --address: The host to listen at. Default is "0.0.0.0"
         --port: The port to listen at. Default is 8000
         --directory: The directory to serve. Default is "data"
+        --cache-size: The file cache size in MiB. Default is 32
+        --cache-check-interval: Seconds before a cached file is checked for changes. Default is 1
+        --keep-alive-timeout: Seconds an idle persistent connection is kept open. Default is 5
+        --max-requests: Requests served per connection before it is closed. Default is 100
+        --workers: The number of pre-forked worker processes. Default is 1 (no supervisor)
+        --grace: Seconds in-flight responses may take to finish on shutdown or reload. Default is 10
+        --metrics: Serve Prometheus metrics at [host]:port or a Unix socket path; workers after
+                   the first at the next ports or at the path suffixed with their slot number.
+                   Default is none
+        --profile: Sample the stacks of the event loop and write them, folded for flame graphs,
+                   to this file on exit. Default is none
     :return: The parsed arguments in a Namespace object.
     """
 
@@ -22,6 +39,22 @@ def parse_arguments() -> Namespace:
                         type=int, help="Set server port", default=8000)
     parser.add_argument("-d", "--directory",
                         type=str, help="Set the directory to serve", default="a5_http_server/public")
+    parser.add_argument("--cache-size",
+                        type=int, help="Set the file cache size in MiB", default=32)
+    parser.add_argument("--cache-check-interval",
+                        type=float, help="Set the seconds before cached files are re-checked", default=1.0)
+    parser.add_argument("--keep-alive-timeout",
+                        type=float, help="Set the seconds idle connections are kept open", default=5.0)
+    parser.add_argument("--max-requests",
+                        type=int, help="Set the requests served per connection, 1 disables keep-alive", default=100)
+    parser.add_argument("-w", "--workers",
+                        type=int, help="Set the number of worker processes", default=1)
+    parser.add_argument("--grace",
+                        type=float, help="Set the seconds to finish in-flight responses when stopping", default=10.0)
+    parser.add_argument("--metrics",
+                        type=parse_address, help="Set the address serving Prometheus metrics")
+    parser.add_argument("--profile",
+                        type=str, help="Set the file the sampled stacks are written to")
 
     return parser.parse_args()
 
@@ -32,7 +65,30 @@ def main() -> None:
     host: str = parser.address
     base_directory: str = parser.directory
 
-    # Your implementation here
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s - %(levelname)s] %(message)s")
+
+    options = {
+        "cache_size": parser.cache_size * 1024 * 1024,
+        "cache_check_interval": parser.cache_check_interval,
+        "idle_timeout": parser.keep_alive_timeout,
+        "max_requests": parser.max_requests,
+        "grace": parser.grace,
+    }
+    if parser.workers > 1:
+        serve_workers(host, port, base_directory, parser.workers, parser.metrics, parser.profile, **options)
+        return
+
+    metrics = Metrics("http") if parser.metrics else None
+    server = HTTPServer(host, port, base_directory, metrics=metrics, **options)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    exporter = Exporter(metrics, parser.metrics, parser.profile)
+    exporter.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        exporter.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+import os
+import stat
+import time
+from collections import OrderedDict
+
+from a5_http_server.compression import MIN_COMPRESS_SIZE, compress, is_compressible
+from a5_http_server.protocol import http_date
+from a5_http_server.static import StaticFiles, content_type
+
+# Approximate bookkeeping cost of an entry, so that metadata-only entries count too
+ENTRY_OVERHEAD = 512
+# Largest body of a type that is never compressed, such as an image, kept in memory. Such a
+# body gains nothing from the cache but the open() call, and larger ones are sent more cheaply
+# by sendfile() than by copying them out of Python
+MAX_INCOMPRESSIBLE_ENTRY_SIZE = 16 * 1024
+
+
+class Representation:
+    """
+    One encoding of a file: its entity tag, the pre-encoded header lines shared by all full
+    responses with it and either the body itself or the path to stream it from.
+    """
+
+    __slots__ = ("encoding", "path", "size", "etag", "headers", "body")
+
+    def __init__(self, encoding: str, path: str, size: int, etag: str, body: bytes | None,
+                 entry: "CacheEntry") -> None:
+        self.encoding: str = encoding
+        self.path: str = path
+        self.size: int = size
+        self.etag: str = etag
+        self.body: bytes | None = body
+        lines = [f"Content-Type: {entry.content_type}"]
+        if encoding != "identity":
+            lines.append(f"Content-Encoding: {encoding}")
+        lines.append(f"ETag: {etag}")
+        lines.append(f"Last-Modified: {entry.last_modified}")
+        if encoding == "identity":
+            lines.append("Accept-Ranges: bytes")
+        if entry.compressible:
+            lines.append("Vary: Accept-Encoding")
+        self.headers: bytes = "".join(line + "\r\n" for line in lines).encode("iso-8859-1")
+
+    @property
+    def weight(self) -> int:
+        return len(self.headers) + (len(self.body) if self.body is not None else 0)
+
+
+def stat_key(info: os.stat_result | None) -> tuple[int, int, int] | None:
+    """
+    :param info: A stat result, or None for a missing file.
+    :return: The fields that change whenever the file is replaced or modified.
+    """
+    return None if info is None else (info.st_ino, info.st_size, info.st_mtime_ns)
+
+
+class CacheEntry:
+    """
+    Everything needed to answer a request for one file without touching the disk: its
+    validators and its representations. The identity representation always exists; compressed
+    ones are added from a pre-compressed ".gz" sibling or on first use.
+    """
+
+    __slots__ = ("key", "path", "size", "file_key", "sibling_key", "mtime", "last_modified",
+                 "content_type", "compressible", "representations", "checked", "weight")
+
+    def __init__(self, key: str, path: str, info: os.stat_result, body: bytes | None, now: float) -> None:
+        self.key: str = key
+        self.path: str = path
+        self.size: int = info.st_size
+        self.file_key: tuple[int, int, int] = stat_key(info)
+        self.sibling_key: tuple[int, int, int] | None = None
+        self.mtime: int = info.st_mtime_ns // 1_000_000_000
+        self.last_modified: str = http_date(self.mtime)
+        self.content_type: str = content_type(path)
+        self.compressible: bool = is_compressible(self.content_type)
+        etag = f'"{info.st_ino:x}-{info.st_size:x}-{info.st_mtime_ns:x}"'
+        identity = Representation("identity", path, info.st_size, etag, body, self)
+        # A None value records that an encoding is not worth serving for this file
+        self.representations: dict[str, Representation | None] = {"identity": identity}
+        self.checked: float = now
+        self.weight: int = ENTRY_OVERHEAD + identity.weight
+
+    @property
+    def identity(self) -> Representation:
+        return self.representations["identity"]
+
+    def add(self, representation: Representation | None, encoding: str) -> int:
+        """
+        :return: The weight added to the entry.
+        """
+        self.representations[encoding] = representation
+        added = representation.weight if representation is not None else 0
+        self.weight += added
+        return added
+
+
+class FileCache:
+    """
+    Bounded LRU cache of static files keyed by request path.
+
+    An entry is trusted for `check_interval` seconds; after that the next lookup re-stats the
+    file (and its ".gz" sibling) and drops the entry if its mtime, size or inode changed, the
+    same polling an inotify watcher would replace. Within the interval a hit, including a
+    conditional request answered with 304, performs no system call at all. Bodies larger than
+    `max_entry_size`, or than `max_incompressible_entry_size` for types that are never
+    compressed, are not kept in memory; their entries only hold metadata and the body is
+    streamed with sendfile(). Such files are only served compressed from a sibling.
+    """
+
+    def __init__(self, files: StaticFiles, max_bytes: int = 32 * 1024 * 1024,
+                 max_entry_size: int = 1024 * 1024, check_interval: float = 1.0,
+                 max_incompressible_entry_size: int = MAX_INCOMPRESSIBLE_ENTRY_SIZE) -> None:
+        self.files: StaticFiles = files
+        self.max_bytes: int = max_bytes
+        self.max_entry_size: int = max_entry_size
+        self.max_incompressible_entry_size: int = min(max_incompressible_entry_size, max_entry_size)
+        self.check_interval: float = check_interval
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.invalidations: int = 0
+        self.evictions: int = 0
+        self.compressions: int = 0
+
+    def lookup(self, request_path: str) -> CacheEntry | None:
+        """
+        :param request_path: The URL path of the request, still percent-encoded.
+        :return: The entry for the file, or None if no file exists at that path.
+        """
+        now = time.monotonic()
+        entry = self.entries.get(request_path)
+        if entry is not None:
+            if now - entry.checked >= self.check_interval:
+                if self._unchanged(entry):
+                    entry.checked = now
+                else:
+                    self.invalidations += 1
+                    self._remove(request_path)
+                    entry = None
+            if entry is not None:
+                self.entries.move_to_end(request_path)
+                self.hits += 1
+                return entry
+
+        self.misses += 1
+        path = self.files.resolve(request_path)
+        if path is None:
+            return None
+        entry = self._load(request_path, path, now)
+        if entry is not None and entry.weight <= self.max_bytes:
+            self.entries[request_path] = entry
+            self.size += entry.weight
+            self._evict()
+        return entry
+
+    def representation(self, entry: CacheEntry, encoding: str) -> Representation | None:
+        """
+        Get a compressed representation of a file, compressing and caching it on first use.
+        :param entry: The file, as returned by lookup().
+        :param encoding: A content coding from compression.ENCODINGS.
+        :return: The representation, or None if the file is served without that coding.
+        """
+        if encoding in entry.representations:
+            return entry.representations[encoding]
+        identity = entry.identity
+        representation = None
+        if entry.compressible and identity.body is not None and identity.size >= MIN_COMPRESS_SIZE:
+            body = compress(identity.body, encoding)
+            self.compressions += 1
+            if len(body) < identity.size:
+                etag = f'{identity.etag[:-1]}-{encoding}"'
+                representation = Representation(encoding, entry.path, len(body), etag, body, entry)
+        added = entry.add(representation, encoding)
+        if self.entries.get(entry.key) is entry:
+            self.size += added
+            self._evict()
+        return representation
+
+    def _unchanged(self, entry: CacheEntry) -> bool:
+        try:
+            info = os.stat(entry.path)
+        except OSError:
+            return False
+        return stat_key(info) == entry.file_key and (
+            not entry.compressible or stat_key(self._sibling(entry.path, info)) == entry.sibling_key)
+
+    @staticmethod
+    def _sibling(path: str, info: os.stat_result) -> os.stat_result | None:
+        """
+        :return: The stat of a pre-compressed "<path>.gz" that is a regular file at least as
+            new as the file itself, or None.
+        """
+        try:
+            sibling = os.stat(path + ".gz")
+        except OSError:
+            return None
+        if not stat.S_ISREG(sibling.st_mode) or sibling.st_mtime_ns < info.st_mtime_ns:
+            return None
+        return sibling
+
+    def _load(self, request_path: str, path: str, now: float) -> CacheEntry | None:
+        limit = self.max_entry_size if is_compressible(content_type(path)) else self.max_incompressible_entry_size
+        try:
+            with open(path, "rb") as file:
+                info = os.fstat(file.fileno())
+                body = file.read() if info.st_size <= limit else None
+        except OSError:
+            return None
+        if body is not None and len(body) != info.st_size:
+            # Modified while reading: stream it instead and let the next lookup re-stat
+            body = None
+            now -= self.check_interval
+        entry = CacheEntry(request_path, path, info, body, now)
+        if entry.compressible:
+            self._load_sibling(entry, info)
+        return entry
+
+    def _load_sibling(self, entry: CacheEntry, info: os.stat_result) -> None:
+        sibling = self._sibling(entry.path, info)
+        if sibling is None:
+            return
+        path = entry.path + ".gz"
+        body = None
+        if sibling.st_size <= self.max_entry_size:
+            try:
+                with open(path, "rb") as file:
+                    body = file.read()
+            except OSError:
+                return
+            if len(body) != sibling.st_size:
+                return
+        entry.sibling_key = stat_key(sibling)
+        etag = f'"{sibling.st_ino:x}-{sibling.st_size:x}-{sibling.st_mtime_ns:x}"'
+        entry.add(Representation("gzip", path, sibling.st_size, etag, body, entry), "gzip")
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.weight
+            self.evictions += 1
+
+    def _remove(self, request_path: str) -> None:
+        entry = self.entries.pop(request_path)
+        self.size -= entry.weight
+
+    def stats(self) -> dict[str, int | float]:
+        """
+        :return: Entry and byte counts, hit/miss counters and the hit ratio.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "compressions": self.compressions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
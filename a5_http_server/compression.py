@@ -0,0 +1,46 @@
+import zlib
+
+# Content codings the server can produce on the fly, in order of preference
+ENCODINGS: tuple[str, ...] = ("gzip", "deflate")
+# Smaller bodies gain nothing once the coding's own header and trailer are added
+MIN_COMPRESS_SIZE = 256
+# Bodies are compressed once and cached, so the slowest, smallest level is affordable
+COMPRESS_LEVEL = 9
+
+COMPRESSIBLE_TYPES: tuple[str, ...] = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+    "image/x-icon",
+)
+
+
+def is_compressible(content_type: str) -> bool:
+    """
+    Decide whether a media type is worth compressing. Formats that already are compressed,
+    like JPEG, PNG or gzip files, are not: they would cost CPU and barely shrink.
+    :param content_type: The Content-Type the file is served with.
+    :return: Whether the body should be compressed.
+    """
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Encode a body with an HTTP content coding. "deflate" means the zlib format (RFC 1950), not
+    a raw deflate stream. The gzip header carries no timestamp, so the output only depends on
+    the input.
+    :param body: The identity body.
+    :param encoding: "gzip" or "deflate".
+    :return: The encoded body.
+    :raises ValueError: If the coding is not supported.
+    """
+    if encoding == "gzip":
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS)
+    else:
+        raise ValueError(f"Unsupported content coding: {encoding}")
+    return compressor.compress(body) + compressor.flush()
@@ -0,0 +1,167 @@
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from functools import lru_cache
+
+REASONS: dict[int, str] = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    505: "HTTP Version Not Supported",
+}
+
+MAX_HEADER_SIZE = 16384
+
+
+class BadRequest(ValueError):
+    """
+    Raised when a request cannot be parsed; carries the status code to answer with.
+    """
+
+    def __init__(self, message: str, status: int = 400) -> None:
+        super().__init__(message)
+        self.status: int = status
+
+
+class Request:
+    """
+    A parsed request head. Header names are lower-cased; repeated headers are joined by ", ".
+    """
+
+    __slots__ = ("method", "target", "path", "query", "version", "headers")
+
+    def __init__(self, method: str, target: str, version: str, headers: dict[str, str]) -> None:
+        self.method: str = method
+        self.target: str = target
+        self.path, _, self.query = target.partition("?")
+        self.version: str = version
+        self.headers: dict[str, str] = headers
+
+
+def parse_head(head: bytes) -> Request:
+    """
+    Parse a request line and header block (without the terminating empty line).
+    :param head: The raw head bytes.
+    :return: The parsed request.
+    :raises BadRequest: If the head is malformed or uses an unsupported HTTP version.
+    """
+    try:
+        text = head.decode("iso-8859-1")
+    except UnicodeDecodeError as e:  # Cannot happen for latin-1, kept for clarity
+        raise BadRequest(str(e)) from e
+    lines = text.split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3:
+        raise BadRequest(f"Malformed request line: {lines[0]!r}")
+    method, target, version = parts
+    if not version.startswith("HTTP/1."):
+        raise BadRequest(f"Unsupported version: {version}", 505)
+    if not target.startswith("/"):
+        raise BadRequest(f"Unsupported request target: {target!r}")
+
+    headers: dict[str, str] = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(":")
+        if not colon or not name or name != name.strip():
+            raise BadRequest(f"Malformed header line: {line!r}")
+        name = name.lower()
+        value = value.strip()
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    return Request(method, target, version, headers)
+
+
+def format_head(status: int, headers: list[tuple[str, str]], raw: bytes = b"") -> bytes:
+    """
+    Serialise a status line and headers, including the empty line that ends the head.
+    :param status: The status code.
+    :param headers: The header name/value pairs in order.
+    :param raw: Pre-encoded header lines, each ending in CRLF, appended after `headers`.
+    :return: The encoded response head.
+    """
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}"]
+    lines.extend(f"{name}: {value}" for name, value in headers)
+    lines.append("")
+    return "\r\n".join(lines).encode("iso-8859-1") + raw + b"\r\n"
+
+
+_date_cache: tuple[int, str] = (0, "")
+
+
+def http_date(timestamp: float | None = None) -> str:
+    """
+    Format a timestamp as an IMF-fixdate. The current date is cached per second since every
+    response carries one.
+    :param timestamp: Seconds since the epoch, or None for now.
+    :return: The formatted date.
+    """
+    global _date_cache
+    if timestamp is not None:
+        return formatdate(timestamp, usegmt=True)
+    now = int(time.time())
+    if _date_cache[0] != now:
+        _date_cache = (now, formatdate(now, usegmt=True))
+    return _date_cache[1]
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """
+    Evaluate an If-None-Match header with the weak comparison RFC 9110 prescribes for it.
+    :param header: The header value, a list of entity tags or "*".
+    :param etag: The current entity tag of the resource.
+    :return: Whether any listed tag matches.
+    """
+    if header.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+@lru_cache(maxsize=256)
+def accepted_encodings(header: str) -> tuple[str, ...]:
+    """
+    Interpret an Accept-Encoding header. Clients send the same few values over and over, so
+    results are memoised per header value.
+    :param header: The header value, e.g. "gzip, deflate;q=0.5".
+    :return: The content codings other than identity the client accepts, most preferred first.
+    """
+    qualities: list[tuple[float, int, str]] = []
+    for index, item in enumerate(header.split(",")):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if coding == "x-gzip":
+            coding = "gzip"
+        if not coding or coding == "identity":
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            qualities.append((-quality, index, coding))
+    return tuple(coding for _, _, coding in sorted(qualities))
+
+
+def parse_http_date(value: str) -> float | None:
+    """
+    :param value: An HTTP date header value.
+    :return: Seconds since the epoch, or None if the value is not a valid date.
+    """
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
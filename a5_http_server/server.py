@@ -0,0 +1,576 @@
+import ipaddress
+import json
+import logging
+import os
+import selectors
+import socket
+import time
+from collections import OrderedDict
+
+from a5_http_server.cache import CacheEntry, FileCache, Representation
+from a5_http_server.compression import ENCODINGS
+from a5_http_server.protocol import (MAX_HEADER_SIZE, BadRequest, Request, accepted_encodings, etag_matches,
+                                     format_head, http_date, parse_head, parse_http_date)
+from a5_http_server.static import RangeNotSatisfiable, StaticFiles, parse_range
+from lab_common.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+RECV_SIZE = 65536
+# Bytes handed to sendfile() per writable event, so one large download cannot starve the loop
+CHUNK_SIZE = 256 * 1024
+# Tell the kernel more data follows the head, so it shares a segment with the first body bytes
+MSG_MORE: int = getattr(socket, "MSG_MORE", 0)
+# Cached bodies up to this size are copied behind their head; larger ones are sent straight
+# from the cache
+INLINE_BODY_SIZE = 16 * 1024
+# Pipelined requests are only answered while less than this much response data is queued
+OUTBUF_HIGH_WATER = 1024 * 1024
+# Upper bound on how long the loop sleeps, so a stop() from a signal handler is noticed
+POLL_INTERVAL = 1.0
+
+
+class Response:
+    """
+    A response head plus either an in-memory body or a byte range of an open file.
+    `raw_headers` holds pre-encoded header lines, such as those cached per file.
+    """
+
+    __slots__ = ("status", "headers", "raw_headers", "body", "fd", "offset", "length")
+
+    def __init__(self, status: int, headers: list[tuple[str, str]], body: bytes | memoryview = b"",
+                 fd: int | None = None, offset: int = 0, length: int = 0, raw_headers: bytes = b"") -> None:
+        self.status: int = status
+        self.headers: list[tuple[str, str]] = headers
+        self.raw_headers: bytes = raw_headers
+        self.body: bytes | memoryview = body
+        self.fd: int | None = fd
+        self.offset: int = offset
+        self.length: int = length
+
+
+class Connection:
+    """
+    State for one persistent client socket: unparsed request bytes and how far they have been
+    searched for the end of a head, the pending response head/body bytes, the unsent part of a
+    large cached body and, while a file is being streamed, its descriptor, the next offset and
+    the bytes left.
+    """
+
+    __slots__ = ("sock", "address", "inbuf", "scanned", "outbuf", "body", "fd", "offset", "remaining",
+                 "requests", "keep_alive", "eof", "last_active", "events", "closed")
+
+    def __init__(self, sock: socket.socket, address, now: float) -> None:
+        self.sock: socket.socket = sock
+        self.address = address
+        self.inbuf: bytearray = bytearray()
+        self.scanned: int = 0
+        self.outbuf: bytearray = bytearray()
+        self.body: memoryview | None = None
+        self.fd: int | None = None
+        self.offset: int = 0
+        self.remaining: int = 0
+        self.requests: int = 0
+        self.keep_alive: bool = True
+        self.eof: bool = False
+        self.last_active: float = now
+        self.events: int = selectors.EVENT_READ
+        self.closed: bool = False
+
+
+class HTTPServer:
+    """
+    Single-threaded static file server on a selector.
+
+    Small, hot files are answered from a FileCache holding their pre-encoded headers and
+    bodies; conditional requests are validated against the cached ETag/Last-Modified. Text is
+    sent gzip or deflate compressed when the client accepts it, from a ".gz" sibling file or
+    compressed once on first use and cached alongside the identity body. Cached bodies larger
+    than INLINE_BODY_SIZE are sent from the cache without being copied. Larger files, and
+    images and other types that are never compressed beyond a few KiB, never pass through
+    Python: after the head has been written the file is copied to the socket by the kernel
+    with os.sendfile(), CHUNK_SIZE bytes per writable event, so many concurrent downloads are
+    interleaved fairly.
+
+    Connections are persistent as HTTP/1.1 prescribes, up to `max_requests` requests each, and
+    are closed after `idle_timeout` seconds without progress. Pipelined requests are answered
+    strictly in order: a request is only handled once the response before it has been queued
+    in full, and reading pauses while a response is blocked on a slow client.
+
+    stop() may be called from a signal handler: the server then stops accepting, closes idle
+    connections and exits once the responses in flight are sent, or after `grace` seconds.
+    Clients on the loopback interface can read the server statistics as JSON at `status_path`.
+    With `metrics`, the statistics are collected into it as well, and request parsing, handling,
+    cache lookups and writes are timed.
+    """
+
+    def __init__(self, host: str, port: int, directory: str, backlog: int = 1024,
+                 cache_size: int = 32 * 1024 * 1024, cache_check_interval: float = 1.0,
+                 idle_timeout: float = 5.0, max_requests: int = 100, grace: float = 10.0,
+                 status_path: str | None = "/_status", metrics: Metrics | None = None) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.backlog: int = backlog
+        self.idle_timeout: float = idle_timeout
+        self.max_requests: int = max_requests
+        self.grace: float = grace
+        self.status_path: str | None = status_path
+        self.files: StaticFiles = StaticFiles(directory)
+        self.cache: FileCache = FileCache(self.files, max_bytes=cache_size,
+                                          max_entry_size=min(cache_size // 8, 1024 * 1024),
+                                          check_interval=cache_check_interval)
+        self.error_pages: dict[int, bytes] = {
+            400: self.files.read_page("400.html", b"<h1>400 Bad Request</h1>"),
+            404: self.files.read_page("404.html", b"<h1>404 Not Found</h1>"),
+        }
+        self.selector: selectors.BaseSelector = selectors.DefaultSelector()
+        self.listener: socket.socket | None = None
+        # Ordered by last activity, so idle connections are found at the front
+        self.connections: OrderedDict[socket.socket, Connection] = OrderedDict()
+        self.now: float = time.monotonic()
+        self.started: float = time.time()
+        self.stopping: bool = False
+        self.drain_deadline: float | None = None
+        self.requests: int = 0
+        self.accepted: int = 0
+        self.bytes_sent: int = 0
+        if metrics is not None:
+            metrics.collect(self.stats, counters=("requests", "accepted", "bytes_sent", "hits", "misses",
+                                                  "invalidations", "evictions", "compressions"))
+            metrics.instrument(self, {"_parse_requests": "parse", "handle": "handle", "_write": "send"})
+            metrics.instrument(self.cache, {"lookup": "cache_lookup"})
+
+    def bind(self) -> None:
+        """
+        Create the non-blocking listening socket and register it with the selector.
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(self.backlog)
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ)
+        self.listener = listener
+        logger.info("Serving %s on %s:%d", self.files.root, self.host, self.port)
+
+    def serve_forever(self) -> None:
+        """
+        Run the event loop until interrupted, or until stopped and drained.
+        """
+        if self.listener is None:
+            self.bind()
+        try:
+            while self.drain_deadline is None or (self.connections and self.now < self.drain_deadline):
+                timeout = self._expire_idle()
+                events = self.selector.select(POLL_INTERVAL if timeout is None else min(timeout, POLL_INTERVAL))
+                self.now = time.monotonic()
+                if self.stopping and self.drain_deadline is None:
+                    self._drain()
+                self.on_tick()
+                for key, mask in events:
+                    conn = key.data
+                    if conn is None:
+                        self._accept()
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self._on_readable(conn)
+                    elif mask & selectors.EVENT_WRITE and not conn.closed:
+                        self._process(conn)
+        finally:
+            self.shutdown()
+
+    def shutdown(self) -> None:
+        """
+        Close every client socket and the listening socket.
+        """
+        for conn in list(self.connections.values()):
+            self.close_connection(conn)
+        if self.listener is not None:
+            self.selector.unregister(self.listener)
+            self.listener.close()
+            self.listener = None
+        self.selector.close()
+        logger.info("Cache statistics: %s", self.cache.stats())
+
+    def stop(self) -> None:
+        """
+        Request a graceful shutdown. Safe to call from a signal handler.
+        """
+        self.stopping = True
+
+    def _drain(self) -> None:
+        if self.listener is not None:
+            self.selector.unregister(self.listener)
+            self.listener.close()
+            self.listener = None
+        self.drain_deadline = self.now + self.grace
+        for conn in list(self.connections.values()):
+            if conn.events == selectors.EVENT_READ:
+                # Idle or between requests: nothing in flight to finish
+                self.close_connection(conn)
+            else:
+                conn.keep_alive = False
+        logger.info("Draining %d connections", len(self.connections))
+
+    def on_tick(self) -> None:
+        """
+        Hook called once per loop iteration, before the ready connections are handled.
+        """
+
+    def stats(self) -> dict[str, int | float]:
+        """
+        :return: Request, connection and byte counters of this process and the file cache
+            statistics.
+        """
+        return {
+            "pid": os.getpid(),
+            "started": int(self.started),
+            "requests": self.requests,
+            "accepted": self.accepted,
+            "connections": len(self.connections),
+            "bytes_sent": self.bytes_sent,
+            **self.cache.stats(),
+        }
+
+    def status(self) -> dict:
+        """
+        :return: The document served at the status path.
+        """
+        stats = self.stats()
+        return {"workers": [stats], "total": stats}
+
+    def status_response(self, conn: Connection) -> Response:
+        """
+        :param conn: The connection asking for the status.
+        :return: The statistics as JSON, or 404 for clients that are not on the loopback
+            interface.
+        """
+        try:
+            internal = ipaddress.ip_address(conn.address[0]).is_loopback
+        except (ValueError, IndexError, TypeError):
+            internal = False
+        if not internal:
+            return self.error_response(404)
+        body = json.dumps(self.status(), indent=2).encode() + b"\n"
+        return Response(200, [
+            ("Date", http_date()),
+            ("Content-Type", "application/json"),
+            ("Cache-Control", "no-store"),
+            ("Content-Length", str(len(body))),
+        ], body)
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.warning("Failed to accept connection: %s", e)
+                return
+            sock.setblocking(False)
+            self.accepted += 1
+            conn = Connection(sock, address, self.now)
+            self.connections[sock] = conn
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def _expire_idle(self) -> float | None:
+        """
+        Close connections that made no progress for `idle_timeout` seconds.
+        :return: The seconds until the next connection expires, or None if there are none.
+        """
+        now = time.monotonic()
+        while self.connections:
+            conn = next(iter(self.connections.values()))
+            idle = now - conn.last_active
+            if idle < self.idle_timeout:
+                return self.idle_timeout - idle
+            logger.debug("Closing idle connection from %s", conn.address)
+            self.close_connection(conn)
+        return None
+
+    def _touch(self, conn: Connection) -> None:
+        conn.last_active = self.now
+        self.connections.move_to_end(conn.sock)
+
+    def _on_readable(self, conn: Connection) -> None:
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close_connection(conn)
+            return
+        if data:
+            conn.inbuf += data
+        else:
+            # Answer what was pipelined before the client's FIN, then close
+            conn.eof = True
+        self._touch(conn)
+        self._process(conn)
+
+    def _process(self, conn: Connection) -> None:
+        """
+        Alternate between answering buffered requests and writing their responses until the
+        connection needs more input, is blocked on output or is done.
+        :param conn: The connection to drive.
+        """
+        while not conn.closed:
+            starved = self._parse_requests(conn)
+            if not self._write(conn):
+                if not conn.closed:
+                    self._set_events(conn, selectors.EVENT_WRITE)
+                return
+            if not conn.keep_alive or (starved and conn.eof):
+                self.close_connection(conn)
+                return
+            if starved:
+                self._set_events(conn, selectors.EVENT_READ)
+                return
+
+    def _parse_requests(self, conn: Connection) -> bool:
+        """
+        Handle complete request heads from the input buffer while responses may be queued.
+        The search for the blank line resumes where the previous one stopped, so bytes that
+        arrive in small pieces are scanned once.
+        :param conn: The connection whose input to parse.
+        :return: Whether parsing stopped because no complete request head is buffered.
+        """
+        while conn.keep_alive and conn.fd is None and conn.body is None and len(conn.outbuf) < OUTBUF_HIGH_WATER:
+            end = conn.inbuf.find(b"\r\n\r\n", conn.scanned)
+            if end == -1:
+                if len(conn.inbuf) > MAX_HEADER_SIZE:
+                    self._queue(conn, self.error_response(431), False)
+                    return False
+                # The terminator may straddle the next read
+                conn.scanned = max(0, len(conn.inbuf) - 3)
+                return True
+            head = bytes(conn.inbuf[:end])
+            del conn.inbuf[:end + 4]
+            conn.scanned = 0
+            conn.requests += 1
+            try:
+                request = parse_head(head)
+            except BadRequest as e:
+                logger.debug("Bad request from %s: %s", conn.address, e)
+                self._queue(conn, self.error_response(e.status), False)
+                return False
+            self.requests += 1
+            keep_alive = conn.requests < self.max_requests and self.wants_keep_alive(request)
+            if request.path == self.status_path and request.method == "GET":
+                response = self.status_response(conn)
+            else:
+                response = self.handle(request)
+            self._queue(conn, response, keep_alive, request.version)
+        return False
+
+    @staticmethod
+    def wants_keep_alive(request: Request) -> bool:
+        """
+        :param request: A parsed request.
+        :return: Whether the connection may be reused after answering it. Requests with a
+            body are never followed, since bodies are not read.
+        """
+        if request.headers.get("content-length", "0") != "0" or "transfer-encoding" in request.headers:
+            return False
+        tokens = {token.strip().lower() for token in request.headers.get("connection", "").split(",")}
+        if "close" in tokens:
+            return False
+        return request.version != "HTTP/1.0" or "keep-alive" in tokens
+
+    def handle(self, request: Request) -> Response:
+        """
+        Produce the response for a parsed request.
+        :param request: The request to answer.
+        :return: The response to send.
+        """
+        if request.method not in ("GET", "HEAD"):
+            response = self.error_response(405)
+            response.headers.append(("Allow", "GET, HEAD"))
+            return response
+
+        entry = self.cache.lookup(request.path)
+        if entry is None:
+            return self.error_response(404)
+        representation = self.select_representation(request, entry)
+        if self.not_modified(request, entry, representation):
+            headers = [
+                ("Date", http_date()),
+                ("ETag", representation.etag),
+                ("Last-Modified", entry.last_modified),
+            ]
+            if entry.compressible:
+                headers.append(("Vary", "Accept-Encoding"))
+            return Response(304, headers)
+        response = self.serve_file(request, representation)
+        if request.method == "HEAD":
+            if response.fd is not None:
+                os.close(response.fd)
+            response.fd, response.body, response.length = None, b"", 0
+        return response
+
+    def select_representation(self, request: Request, entry: CacheEntry) -> Representation:
+        """
+        Negotiate the content coding from Accept-Encoding. Range requests always get the
+        identity representation, since ranges of a compressed body are of little use.
+        :param request: The request carrying the Accept-Encoding header.
+        :param entry: The cached file.
+        :return: The most preferred representation that is available.
+        """
+        header = request.headers.get("accept-encoding")
+        if not header or not entry.compressible or "range" in request.headers:
+            return entry.identity
+        for coding in accepted_encodings(header):
+            for candidate in ENCODINGS if coding == "*" else (coding,):
+                if candidate in ENCODINGS:
+                    representation = self.cache.representation(entry, candidate)
+                    if representation is not None:
+                        return representation
+        return entry.identity
+
+    @staticmethod
+    def not_modified(request: Request, entry: CacheEntry, representation: Representation) -> bool:
+        """
+        Evaluate If-None-Match, or If-Modified-Since when no If-None-Match is present.
+        :param request: The request carrying the conditional headers.
+        :param entry: The cached file.
+        :param representation: The representation that would be sent.
+        :return: Whether a 304 Not Modified should be sent.
+        """
+        if "if-none-match" in request.headers:
+            return etag_matches(request.headers["if-none-match"], representation.etag)
+        if "if-modified-since" in request.headers:
+            since = parse_http_date(request.headers["if-modified-since"])
+            return since is not None and entry.mtime <= since
+        return False
+
+    def serve_file(self, request: Request, representation: Representation) -> Response:
+        """
+        Describe the (partial) body of a file: a slice of the cached body, or a range to stream
+        from a freshly opened descriptor.
+        :param request: The request, consulted for its Range header.
+        :param representation: The representation of the file to send.
+        :return: A 200, 206 or 416 response; the caller owns the descriptor in `fd`, if any.
+        """
+        size = representation.size
+        headers = [("Date", http_date())]
+        status, start, end = 200, 0, size - 1
+        if "range" in request.headers and representation.encoding == "identity":
+            try:
+                selected = parse_range(request.headers["range"], size)
+            except RangeNotSatisfiable:
+                return Response(416, headers + [("Content-Range", f"bytes */{size}"),
+                                                ("Content-Length", "0")])
+            if selected is not None:
+                status, (start, end) = 206, selected
+                headers.append(("Content-Range", f"bytes {start}-{end}/{size}"))
+        length = end - start + 1
+        headers.append(("Content-Length", str(length)))
+
+        if representation.body is not None:
+            body = representation.body if status == 200 else memoryview(representation.body)[start:end + 1]
+            return Response(status, headers, body, raw_headers=representation.headers)
+        try:
+            fd = os.open(representation.path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        except OSError:
+            return self.error_response(404)
+        return Response(status, headers, fd=fd, offset=start, length=length, raw_headers=representation.headers)
+
+    def error_response(self, status: int) -> Response:
+        """
+        :param status: The error status code.
+        :return: A response carrying the matching error page, or the 400 page for other codes.
+        """
+        body = self.error_pages.get(status, self.error_pages[400])
+        return Response(status, [
+            ("Date", http_date()),
+            ("Content-Type", "text/html; charset=utf-8"),
+            ("Content-Length", str(len(body))),
+        ], body)
+
+    def _queue(self, conn: Connection, response: Response, keep_alive: bool,
+               version: str = "HTTP/1.1") -> None:
+        if not keep_alive:
+            response.headers.append(("Connection", "close"))
+        elif version == "HTTP/1.0":
+            response.headers.append(("Connection", "keep-alive"))
+        conn.keep_alive = keep_alive
+        conn.outbuf += format_head(response.status, response.headers, response.raw_headers)
+        if len(response.body) <= INLINE_BODY_SIZE:
+            conn.outbuf += response.body
+        else:
+            conn.body = memoryview(response.body)
+        conn.fd, conn.offset, conn.remaining = response.fd, response.offset, response.length
+
+    def _write(self, conn: Connection) -> bool:
+        """
+        Send queued response bytes and at most one file chunk.
+        :param conn: The connection to write to.
+        :return: Whether every queued response has been sent completely.
+        """
+        try:
+            if conn.outbuf:
+                more = conn.body is not None or conn.remaining
+                sent = conn.sock.send(conn.outbuf, MSG_MORE if more else 0)
+                del conn.outbuf[:sent]
+                self.bytes_sent += sent
+                self._touch(conn)
+                if conn.outbuf:
+                    return False
+            if conn.body is not None:
+                sent = conn.sock.send(conn.body)
+                self.bytes_sent += sent
+                self._touch(conn)
+                if sent < len(conn.body):
+                    conn.body = conn.body[sent:]
+                    return False
+                conn.body = None
+            if conn.remaining:
+                # One chunk per wakeup; the next one follows when the socket is writable again
+                sent = self._send_file(conn, min(conn.remaining, CHUNK_SIZE))
+                conn.offset += sent
+                conn.remaining -= sent
+                self.bytes_sent += sent
+                self._touch(conn)
+                if conn.remaining:
+                    return False
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            self.close_connection(conn)
+            return False
+        if conn.fd is not None:
+            os.close(conn.fd)
+            conn.fd = None
+        return True
+
+    def _send_file(self, conn: Connection, count: int) -> int:
+        if hasattr(os, "sendfile"):
+            sent = os.sendfile(conn.sock.fileno(), conn.fd, conn.offset, count)
+        else:  # Windows: copy through a buffer instead
+            os.lseek(conn.fd, conn.offset, os.SEEK_SET)
+            sent = conn.sock.send(os.read(conn.fd, count))
+        if sent == 0:
+            # The file shrank underneath us; nothing more can be sent for this response
+            raise OSError("File truncated while sending")
+        return sent
+
+    def _set_events(self, conn: Connection, events: int) -> None:
+        if conn.events != events:
+            conn.events = events
+            self.selector.modify(conn.sock, events, conn)
+
+    def close_connection(self, conn: Connection) -> None:
+        """
+        Unregister and close a client socket and any file it was streaming.
+        :param conn: The connection to close.
+        """
+        if conn.closed:
+            return
+        conn.closed = True
+        if conn.fd is not None:
+            os.close(conn.fd)
+            conn.fd = None
+        self.connections.pop(conn.sock, None)
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
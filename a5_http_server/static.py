@@ -0,0 +1,124 @@
+import mimetypes
+import os
+import stat
+from urllib.parse import unquote
+
+CONTENT_TYPES: dict[str, str] = {
+    ".html": "text/html; charset=utf-8",
+    ".htm": "text/html; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+    ".json": "application/json",
+    ".txt": "text/plain; charset=utf-8",
+    ".svg": "image/svg+xml",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".ico": "image/x-icon",
+    ".gz": "application/gzip",
+}
+
+
+class RangeNotSatisfiable(ValueError):
+    """
+    Raised when a Range header is valid but lies completely outside the file.
+    """
+
+
+def content_type(path: str) -> str:
+    """
+    :param path: A file path.
+    :return: The Content-Type to serve the file with.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in CONTENT_TYPES:
+        return CONTENT_TYPES[extension]
+    guessed, encoding = mimetypes.guess_type(path)
+    # A compressed file is served as it is stored, not as the type of what it contains
+    if encoding is not None:
+        return "application/octet-stream"
+    return guessed or "application/octet-stream"
+
+
+def parse_range(value: str, size: int) -> tuple[int, int] | None:
+    """
+    Interpret a Range header for a file of the given size.
+    Only a single byte range is honoured; multiple ranges and syntactically invalid headers are
+    ignored, which RFC 9110 allows, so the full file is served instead.
+    :param value: The Range header value.
+    :param size: The file size in bytes.
+    :return: The first and last byte position (inclusive), or None to serve the whole file.
+    :raises RangeNotSatisfiable: If the range starts beyond the end of the file.
+    """
+    unit, _, ranges = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, dash, last = ranges.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable(value)
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start < 0:
+        return None
+    # Before the order check: for an open range past the end, end = size - 1 is below start
+    if start >= size:
+        raise RangeNotSatisfiable(value)
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class StaticFiles:
+    """
+    Maps request paths onto files below a root directory without ever escaping it.
+    """
+
+    def __init__(self, directory: str, index: str = "index.html") -> None:
+        self.root: str = os.path.realpath(directory)
+        self.index: str = index
+
+    def resolve(self, path: str) -> str | None:
+        """
+        :param path: The URL path of a request, still percent-encoded.
+        :return: The absolute file path to serve, or None if there is no such file.
+        """
+        relative = unquote(path).lstrip("/")
+        if "\x00" in relative:
+            return None
+        candidate = os.path.realpath(os.path.join(self.root, relative))
+        if candidate != self.root and not candidate.startswith(self.root + os.sep):
+            return None
+        try:
+            info = os.stat(candidate)
+        except OSError:
+            return None
+        if stat.S_ISDIR(info.st_mode):
+            candidate = os.path.join(candidate, self.index)
+            if not os.path.isfile(candidate):
+                return None
+        elif not stat.S_ISREG(info.st_mode):
+            return None
+        return candidate
+
+    def read_page(self, name: str, fallback: bytes) -> bytes:
+        """
+        Load a small page such as 404.html, used as the body of error responses.
+        :param name: The file name relative to the root.
+        :param fallback: The body to use if the file is missing.
+        :return: The page contents.
+        """
+        try:
+            with open(os.path.join(self.root, name), "rb") as page:
+                return page.read()
+        except OSError:
+            return fallback
@@ -0,0 +1,319 @@
+import logging
+import mmap
+import os
+import select
+import selectors
+import signal
+import socket
+import struct
+import time
+
+from a5_http_server.server import HTTPServer
+from lab_common.metrics import Exporter, Metrics, worker_address
+
+logger = logging.getLogger(__name__)
+
+# Counters every worker publishes into its slot of the shared statistics table
+STAT_FIELDS: tuple[str, ...] = (
+    "pid", "generation", "restarts", "started", "requests", "accepted", "connections", "bytes_sent",
+    "entries", "bytes", "hits", "misses", "invalidations", "evictions", "compressions",
+)
+# Fields that are summed into the totals of the status document
+SUMMED_FIELDS: tuple[str, ...] = STAT_FIELDS[4:]
+SLOT = struct.Struct("<" + "q" * len(STAT_FIELDS))
+# Seconds between two updates of a worker's slot
+PUBLISH_INTERVAL = 0.5
+# A worker that dies sooner than this after starting is restarted only after this delay
+RESTART_DELAY = 1.0
+
+
+class StatsTable:
+    """
+    Fixed-size slots of 64-bit counters in an anonymous shared mapping. The mapping is created
+    by the supervisor before forking, so every worker writes its own slot and any worker can
+    read all of them without a system call. Slots are written without locking; a reader may
+    see a slot halfway through an update, which is acceptable for statistics.
+    """
+
+    def __init__(self, slots: int) -> None:
+        self.slots: int = slots
+        self.buffer: mmap.mmap = mmap.mmap(-1, SLOT.size * slots)
+
+    def write(self, slot: int, values: dict[str, int]) -> None:
+        SLOT.pack_into(self.buffer, slot * SLOT.size, *(int(values.get(field, 0)) for field in STAT_FIELDS))
+
+    def owner(self, slot: int) -> tuple[int, int]:
+        """
+        :return: The pid and generation of the worker that last wrote a slot, (0, 0) if empty.
+        """
+        pid, generation = struct.unpack_from("<qq", self.buffer, slot * SLOT.size)
+        return pid, generation
+
+    def clear(self, slot: int, pid: int | None = None) -> None:
+        """
+        :param pid: Only clear the slot if this worker still holds it.
+        """
+        if pid is not None and self.owner(slot)[0] != pid:
+            return
+        self.buffer[slot * SLOT.size:(slot + 1) * SLOT.size] = bytes(SLOT.size)
+
+    def read(self) -> list[dict[str, int]]:
+        """
+        :return: The contents of every slot in use, ordered by slot.
+        """
+        rows = []
+        for slot in range(self.slots):
+            values = SLOT.unpack_from(self.buffer, slot * SLOT.size)
+            if values[0]:
+                rows.append({"slot": slot, **dict(zip(STAT_FIELDS, values))})
+        return rows
+
+
+class WorkerHTTPServer(HTTPServer):
+    """
+    One pre-forked worker: an HTTPServer on the listening socket inherited from the supervisor
+    that publishes its counters to the shared table and answers the status endpoint with the
+    statistics of all workers. A worker stops by itself when its supervisor is gone.
+    """
+
+    def __init__(self, host: str, port: int, directory: str, listener: socket.socket, table: StatsTable,
+                 slot: int, generation: int, restarts: int, **options) -> None:
+        super().__init__(host, port, directory, **options)
+        self.shared_listener: socket.socket = listener
+        self.table: StatsTable = table
+        self.slot: int = slot
+        self.generation: int = generation
+        self.restarts: int = restarts
+        self.parent: int = os.getppid()
+        self.published: float = 0.0
+
+    def bind(self) -> None:
+        self.shared_listener.setblocking(False)
+        self.selector.register(self.shared_listener, selectors.EVENT_READ)
+        self.listener = self.shared_listener
+        logger.info("Worker in slot %d (generation %d) serving on %s:%d", self.slot, self.generation,
+                    self.host, self.port)
+        # Appear in the status document before the first tick
+        self.publish()
+
+    def on_tick(self) -> None:
+        if self.now - self.published >= PUBLISH_INTERVAL:
+            self.publish()
+            if os.getppid() != self.parent:
+                logger.warning("Supervisor exited, stopping worker %d", self.slot)
+                self.stop()
+
+    def publish(self) -> None:
+        """
+        Write the current counters into this worker's slot, unless a worker of a later
+        generation took it over while this one drains.
+        """
+        self.published = self.now
+        pid, generation = self.table.owner(self.slot)
+        if pid and pid != os.getpid() and generation > self.generation:
+            return
+        self.table.write(self.slot, {**self.stats(), "generation": self.generation, "restarts": self.restarts})
+
+    def status(self) -> dict:
+        self.publish()
+        workers = self.table.read()
+        total = {field: sum(worker[field] for worker in workers) for field in SUMMED_FIELDS}
+        lookups = total["hits"] + total["misses"]
+        total["hit_ratio"] = total["hits"] / lookups if lookups else 0.0
+        total["workers"] = len(workers)
+        return {"workers": workers, "total": total}
+
+
+class Supervisor:
+    """
+    Pre-forks `workers` processes that all accept on one listening socket, bound here once so
+    that it outlives every worker. The supervisor only waits for signals:
+
+        SIGCHLD: a worker exited; workers of the current generation are restarted
+        SIGHUP: graceful reload; a fresh generation of workers (with empty caches) is started,
+            then the previous one is told to drain, so no connection is refused or cut off
+        SIGTERM, SIGINT: graceful shutdown of all workers
+
+    Each worker index has two slots in the statistics table, used by alternating generations,
+    so a draining worker and its replacement can publish at the same time. After reloads in
+    quick succession a slot may be shared with a worker still draining two generations back;
+    the later generation then owns it, and a slot is only cleared for the pid that holds it.
+    Metrics and profiles are per slot too: the worker in slot n serves its metrics at
+    worker_address(metrics_address, n) and writes its profile to the profile path with ".n"
+    appended, slot 0 using them unchanged.
+    """
+
+    def __init__(self, host: str, port: int, directory: str, workers: int, backlog: int = 1024,
+                 metrics_address: str | None = None, profile: str | None = None, **options) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.directory: str = directory
+        self.workers: int = workers
+        self.backlog: int = backlog
+        self.options: dict = options
+        self.metrics_address: str | None = metrics_address
+        self.profile: str | None = profile
+        self.grace: float = options.get("grace", 10.0)
+        self.table: StatsTable = StatsTable(2 * workers)
+        self.listener: socket.socket | None = None
+        self.generation: int = 0
+        # pid -> (worker index, generation, start time)
+        self.children: dict[int, tuple[int, int, float]] = {}
+        self.restarts: list[int] = [0] * workers
+        # Worker index -> time at which a worker that crashed right away is started again
+        self.delayed: dict[int, float] = {}
+        self.stopping: bool = False
+        self.wakeup: tuple[socket.socket, socket.socket] | None = None
+
+    def slot(self, index: int, generation: int) -> int:
+        return (generation % 2) * self.workers + index
+
+    def run(self) -> None:
+        """
+        Bind the listening socket, start the workers and supervise them until stopped.
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(self.backlog)
+        self.listener = listener
+        logger.info("Serving %s on %s:%d with %d workers", self.directory, self.host, self.port, self.workers)
+
+        # Signals only write their number to the wakeup socket; they are handled in the loop
+        self.wakeup = socket.socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
+        signal.set_wakeup_fd(self.wakeup[1].fileno())
+        for signum in (signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: None)
+
+        for index in range(self.workers):
+            self._spawn(index)
+        try:
+            self._supervise()
+        finally:
+            for pid in self.children:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            listener.close()
+
+    def _supervise(self) -> None:
+        deadline = None
+        while self.children or not self.stopping:
+            timeout = None
+            if self.delayed:
+                timeout = max(0.0, min(self.delayed.values()) - time.monotonic())
+            if deadline is not None:
+                timeout = max(0.0, deadline - time.monotonic())
+                if timeout == 0.0:
+                    logger.warning("Killing %d workers that did not drain in time", len(self.children))
+                    for pid in self.children:
+                        os.kill(pid, signal.SIGKILL)
+                    deadline = None
+            select.select([self.wakeup[0]], [], [], timeout)
+            try:
+                signals = self.wakeup[0].recv(256)
+            except BlockingIOError:
+                signals = b""
+
+            self._reap()
+            if signal.SIGHUP in signals and not self.stopping:
+                self._reload()
+            if (signal.SIGTERM in signals or signal.SIGINT in signals) and not self.stopping:
+                logger.info("Stopping %d workers", len(self.children))
+                self.stopping = True
+                self.delayed.clear()
+                self._signal_all(signal.SIGTERM, lambda generation: True)
+                deadline = time.monotonic() + self.grace + 5.0
+            now = time.monotonic()
+            for index, when in list(self.delayed.items()):
+                if when <= now:
+                    del self.delayed[index]
+                    self._spawn(index)
+
+    def _reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            index, generation, started = self.children.pop(pid)
+            self.table.clear(self.slot(index, generation), pid)
+            if generation != self.generation or self.stopping:
+                continue
+            logger.error("Worker %d (pid %d) exited with status %d, restarting",
+                         index, pid, os.waitstatus_to_exitcode(status))
+            self.restarts[index] += 1
+            if time.monotonic() - started < RESTART_DELAY:
+                self.delayed[index] = time.monotonic() + RESTART_DELAY
+            else:
+                self._spawn(index)
+
+    def _reload(self) -> None:
+        self.generation += 1
+        logger.info("Reloading: starting worker generation %d", self.generation)
+        self.delayed.clear()
+        for index in range(self.workers):
+            self._spawn(index)
+        self._signal_all(signal.SIGTERM, lambda generation: generation < self.generation)
+
+    def _signal_all(self, signum: int, selected) -> None:
+        for pid, (_, generation, _) in self.children.items():
+            if selected(generation):
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def _spawn(self, index: int) -> None:
+        slot = self.slot(index, self.generation)
+        self.table.clear(slot)
+        pid = os.fork()
+        if pid == 0:
+            os._exit(self._run_worker(index, slot))
+        self.children[pid] = (index, self.generation, time.monotonic())
+
+    def _run_worker(self, index: int, slot: int) -> int:
+        signal.set_wakeup_fd(-1)
+        for sock in self.wakeup:
+            sock.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # Ctrl+C reaches the whole process group; the supervisor coordinates the shutdown
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        metrics = Metrics("http") if self.metrics_address else None
+        profile = f"{self.profile}.{slot}" if self.profile and slot else self.profile
+        exporter = Exporter(metrics, worker_address(self.metrics_address, slot), profile)
+        try:
+            server = WorkerHTTPServer(self.host, self.port, self.directory, self.listener, self.table,
+                                      slot, self.generation, self.restarts[index], metrics=metrics,
+                                      **self.options)
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+            exporter.start()
+            server.serve_forever()
+        except Exception:
+            logger.exception("Worker %d crashed", index)
+            return 1
+        finally:
+            exporter.close()
+        return 0
+
+
+def serve_workers(host: str, port: int, directory: str, workers: int, metrics_address: str | None = None,
+                  profile: str | None = None, **options) -> None:
+    """
+    Run the HTTP server as a supervisor with `workers` pre-forked worker processes.
+    :param host: The host to listen at.
+    :param port: The port to listen at.
+    :param directory: The directory to serve.
+    :param workers: The number of worker processes.
+    :param metrics_address: Where the worker in statistics slot 0 serves its metrics, the others
+                            at worker_address() of their slot; no metrics if None.
+    :param profile: The file the worker in slot 0 writes its profile to; no profiling if None.
+    :param options: Keyword arguments for every worker's HTTPServer.
+    """
+    Supervisor(host, port, directory, workers, metrics_address=metrics_address, profile=profile, **options).run()
@@ -1,12 +1,35 @@
+import logging
+import signal
+import sys
 from argparse import Namespace, ArgumentParser
 
+from a6_dns_server.index import load_index
+from a6_dns_server.message import EDNS_UDP_SIZE
+from a6_dns_server.server import DNSServer, serve_workers
+from a6_dns_server.zone import ZoneError
+from lab_common.metrics import Exporter, Metrics, parse_address
+
 
 def parse_arguments() -> Namespace:
     """
     Parse command line arguments for the dns server.
-    The three valid options are:
+    The valid options are:
         --address: The host to listen at. Default is "0.0.0.0"
         --port: The port to listen at. Default is 8000
+        --zone: A zone file to serve authoritatively; may be repeated. SIGHUP reloads the zone files
+        --snapshot-dir: A directory for compiled zone snapshots, which are mapped at startup
+                        instead of compiling a zone file that did not change. Default is none
+        --upstream: The resolver to forward other queries to, as host[:port]. Default is none
+        --workers: The number of worker processes sharing the port. Default is 1
+        --cache-size: The number of upstream answers to cache, 0 to disable. Default is 10000
+        --max-ttl: The longest time in seconds an upstream answer is cached. Default is 86400
+        --max-udp-size: The largest UDP response for EDNS0 clients, others get at most 512 bytes.
+                        Larger responses are truncated and retried over TCP. Default is 1232
+        --metrics: Serve Prometheus metrics at [host]:port or a Unix socket path; workers after
+                   the first at the next ports or at the path suffixed with their number.
+                   Default is none
+        --profile: Sample the stacks of the event loop and write them, folded for flame graphs,
+                   to this file on exit. Default is none
     :return: The parsed arguments in a Namespace object.
     """
 
@@ -19,6 +42,24 @@ def parse_arguments() -> Namespace:
                         type=str, help="Set server address", default="0.0.0.0")
     parser.add_argument("-p", "--port",
                         type=int, help="Set server port", default=8000)
+    parser.add_argument("-z", "--zone", dest="zones", action="append", default=[],
+                        type=str, help="Serve a zone file authoritatively")
+    parser.add_argument("--snapshot-dir",
+                        type=str, help="Keep compiled zone snapshots in this directory")
+    parser.add_argument("-u", "--upstream",
+                        type=str, help="Forward other queries to this resolver (host[:port])")
+    parser.add_argument("-w", "--workers",
+                        type=int, help="Set the number of worker processes", default=1)
+    parser.add_argument("--cache-size",
+                        type=int, help="Set the number of cached upstream answers", default=10000)
+    parser.add_argument("--max-ttl",
+                        type=int, help="Set the longest time an upstream answer is cached", default=86400)
+    parser.add_argument("--max-udp-size",
+                        type=int, help="Set the largest UDP response to EDNS0 clients", default=EDNS_UDP_SIZE)
+    parser.add_argument("--metrics",
+                        type=parse_address, help="Set the address serving Prometheus metrics")
+    parser.add_argument("--profile",
+                        type=str, help="Set the file the sampled stacks are written to")
 
     return parser.parse_args()
 
@@ -28,7 +69,36 @@ def main() -> None:
     port: int = parser.port
     host: str = parser.address
 
-    # TODO: Your implementation here
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s - %(levelname)s] %(message)s")
+
+    try:
+        zones = [load_index(path, parser.snapshot_dir) for path in parser.zones]
+    except (OSError, ZoneError) as e:
+        logging.error("Failed to load zone: %s", e)
+        sys.exit(1)
+    upstream = None
+    if parser.upstream:
+        upstream_host, _, upstream_port = parser.upstream.partition(":")
+        upstream = (upstream_host, int(upstream_port or 53))
+
+    options = {"cache_size": parser.cache_size, "max_ttl": parser.max_ttl,
+               "max_udp_size": max(512, parser.max_udp_size)}
+    if parser.workers > 1:
+        serve_workers(host, port, parser.workers, zones, upstream, parser.metrics, parser.profile, **options)
+        return
+    metrics = Metrics("dns") if parser.metrics else None
+    server = DNSServer(host, port, zones, upstream, metrics=metrics, **options)
+    signal.signal(signal.SIGHUP, lambda signum, frame: server.request_reload())
+    # Unwind on SIGTERM, so that the profile is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    exporter = Exporter(metrics, parser.metrics, parser.profile)
+    exporter.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        exporter.close()
 
 
 if __name__ == "__main__":
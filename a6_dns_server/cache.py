@@ -0,0 +1,141 @@
+import struct
+from collections import OrderedDict
+
+from a6_dns_server.message import (AUTHORITY, FLAG_TC, HEADER, RCODE_NOERROR, RCODE_NXDOMAIN, TYPE_OPT,
+                                   TYPE_SOA, FormatError, iter_records)
+
+TTL = struct.Struct("!I")
+
+CacheKey = tuple[bytes, int, int]
+
+
+class CachedAnswer:
+    """
+    A response in wire format with the offsets of its TTL fields. Serving it means copying the
+    bytes and patching the transaction ID; the TTLs are re-rendered at most once per second of
+    age, so they count down while the entry lives.
+    """
+
+    __slots__ = ("wire", "ttls", "stored", "expires", "negative", "rendered", "rendered_age")
+
+    def __init__(self, wire: bytes, ttls: list[tuple[int, int]], stored: float, lifetime: int,
+                 negative: bool) -> None:
+        self.wire: bytes = wire
+        self.ttls: list[tuple[int, int]] = ttls
+        self.stored: float = stored
+        self.expires: float = stored + lifetime
+        self.negative: bool = negative
+        self.rendered: bytes = wire
+        self.rendered_age: int = 0
+
+    def render(self, now: float) -> bytes:
+        """
+        :param now: The current monotonic time.
+        :return: The response with every TTL decremented by the entry's age in whole seconds.
+        """
+        age = int(now - self.stored)
+        if age != self.rendered_age:
+            wire = bytearray(self.wire)
+            for offset, ttl in self.ttls:
+                TTL.pack_into(wire, offset, max(0, ttl - age))
+            self.rendered = bytes(wire)
+            self.rendered_age = age
+        return self.rendered
+
+
+class AnswerCache:
+    """
+    Bounded cache of upstream responses keyed by (lower-cased name, type, class).
+
+    Positive answers live for their smallest TTL. NXDOMAIN and NODATA answers are cached as
+    RFC 2308 prescribes: for the lesser of the TTL and MINIMUM field of the SOA record in the
+    authority section, and not at all without one. Truncated answers and errors are never
+    cached. Entries are evicted least recently used first, expired ones as soon as they are met.
+    """
+
+    def __init__(self, max_entries: int = 10000, max_ttl: int = 86400, max_negative_ttl: int = 3600) -> None:
+        self.max_entries: int = max_entries
+        self.max_ttl: int = max_ttl
+        self.max_negative_ttl: int = max_negative_ttl
+        self.entries: OrderedDict[CacheKey, CachedAnswer] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.expirations: int = 0
+        self.evictions: int = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: CacheKey, now: float) -> CachedAnswer | None:
+        """
+        :param key: The question.
+        :param now: The current monotonic time.
+        :return: The live entry for the question, or None.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires <= now:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def store(self, key: CacheKey, response: bytes | memoryview, now: float) -> CachedAnswer | None:
+        """
+        Cache an upstream response if it is cacheable.
+        :param key: The question the response answers.
+        :param response: The response in wire format.
+        :param now: The current monotonic time.
+        :return: The new entry, or None if the response is not cached.
+        """
+        if self.max_entries <= 0:
+            return None
+        _, flags, _, ancount, _, _ = HEADER.unpack_from(response)
+        rcode = flags & 0x000F
+        if flags & FLAG_TC or rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            return None
+        negative = rcode == RCODE_NXDOMAIN or ancount == 0
+        ttls: list[tuple[int, int]] = []
+        lifetime: int | None = None
+        try:
+            for section, fixed, rtype, ttl, rdata, length in iter_records(response):
+                if rtype == TYPE_OPT:
+                    # Its TTL field holds EDNS flags, not a TTL
+                    continue
+                ttls.append((fixed + 4, ttl))
+                if negative:
+                    if section == AUTHORITY and rtype == TYPE_SOA and length >= 20:
+                        minimum = TTL.unpack_from(response, rdata + length - 4)[0]
+                        lifetime = min(ttl, minimum, self.max_negative_ttl)
+                else:
+                    lifetime = min(ttl, self.max_ttl if lifetime is None else lifetime)
+        except FormatError:
+            return None
+        if not lifetime or lifetime <= 0:
+            return None
+        entry = CachedAnswer(bytes(response), ttls, now, lifetime, negative)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def stats(self) -> dict[str, int | float]:
+        """
+        :return: Entry count, hit/miss counters and the hit ratio.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,604 @@
+import logging
+import mmap
+import os
+import struct
+import zlib
+from abc import ABC, abstractmethod
+
+from a6_dns_server.message import (ADDITIONAL, ANSWER, AUTHORITY, FLAG_AA, HEADER, QNAME_POINTER, QUESTION,
+                                   RCODE_NOERROR, RCODE_NXDOMAIN, RR_FIXED, TYPE_A, TYPE_AAAA, TYPE_CNAME,
+                                   TYPE_MX, TYPE_NS, TYPE_PTR, TYPE_SOA, TYPES, MessageWriter, Query,
+                                   skip_name, wire_to_name)
+from a6_dns_server.zone import Record, Zone, ZoneError
+
+logger = logging.getLogger(__name__)
+
+POINTER = struct.Struct("!H")
+RDLENGTH = struct.Struct("!H")
+# Names are only pointed to this far below the 14-bit pointer limit, so that moving a pointer
+# by the length difference of a longer question name cannot overflow it
+MAX_POINTER_TARGET = 0x3FFF - 255
+WILDCARD = b"\x01*"
+MAX_CNAME_CHAIN = 8
+# Answers at an alias for a type no record in the zone has are compiled as this type
+ANY_OTHER_TYPE = 0
+# The types whose answers are kept once compiled; others are compiled again for every query
+KNOWN_TYPES = frozenset(TYPES.values()) | {ANY_OTHER_TYPE}
+
+SNAPSHOT_MAGIC = b"A6ZI"
+SNAPSHOT_VERSION = 1
+# Magic, version, size and mtime of the zone file, slot count, offsets of the origin and of the
+# NXDOMAIN and NODATA answers
+SNAPSHOT_HEADER = struct.Struct("<4sIqqIIII")
+SLOT = struct.Struct("<I")
+# Flags, rcode, record counts per section, question name length, body length, relocation count
+ANSWER_HEADER = struct.Struct("<HHHHHHIH")
+# Offset of the referral answer, number of answers
+ENTRY_HEADER = struct.Struct("<IH")
+ENTRY_ANSWER = struct.Struct("<HI")
+
+Source = tuple[int, int]
+
+
+def source_of(path: str) -> Source:
+    """
+    :return: The size and modification time of a file, which change when it is rewritten.
+    """
+    info = os.stat(path)
+    return info.st_size, info.st_mtime_ns
+
+
+class Answer:
+    """
+    Everything of a response after its question, encoded once for a question name of `base`
+    bytes. Owner names equal to the question name point to it at offset 12. Every other
+    compression pointer is listed in `relocations`: when the question name is longer than the
+    name the answer was compiled for, as for wildcard matches, names below a delegation and
+    names that do not exist, those pointers are moved by the difference. An answer is
+    therefore written with one copy, and at most a few two-byte patches.
+    """
+
+    __slots__ = ("flags", "rcode", "counts", "body", "base", "relocations")
+
+    def __init__(self, flags: int, rcode: int, counts: tuple[int, int, int], body: bytes | memoryview,
+                 base: int, relocations: tuple[int, ...]) -> None:
+        self.flags: int = flags
+        self.rcode: int = rcode
+        self.counts: tuple[int, int, int] = counts
+        self.body: bytes | memoryview = body
+        self.base: int = base
+        self.relocations: tuple[int, ...] = relocations
+
+    def write(self, writer: MessageWriter, query: Query, flags: int, limit: int) -> memoryview:
+        """
+        Write the response to a query.
+        :param writer: The writer to build the response in.
+        :param query: The query, whose name is at or below the name the answer was compiled for.
+        :param flags: Flags to set besides those of the answer.
+        :param limit: The largest response the client accepts.
+        :return: The response.
+        """
+        writer.begin(query, self.flags | flags, self.rcode, limit)
+        start = writer.pos
+        if writer.add_raw(self.body, self.counts) and self.relocations:
+            delta = len(query.qname) - self.base
+            if delta:
+                buffer = writer.buffer
+                for offset in self.relocations:
+                    offset += start
+                    POINTER.pack_into(buffer, offset, POINTER.unpack_from(buffer, offset)[0] + delta)
+        return writer.finish()
+
+
+class AnswerBuilder:
+    """
+    Encodes records for an Answer, compressing every name against the question and the names
+    before it.
+    """
+
+    def __init__(self, base: bytes, wildcard: bool = False) -> None:
+        """
+        :param base: The question name the answer is compiled for.
+        :param wildcard: Whether the name is a wildcard, whose first label differs in every
+            response, so only the names above it can be pointed to.
+        """
+        self.base: bytes = base
+        self.body: bytearray = bytearray()
+        self.relocations: list[int] = []
+        self.counts: list[int] = [0, 0, 0]
+        self.start: int = HEADER.size + len(base) + QUESTION.size
+        self.names: dict[bytes, int] = {}
+        key = base.lower()
+        offset = key[0] + 1 if wildcard else 0
+        while key[offset]:
+            self.names[key[offset:]] = HEADER.size + offset
+            offset += key[offset] + 1
+
+    def name(self, name: bytes) -> None:
+        """
+        Append a name, replacing its longest suffix already encoded by a pointer.
+        """
+        key = name.lower()
+        names = self.names
+        body = self.body
+        offset = 0
+        while name[offset]:
+            pointer = names.get(key[offset:])
+            if pointer is not None:
+                body += name[:offset]
+                self.relocations.append(len(body))
+                body += POINTER.pack(0xC000 | pointer)
+                return
+            position = self.start + len(body) + offset
+            if position <= MAX_POINTER_TARGET:
+                names[key[offset:]] = position
+            offset += name[offset] + 1
+        body += name
+
+    def record(self, section: int, record: Record, owner: bool = False) -> None:
+        """
+        Append a record. Sections must be filled in order.
+        :param section: The section of the record.
+        :param record: The record.
+        :param owner: Whether the owner name is the question name.
+        """
+        body = self.body
+        if owner:
+            body += QNAME_POINTER
+        else:
+            self.name(record.name)
+        fixed = len(body)
+        body += RR_FIXED.pack(record.rtype, record.rclass, record.ttl, 0)
+        rdata = record.rdata
+        # Only the names in the RDATA of the types of RFC 1035 may be compressed (RFC 3597)
+        if record.rtype in (TYPE_NS, TYPE_CNAME, TYPE_PTR):
+            self.name(rdata)
+        elif record.rtype == TYPE_MX:
+            body += rdata[:2]
+            self.name(rdata[2:])
+        elif record.rtype == TYPE_SOA:
+            mname = skip_name(rdata, 0)
+            rname = skip_name(rdata, mname)
+            self.name(rdata[:mname])
+            self.name(rdata[mname:rname])
+            body += rdata[rname:]
+        else:
+            body += rdata
+        RDLENGTH.pack_into(body, fixed + RR_FIXED.size - RDLENGTH.size, len(body) - fixed - RR_FIXED.size)
+        self.counts[section] += 1
+
+    def build(self, flags: int, rcode: int) -> Answer:
+        return Answer(flags, rcode, (self.counts[0], self.counts[1], self.counts[2]), bytes(self.body),
+                      len(self.base), tuple(self.relocations))
+
+
+class Node:
+    """
+    A name in a compiled zone: the delegation it is at or below, if any, and its answers by
+    query type.
+    """
+
+    __slots__ = ("cut", "answers")
+
+    def __init__(self, cut: bytes | None, answers: dict[int, Answer]) -> None:
+        self.cut: bytes | None = cut
+        self.answers: dict[int, Answer] = answers
+
+
+class CompiledZone(ABC):
+    """
+    A zone compiled into a hash of lower-cased names in wire format to Nodes, whose answers are
+    complete, compressed response bodies. A query for an existing name costs one lookup of the
+    name and one of the type. Names that do not exist are matched to their closest existing
+    ancestor, which may be a delegation or have a wildcard child, with one lookup per label.
+    """
+
+    origin: bytes
+    nxdomain: Answer
+    nodata: Answer
+
+    def lookup(self, key: bytes, qtype: int) -> Answer:
+        """
+        :param key: The lower-cased query name in wire format, at or below the origin.
+        :param qtype: The query type.
+        :return: The answer to the query.
+        """
+        find = self._node
+        node = find(key)
+        if node is None:
+            # The origin always exists, so this ends at the closest existing ancestor
+            offset = key[0] + 1
+            node = find(key[offset:])
+            while node is None:
+                offset += key[offset] + 1
+                node = find(key[offset:])
+            if node.cut is None:
+                key = WILDCARD + key[offset:]
+                node = find(key)
+                if node is None:
+                    return self.nxdomain
+        if node.cut is not None:
+            return self._referral(node.cut)
+        answer = node.answers.get(qtype)
+        if answer is None:
+            answer = self._derive(key, node, qtype)
+        return answer
+
+    def reload(self) -> "CompiledZone":
+        """
+        Bring the zone up to date with its file.
+        :return: The up to date zone, which may be a new object.
+        """
+        return self
+
+    @abstractmethod
+    def _node(self, key: bytes) -> Node | None:
+        """
+        :param key: A lower-cased name in wire format, at or below the origin.
+        :return: The node of the name, or None if the name does not exist.
+        """
+
+    @abstractmethod
+    def _referral(self, cut: bytes) -> Answer:
+        """
+        :param cut: The name of a delegation, as found in Node.cut.
+        :return: The referral to the delegated zone.
+        """
+
+    @abstractmethod
+    def _derive(self, key: bytes, node: Node, qtype: int) -> Answer:
+        """
+        :param key: The name of the node, or the wildcard it was matched to.
+        :param node: A node without an answer compiled for the type.
+        :param qtype: The query type.
+        :return: The answer to the query.
+        """
+
+
+class ZoneIndex(CompiledZone):
+    """
+    A zone compiled in memory. The answers for the records at each name are compiled up front.
+    Answers that depend on records at other names, referrals and the answers at aliases, are
+    compiled on first use and recorded as depending on those names, so that a reload can
+    recompile just the names whose records changed and the answers built from them.
+    """
+
+    def __init__(self, zone: Zone, path: str | None = None, snapshot: str | None = None) -> None:
+        """
+        :param zone: The zone.
+        :param path: The zone file, if the zone can be reloaded.
+        :param snapshot: The snapshot file to update after every reload, if any.
+        """
+        self.zone: Zone = zone
+        self.path: str | None = path
+        self.snapshot: str | None = snapshot
+        self.source: Source = source_of(path) if path is not None else (0, 0)
+        self.origin = zone.origin
+        self.nodes: dict[bytes, Node] = {key: self._compile(key) for key in zone.names}
+        # Shadows _node below, sparing lookup() a call per label
+        self._node = self.nodes.get
+        self.referrals: dict[bytes, Answer] = {}
+        # The names with answers compiled from records at other names, by those names
+        self.dependents: dict[bytes, set[bytes]] = {}
+        self._compile_negative()
+
+    def _compile(self, key: bytes) -> Node:
+        zone = self.zone
+        cut = zone.delegation(key)
+        answers: dict[int, Answer] = {}
+        if cut is None:
+            wildcard = key.startswith(WILDCARD)
+            for rtype, rrset in zone.rrsets.get(key, {}).items():
+                builder = AnswerBuilder(rrset[0].name, wildcard)
+                for record in rrset:
+                    builder.record(ANSWER, record, owner=True)
+                answers[rtype] = builder.build(FLAG_AA, RCODE_NOERROR)
+        return Node(cut, answers)
+
+    def _compile_negative(self) -> None:
+        soa = self.zone.soa
+        answers = []
+        for rcode in (RCODE_NXDOMAIN, RCODE_NOERROR):
+            builder = AnswerBuilder(soa.name)
+            builder.record(AUTHORITY, soa)
+            answers.append(builder.build(FLAG_AA, rcode))
+        self.nxdomain, self.nodata = answers
+
+    def _depend(self, key: bytes, dependent: bytes) -> None:
+        self.dependents.setdefault(key, set()).add(dependent)
+
+    def _node(self, key: bytes) -> Node | None:
+        return self.nodes.get(key)
+
+    def _referral(self, cut: bytes) -> Answer:
+        answer = self.referrals.get(cut)
+        if answer is not None:
+            return answer
+        zone = self.zone
+        ns = zone.rrsets[cut][TYPE_NS]
+        builder = AnswerBuilder(ns[0].name)
+        for record in ns:
+            builder.record(AUTHORITY, record)
+        # Glue: the addresses of name servers within the zone
+        for record in ns:
+            target = record.rdata.lower()
+            if zone.contains(target):
+                self._depend(target, cut)
+                rrsets = zone.rrsets.get(target, {})
+                for glue in rrsets.get(TYPE_A, []) + rrsets.get(TYPE_AAAA, []):
+                    builder.record(ADDITIONAL, glue)
+        answer = self.referrals[cut] = builder.build(0, RCODE_NOERROR)
+        return answer
+
+    def _derive(self, key: bytes, node: Node, qtype: int) -> Answer:
+        rrsets = self.zone.rrsets.get(key)
+        if not rrsets or TYPE_CNAME not in rrsets:
+            return self.nodata
+        cname = rrsets[TYPE_CNAME][0]
+        builder = AnswerBuilder(cname.name, key.startswith(WILDCARD))
+        builder.record(ANSWER, cname, owner=True)
+        rcode = self._chase(builder, cname.rdata.lower(), qtype, key)
+        answer = builder.build(FLAG_AA, rcode)
+        if qtype in KNOWN_TYPES:
+            node.answers[qtype] = answer
+        return answer
+
+    def _chase(self, builder: AnswerBuilder, target: bytes, qtype: int, alias: bytes) -> int:
+        """
+        Follow a CNAME within the zone, adding the records found to the answer.
+        :return: The response code.
+        """
+        zone = self.zone
+        for _ in range(MAX_CNAME_CHAIN):
+            if not zone.contains(target) or zone.delegation(target) is not None:
+                return RCODE_NOERROR
+            self._depend(target, alias)
+            rrsets = zone.rrsets.get(target, {})
+            rrset = rrsets.get(qtype)
+            if rrset is not None:
+                for record in rrset:
+                    builder.record(ANSWER, record)
+                return RCODE_NOERROR
+            cname = rrsets.get(TYPE_CNAME)
+            if cname is None:
+                self._depend(zone.origin, alias)
+                builder.record(AUTHORITY, zone.soa)
+                return RCODE_NOERROR if target in zone.names else RCODE_NXDOMAIN
+            builder.record(ANSWER, cname[0])
+            target = cname[0].rdata.lower()
+        return RCODE_NOERROR
+
+    def update(self, zone: Zone) -> int:
+        """
+        Switch to a new version of the zone with the same origin. Only the names whose records
+        changed are recompiled, along with the answers compiled from them and the names below
+        delegations that were added, changed or removed.
+        :param zone: The new version.
+        :return: The number of names recompiled.
+        """
+        old = self.zone
+        if zone.origin != old.origin:
+            raise ZoneError("The origin of a zone cannot change on reload")
+        # Names that appeared or disappeared, including empty non-terminals, and changed names
+        changed = old.names ^ zone.names
+        changed.update(key for key in old.names & zone.names if old.signature(key) != zone.signature(key))
+        dirty = set(changed)
+        for key in changed:
+            dirty |= self.dependents.pop(key, set())
+        moved = (old.delegations ^ zone.delegations) | (changed & (old.delegations | zone.delegations))
+        if moved:
+            for key in old.names | zone.names:
+                ancestor = key
+                while ancestor != zone.origin and ancestor not in moved:
+                    ancestor = ancestor[ancestor[0] + 1:]
+                if ancestor in moved:
+                    dirty.add(key)
+        self.zone = zone
+        if zone.origin in changed:
+            self._compile_negative()
+        for key in dirty:
+            self.referrals.pop(key, None)
+            if key in zone.names:
+                self.nodes[key] = self._compile(key)
+            else:
+                self.nodes.pop(key, None)
+        return len(dirty)
+
+    def reload(self) -> CompiledZone:
+        if self.path is None:
+            return self
+        source = source_of(self.path)
+        if source == self.source:
+            return self
+        count = self.update(Zone.from_file(self.path))
+        self.source = source
+        logger.info("Reloaded zone %s: recompiled %d of %d names", wire_to_name(self.origin), count,
+                    len(self.nodes))
+        if self.snapshot is not None:
+            self.save(self.snapshot)
+        return self
+
+    def save(self, path: str) -> None:
+        """
+        Write the compiled zone to a snapshot file, which ZoneSnapshot maps into memory.
+        The file is replaced atomically.
+        :param path: The snapshot file.
+        """
+        # Answers at aliases are compiled on first use; a snapshot holds them for every known type
+        for key, node in self.nodes.items():
+            if node.cut is None and TYPE_CNAME in self.zone.rrsets.get(key, {}):
+                for qtype in KNOWN_TYPES:
+                    if qtype not in node.answers:
+                        self._derive(key, node, qtype)
+
+        slot_count = 1 << max(4, (2 * len(self.nodes)).bit_length())
+        slots = bytearray(slot_count * SLOT.size)
+        data = bytearray()
+        data_start = SNAPSHOT_HEADER.size + len(slots)
+        offsets: dict[int, int] = {}
+
+        def put_answer(answer: Answer) -> int:
+            offset = offsets.get(id(answer))
+            if offset is None:
+                offset = offsets[id(answer)] = data_start + len(data)
+                data.extend(ANSWER_HEADER.pack(answer.flags, answer.rcode, *answer.counts, answer.base,
+                                               len(answer.body), len(answer.relocations)))
+                data.extend(struct.pack(f"<{len(answer.relocations)}H", *answer.relocations))
+                data.extend(answer.body)
+            return offset
+
+        origin = data_start + len(data)
+        data.extend(bytes([len(self.origin)]) + self.origin)
+        nxdomain, nodata = put_answer(self.nxdomain), put_answer(self.nodata)
+        mask = slot_count - 1
+        for key, node in self.nodes.items():
+            referral = put_answer(self._referral(node.cut)) if node.cut is not None else 0
+            answers = [(qtype, put_answer(answer)) for qtype, answer in node.answers.items()]
+            slot = zlib.crc32(key) & mask
+            while SLOT.unpack_from(slots, slot * SLOT.size)[0]:
+                slot = (slot + 1) & mask
+            SLOT.pack_into(slots, slot * SLOT.size, data_start + len(data))
+            cut = node.cut or b""
+            data.extend(bytes([len(key)]) + key + bytes([len(cut)]) + cut)
+            data.extend(ENTRY_HEADER.pack(referral, len(answers)))
+            for answer in answers:
+                data.extend(ENTRY_ANSWER.pack(*answer))
+
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, *self.source, slot_count, origin,
+                                            nxdomain, nodata))
+            file.write(slots)
+            file.write(data)
+        os.replace(temporary, path)
+
+
+class ZoneSnapshot(CompiledZone):
+    """
+    A compiled zone mapped into memory from a snapshot file. Opening one reads nothing but the
+    header, however large the zone; the names are found in an open addressing hash table in
+    the file and decoded on first use, and answer bodies are copied into responses straight
+    from the mapping. Worker processes mapping the same snapshot share its pages.
+    """
+
+    def __init__(self, path: str, source: str | None = None) -> None:
+        """
+        :param path: The snapshot file.
+        :param source: The zone file the snapshot was made from, if it can be reloaded.
+        :raises ZoneError: If the file is not a snapshot.
+        """
+        with open(path, "rb") as file:
+            self.map: mmap.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view: memoryview = memoryview(self.map)
+        try:
+            magic, version, size, mtime, slot_count, origin, nxdomain, nodata = \
+                SNAPSHOT_HEADER.unpack_from(self.view)
+        except struct.error:
+            magic = version = None
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ZoneError(f"Not a zone snapshot: {path}")
+        self.path: str = path
+        self.source_path: str | None = source
+        self.source: Source = (size, mtime)
+        self.mask: int = slot_count - 1
+        self.origin = bytes(self.view[origin + 1:origin + 1 + self.view[origin]])
+        self.answers: dict[int, Answer] = {}
+        self.nxdomain = self._answer(nxdomain)
+        self.nodata = self._answer(nodata)
+        self.nodes: dict[bytes, Node] = {}
+        self.referrals: dict[bytes, Answer] = {}
+
+    def _answer(self, start: int) -> Answer:
+        answer = self.answers.get(start)
+        if answer is None:
+            flags, rcode, answers, authority, additional, base, length, count = \
+                ANSWER_HEADER.unpack_from(self.view, start)
+            offset = start + ANSWER_HEADER.size
+            relocations = struct.unpack_from(f"<{count}H", self.view, offset)
+            offset += 2 * count
+            answer = self.answers[start] = Answer(flags, rcode, (answers, authority, additional),
+                                                   self.view[offset:offset + length], base, relocations)
+        return answer
+
+    def _node(self, key: bytes) -> Node | None:
+        node = self.nodes.get(key)
+        if node is not None:
+            return node
+        view = self.view
+        slot = zlib.crc32(key) & self.mask
+        while True:
+            offset = SLOT.unpack_from(view, SNAPSHOT_HEADER.size + slot * SLOT.size)[0]
+            if not offset:
+                return None
+            length = view[offset]
+            if view[offset + 1:offset + 1 + length] == key:
+                break
+            slot = (slot + 1) & self.mask
+        offset += 1 + length
+        length = view[offset]
+        cut = bytes(view[offset + 1:offset + 1 + length]) if length else None
+        offset += 1 + length
+        referral, count = ENTRY_HEADER.unpack_from(view, offset)
+        offset += ENTRY_HEADER.size
+        answers: dict[int, Answer] = {}
+        for _ in range(count):
+            qtype, answer = ENTRY_ANSWER.unpack_from(view, offset)
+            answers[qtype] = self._answer(answer)
+            offset += ENTRY_ANSWER.size
+        if cut is not None and cut not in self.referrals:
+            self.referrals[cut] = self._answer(referral)
+        node = self.nodes[key] = Node(cut, answers)
+        return node
+
+    def _referral(self, cut: bytes) -> Answer:
+        return self.referrals[cut]
+
+    def _derive(self, key: bytes, node: Node, qtype: int) -> Answer:
+        return node.answers.get(ANY_OTHER_TYPE, self.nodata)
+
+    def reload(self) -> CompiledZone:
+        if self.source_path is None or source_of(self.source_path) == self.source:
+            return self
+        index = ZoneIndex(Zone.from_file(self.source_path), self.source_path, self.path)
+        index.save(self.path)
+        logger.info("Reloaded zone %s: recompiled all %d names", wire_to_name(index.origin), len(index.nodes))
+        self.close()
+        return index
+
+    def close(self) -> None:
+        """
+        Unmap the snapshot. Answer bodies are views of the mapping, so they are released first;
+        the zone cannot be used afterwards.
+        """
+        for answer in self.answers.values():
+            answer.body.release()
+        self.answers.clear()
+        self.nodes.clear()
+        self.referrals.clear()
+        self.view.release()
+        self.map.close()
+
+
+def load_index(path: str, snapshot_dir: str | None = None) -> CompiledZone:
+    """
+    Compile a zone file. With a snapshot directory, map the snapshot of the file instead if it
+    was made from the file as it is now, or write one for the next start.
+    :param path: The zone file.
+    :param snapshot_dir: The directory holding the snapshots, named after the zone files.
+    :return: The compiled zone.
+    :raises OSError: If a file cannot be read or written.
+    :raises ZoneError: If the zone file is invalid.
+    """
+    if snapshot_dir is None:
+        return ZoneIndex(Zone.from_file(path), path)
+    snapshot = os.path.join(snapshot_dir, os.path.basename(path) + ".index")
+    try:
+        index = ZoneSnapshot(snapshot, path)
+        if index.source == source_of(path):
+            return index
+        index.close()
+    except (OSError, ZoneError):
+        pass
+    index = ZoneIndex(Zone.from_file(path), path, snapshot)
+    index.save(snapshot)
+    return index
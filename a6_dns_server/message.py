@@ -0,0 +1,492 @@
+import struct
+from typing import Iterator
+
+# Resource record types
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_PTR = 12
+TYPE_MX = 15
+TYPE_TXT = 16
+TYPE_AAAA = 28
+TYPE_SRV = 33
+TYPE_OPT = 41
+TYPE_ANY = 255
+
+TYPES: dict[str, int] = {
+    "A": TYPE_A, "NS": TYPE_NS, "CNAME": TYPE_CNAME, "SOA": TYPE_SOA, "PTR": TYPE_PTR, "MX": TYPE_MX,
+    "TXT": TYPE_TXT, "AAAA": TYPE_AAAA, "SRV": TYPE_SRV, "OPT": TYPE_OPT, "ANY": TYPE_ANY,
+}
+
+CLASS_IN = 1
+
+# Header flags
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+OPCODE_MASK = 0x7800
+
+# Response codes
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+# Extended response codes need the upper eight bits in the OPT record (RFC 6891)
+RCODE_BADVERS = 16
+
+# Section indices for MessageWriter
+ANSWER = 0
+AUTHORITY = 1
+ADDITIONAL = 2
+
+HEADER = struct.Struct("!HHHHHH")
+QUESTION = struct.Struct("!HH")
+# Type, class, TTL and RDLENGTH of a resource record
+RR_FIXED = struct.Struct("!HHIH")
+# Largest UDP response without EDNS0 (RFC 1035)
+MAX_UDP_SIZE = 512
+# The EDNS0 UDP payload size advertised, small enough to avoid IP fragmentation on common paths
+EDNS_UDP_SIZE = 1232
+MAX_MESSAGE_SIZE = 65535
+MAX_NAME_LENGTH = 255
+# Pointer to the question name, which always starts right after the header
+QNAME_POINTER = b"\xc0\x0c"
+# An OPT pseudo-record: root owner name, type, UDP payload size, extended rcode/version/flags, RDLENGTH
+OPT = struct.Struct("!BHHIH")
+
+
+class FormatError(ValueError):
+    """
+    Raised when a message cannot be parsed.
+    """
+
+
+class Query:
+    """
+    The parts of a query a server needs to answer it. The name is copied out of the packet
+    once, in wire format; `key` is its lower-cased form used for every lookup. Queries with an
+    OPT record carry their EDNS version and the UDP payload size the client accepts.
+    """
+
+    __slots__ = ("id", "flags", "qname", "key", "qtype", "qclass", "end", "edns_version", "udp_size")
+
+    def __init__(self, ident: int, flags: int, qname: bytes, qtype: int, qclass: int, end: int,
+                 edns_version: int | None = None, udp_size: int = MAX_UDP_SIZE) -> None:
+        self.id: int = ident
+        self.flags: int = flags
+        self.qname: bytes = qname
+        self.key: bytes = qname.lower()
+        self.qtype: int = qtype
+        self.qclass: int = qclass
+        # Offset of the first byte after the question section
+        self.end: int = end
+        self.edns_version: int | None = edns_version
+        self.udp_size: int = udp_size
+
+    @property
+    def opcode(self) -> int:
+        return (self.flags & OPCODE_MASK) >> 11
+
+
+def skip_name(packet: bytes | memoryview, offset: int) -> int:
+    """
+    :param packet: A DNS message.
+    :param offset: The offset of a possibly compressed name.
+    :return: The offset just after the name as it is stored at `offset`.
+    :raises FormatError: If the name runs past the end of the packet.
+    """
+    try:
+        while True:
+            length = packet[offset]
+            if length == 0:
+                return offset + 1
+            if length & 0xC0:
+                return offset + 2
+            offset += length + 1
+    except IndexError:
+        raise FormatError("Name runs past the end of the message") from None
+
+
+def read_name(packet: bytes | memoryview, offset: int) -> tuple[bytes, int]:
+    """
+    Read a name, following compression pointers.
+    :param packet: A DNS message.
+    :param offset: The offset of the name.
+    :return: The uncompressed name in wire format and the offset just after it.
+    :raises FormatError: If the name is malformed, too long or has a pointer loop.
+    """
+    labels = bytearray()
+    end = None
+    jumps = 0
+    try:
+        while True:
+            length = packet[offset]
+            if length == 0:
+                break
+            if length & 0xC0 == 0xC0:
+                if end is None:
+                    end = offset + 2
+                jumps += 1
+                if jumps > 64:
+                    raise FormatError("Compression pointer loop")
+                offset = ((length & 0x3F) << 8) | packet[offset + 1]
+                continue
+            if length & 0xC0:
+                raise FormatError(f"Unsupported label type {length:#x}")
+            labels += packet[offset:offset + length + 1]
+            offset += length + 1
+            if len(labels) >= MAX_NAME_LENGTH:
+                raise FormatError("Name too long")
+    except IndexError:
+        raise FormatError("Name runs past the end of the message") from None
+    labels.append(0)
+    return bytes(labels), (offset + 1 if end is None else end)
+
+
+def parse_query(packet: bytes | memoryview) -> Query:
+    """
+    Parse the header and question of a query without copying the packet; only the name is
+    copied out.
+    :param packet: The received datagram or TCP message.
+    :return: The query.
+    :raises FormatError: If the packet is not a well-formed single-question query.
+    """
+    if len(packet) < HEADER.size:
+        raise FormatError("Message shorter than a header")
+    ident, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(packet)
+    if flags & FLAG_QR:
+        raise FormatError("Not a query")
+    if qdcount != 1:
+        raise FormatError(f"Expected one question, got {qdcount}")
+    offset = HEADER.size
+    try:
+        while True:
+            length = packet[offset]
+            if length == 0:
+                break
+            if length & 0xC0:
+                # Nothing precedes the question that a pointer could refer to
+                raise FormatError("Compressed or extended label in question")
+            offset += length + 1
+    except IndexError:
+        raise FormatError("Question runs past the end of the message") from None
+    offset += 1
+    if offset - HEADER.size > MAX_NAME_LENGTH or offset + QUESTION.size > len(packet):
+        raise FormatError("Malformed question")
+    qtype, qclass = QUESTION.unpack_from(packet, offset)
+    end = offset + QUESTION.size
+    query = Query(ident, flags, bytes(packet[HEADER.size:offset]), qtype, qclass, end)
+    if arcount:
+        _parse_opt(packet, end, ancount + nscount, arcount, query)
+    return query
+
+
+def _parse_opt(packet: bytes | memoryview, offset: int, skip: int, count: int, query: Query) -> None:
+    """
+    Find the OPT record among the additional records of a query and store its EDNS version and
+    UDP payload size in the query.
+    :param skip: The number of answer and authority records before the additional records.
+    :param count: The number of additional records.
+    """
+    for index in range(skip + count):
+        start = offset
+        fixed = skip_name(packet, offset)
+        if fixed + RR_FIXED.size > len(packet):
+            raise FormatError("Record runs past the end of the message")
+        rtype, rclass, ttl, length = RR_FIXED.unpack_from(packet, fixed)
+        offset = fixed + RR_FIXED.size + length
+        if offset > len(packet):
+            raise FormatError("Record data runs past the end of the message")
+        if rtype == TYPE_OPT and index >= skip:
+            if query.edns_version is not None or packet[start] != 0:
+                raise FormatError("Duplicate OPT record or OPT record not owned by the root")
+            query.edns_version = (ttl >> 16) & 0xFF
+            query.udp_size = max(MAX_UDP_SIZE, rclass)
+
+
+def iter_records(packet: bytes | memoryview) -> Iterator[tuple[int, int, int, int, int, int]]:
+    """
+    Walk the resource records of a message without decoding their names or data.
+    :param packet: A DNS message.
+    :return: For every record: its section, the offset of its TYPE field, its type, TTL, the
+        offset of its RDATA and the RDATA length.
+    :raises FormatError: If the message is truncated or malformed.
+    """
+    if len(packet) < HEADER.size:
+        raise FormatError("Message shorter than a header")
+    _, _, qdcount, ancount, nscount, arcount = HEADER.unpack_from(packet)
+    offset = HEADER.size
+    for _ in range(qdcount):
+        offset = skip_name(packet, offset) + QUESTION.size
+    for section, count in ((ANSWER, ancount), (AUTHORITY, nscount), (ADDITIONAL, arcount)):
+        for _ in range(count):
+            fixed = skip_name(packet, offset)
+            if fixed + RR_FIXED.size > len(packet):
+                raise FormatError("Record runs past the end of the message")
+            rtype, _, ttl, length = RR_FIXED.unpack_from(packet, fixed)
+            offset = fixed + RR_FIXED.size + length
+            if offset > len(packet):
+                raise FormatError("Record data runs past the end of the message")
+            yield section, fixed, rtype, ttl, fixed + RR_FIXED.size, length
+
+
+def strip_opt(packet: bytes | memoryview) -> bytes:
+    """
+    :param packet: A DNS message.
+    :return: The message without its OPT record, which only applies to a single hop.
+    :raises FormatError: If the message is malformed.
+    """
+    message = bytes(packet)
+    for section, fixed, rtype, _, rdata, length in iter_records(message):
+        if section == ADDITIONAL and rtype == TYPE_OPT and message[fixed - 1] == 0:
+            arcount = struct.unpack_from("!H", message, 10)[0] - 1
+            return message[:10] + struct.pack("!H", arcount) + message[12:fixed - 1] + message[rdata + length:]
+    return message
+
+
+def name_to_wire(name: str) -> bytes:
+    """
+    :param name: A domain name in presentation format, e.g. "www.example.com." ("." is the root).
+    :return: The name in wire format.
+    :raises ValueError: If a label is empty or longer than 63 bytes, or the name is too long.
+    """
+    name = name.rstrip(".")
+    wire = bytearray()
+    if name:
+        for label in name.split("."):
+            encoded = label.encode("ascii")
+            if not 0 < len(encoded) < 64:
+                raise ValueError(f"Invalid label {label!r} in {name!r}")
+            wire.append(len(encoded))
+            wire += encoded
+    wire.append(0)
+    if len(wire) > MAX_NAME_LENGTH:
+        raise ValueError(f"Name too long: {name!r}")
+    return bytes(wire)
+
+
+def wire_to_name(wire: bytes) -> str:
+    """
+    :param wire: An uncompressed name in wire format.
+    :return: The name in presentation format, with a trailing dot.
+    """
+    labels = []
+    offset = 0
+    while wire[offset]:
+        length = wire[offset]
+        labels.append(wire[offset + 1:offset + 1 + length].decode("ascii", "backslashreplace"))
+        offset += length + 1
+    return ".".join(labels) + "."
+
+
+def build_query(ident: int, name: bytes, qtype: int, qclass: int = CLASS_IN, recursion: bool = True,
+                udp_size: int = 0) -> bytes:
+    """
+    :param ident: The transaction ID.
+    :param name: The name in wire format.
+    :param qtype: The query type.
+    :param qclass: The query class.
+    :param recursion: Whether to set the RD flag.
+    :param udp_size: The EDNS0 UDP payload size to advertise, or 0 to send no OPT record.
+    :return: A query message.
+    """
+    message = (HEADER.pack(ident, FLAG_RD if recursion else 0, 1, 0, 0, 1 if udp_size else 0) + name
+               + QUESTION.pack(qtype, qclass))
+    if udp_size:
+        message += OPT.pack(0, TYPE_OPT, udp_size, 0, 0)
+    return message
+
+
+class MessageWriter:
+    """
+    Builds responses in one preallocated buffer that is reused for every message. finish()
+    returns a view of the buffer, valid until the next begin(), so a response can be sent
+    without copying it.
+
+    Owner names are compressed against every name already written, starting with the question
+    name at offset 12. Record data is written as given. When a record would push the message
+    past the size limit, the records are dropped and the TC bit is set, telling the client to
+    retry over TCP. Responses to queries with an OPT record get one too, advertising
+    `udp_size`; room for it is kept free below the limit.
+    """
+
+    def __init__(self, size: int = MAX_MESSAGE_SIZE, udp_size: int = EDNS_UDP_SIZE) -> None:
+        self.buffer: bytearray = bytearray(size)
+        self.view: memoryview = memoryview(self.buffer)
+        self.pos: int = 0
+        self.limit: int = size
+        self.question_end: int = 0
+        self.flags: int = 0
+        self.id: int = 0
+        self.counts: list[int] = [0, 0, 0]
+        self.section: int = ANSWER
+        self.truncated: bool = False
+        self.names: dict[bytes, int] = {}
+        self.udp_size: int = udp_size
+        self.edns: bool = False
+        self.extended_rcode: int = 0
+
+    def begin(self, query: Query, flags: int, rcode: int = RCODE_NOERROR, limit: int = MAX_MESSAGE_SIZE) -> None:
+        """
+        Start a response that echoes the question of a query.
+        :param query: The query to answer.
+        :param flags: Flags besides QR, the opcode and RD, which are always set or copied.
+        :param rcode: The response code.
+        :param limit: The largest message the client accepts.
+        """
+        self.id = query.id
+        self.flags = FLAG_QR | (query.flags & (OPCODE_MASK | FLAG_RD)) | flags | (rcode & 0x000F)
+        self.extended_rcode = rcode >> 4
+        self.edns = query.edns_version is not None
+        pos = HEADER.size
+        end = pos + len(query.qname)
+        self.buffer[pos:end] = query.qname
+        QUESTION.pack_into(self.buffer, end, query.qtype, query.qclass)
+        self.pos = self.question_end = end + QUESTION.size
+        self.limit = min(limit, len(self.buffer)) - (OPT.size if self.edns else 0)
+        self.counts[0] = self.counts[1] = self.counts[2] = 0
+        self.section = ANSWER
+        self.truncated = False
+        self.names = {query.key: HEADER.size}
+
+    def load(self, message: bytes, query: Query, limit: int = MAX_MESSAGE_SIZE) -> memoryview:
+        """
+        Copy a complete response without an OPT record, such as a cached one, so it can be
+        patched in place. A response too large for the limit is cut down to its question with
+        the TC bit set, and an OPT record is added if the query had one.
+        :param message: The response in wire format.
+        :param query: The query to answer, whose question the response echoes.
+        :param limit: The largest response the client accepts.
+        :return: A view of the copy, valid until the next message is started.
+        """
+        buffer = self.buffer
+        opt = OPT.size if query.edns_version is not None else 0
+        size = len(message)
+        if size + opt > min(limit, len(buffer)):
+            size = HEADER.size + len(query.qname) + QUESTION.size
+            buffer[:size] = message[:size]
+            buffer[2] |= FLAG_TC >> 8
+            buffer[6:12] = bytes(6)
+        else:
+            buffer[:size] = message
+        if opt:
+            OPT.pack_into(buffer, size, 0, TYPE_OPT, self.udp_size, 0, 0)
+            buffer[10:12] = struct.pack("!H", struct.unpack_from("!H", buffer, 10)[0] + 1)
+            size += opt
+        self.pos = size
+        return self.view[:size]
+
+    def begin_header_only(self, ident: int, flags: int, rcode: int) -> None:
+        """
+        Start a response without a question, for queries too malformed to echo.
+        """
+        self.id = ident
+        self.flags = FLAG_QR | (flags & (OPCODE_MASK | FLAG_RD)) | rcode
+        self.extended_rcode = 0
+        self.edns = False
+        self.pos = self.question_end = HEADER.size
+        self.limit = len(self.buffer)
+        self.counts[0] = self.counts[1] = self.counts[2] = 0
+        self.section = ANSWER
+        self.truncated = False
+        self.names = {}
+
+    def set_rcode(self, rcode: int) -> None:
+        self.flags = (self.flags & ~0x000F) | (rcode & 0x000F)
+        self.extended_rcode = rcode >> 4
+
+    def write_name(self, name: bytes) -> None:
+        """
+        Write an owner name, replacing its longest suffix already in the message by a pointer.
+        :param name: The name in wire format.
+        """
+        key = name.lower()
+        names = self.names
+        offset = 0
+        while name[offset]:
+            pointer = names.get(key[offset:])
+            if pointer is not None:
+                break
+            if self.pos + offset < 0x4000:
+                names[key[offset:]] = self.pos + offset
+            offset += name[offset] + 1
+        else:
+            pointer = None
+        if pointer is None:
+            end = self.pos + len(name)
+            self.buffer[self.pos:end] = name
+        else:
+            end = self.pos + offset + 2
+            self.buffer[self.pos:end - 2] = name[:offset]
+            self.buffer[end - 2] = 0xC0 | (pointer >> 8)
+            self.buffer[end - 1] = pointer & 0xFF
+        self.pos = end
+
+    def add(self, section: int, name: bytes, rtype: int, rclass: int, ttl: int, rdata: bytes) -> bool:
+        """
+        Append a resource record. Sections must be filled in order.
+        :return: False if the record did not fit and the message was truncated.
+        """
+        if self.truncated:
+            return False
+        if section < self.section:
+            raise ValueError("Records must be added section by section")
+        self.section = section
+        start = self.pos
+        if start + len(name) + RR_FIXED.size + len(rdata) > self.limit:
+            self._truncate()
+            return False
+        self.write_name(name)
+        RR_FIXED.pack_into(self.buffer, self.pos, rtype, rclass, ttl, len(rdata))
+        self.pos += RR_FIXED.size
+        self.buffer[self.pos:self.pos + len(rdata)] = rdata
+        self.pos += len(rdata)
+        self.counts[section] += 1
+        return True
+
+    def add_raw(self, data: bytes | memoryview, counts: tuple[int, int, int]) -> bool:
+        """
+        Append pre-encoded records, whose names may only point into the question or into the
+        records themselves, after any records written so far.
+        :param data: The encoded records, section by section.
+        :param counts: The number of records in `data` per section.
+        :return: False if the records did not fit and the message was truncated.
+        """
+        if self.truncated:
+            return False
+        end = self.pos + len(data)
+        if end > self.limit:
+            self._truncate()
+            return False
+        self.buffer[self.pos:end] = data
+        self.pos = end
+        for section in (ANSWER, AUTHORITY, ADDITIONAL):
+            if counts[section]:
+                self.counts[section] += counts[section]
+                self.section = section
+        return True
+
+    def _truncate(self) -> None:
+        self.truncated = True
+        self.flags |= FLAG_TC
+        self.pos = self.question_end
+        self.counts[0] = self.counts[1] = self.counts[2] = 0
+
+    def finish(self) -> memoryview:
+        """
+        :return: The complete message, as a view of the writer's buffer.
+        """
+        end = self.pos
+        additional = self.counts[ADDITIONAL]
+        if self.edns:
+            OPT.pack_into(self.buffer, end, 0, TYPE_OPT, self.udp_size, self.extended_rcode << 24, 0)
+            end += OPT.size
+            additional += 1
+        HEADER.pack_into(self.buffer, 0, self.id, self.flags, 1 if self.question_end > HEADER.size else 0,
+                         self.counts[ANSWER], self.counts[AUTHORITY], additional)
+        return self.view[:end]
@@ -0,0 +1,678 @@
+import functools
+import logging
+import os
+import random
+import selectors
+import signal
+import socket
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+from a6_dns_server.cache import AnswerCache, CacheKey
+from a6_dns_server.index import CompiledZone
+from a6_dns_server.message import (CLASS_IN, EDNS_UDP_SIZE, FLAG_AA, FLAG_QR, FLAG_RA, FLAG_RD, FLAG_TC, HEADER,
+                                   MAX_MESSAGE_SIZE, RCODE_BADVERS, RCODE_FORMERR, RCODE_NOTIMP, RCODE_REFUSED,
+                                   RCODE_SERVFAIL, FormatError, MessageWriter, Query, build_query, parse_query,
+                                   strip_opt, wire_to_name)
+from a6_dns_server.zone import ZoneError
+from lab_common.metrics import Exporter, Metrics, worker_address
+
+logger = logging.getLogger(__name__)
+
+# Datagrams read per readable event before other sockets get a turn
+RECV_BATCH = 64
+UPSTREAM_TIMEOUT = 2.0
+MAX_PENDING = 16384
+SOCKET_BUFFER_SIZE = 1 << 20
+# Longest wait in select(), so that a reload requested by a signal is not delayed for long
+POLL_INTERVAL = 1.0
+ID = struct.Struct("!H")
+# DNS over TCP prefixes every message with its length (RFC 1035 section 4.2.2)
+LENGTH = struct.Struct("!H")
+TCP_BACKLOG = 128
+TCP_RECV_SIZE = 65536
+TCP_IDLE_TIMEOUT = 10.0
+MAX_TCP_CONNECTIONS = 1024
+# Queued output beyond which no further queries are read from a connection until it drains
+OUTBUF_HIGH_WATER = 256 * 1024
+
+
+class TCPConnection:
+    """
+    A DNS over TCP client connection (RFC 7766). The client may send any number of queries
+    without waiting for answers; each answer is queued as soon as it is ready, so an answer
+    that has to come from upstream can follow the answers to later queries.
+    """
+
+    __slots__ = ("sock", "address", "inbuf", "outbuf", "outstanding", "last_active", "eof", "closed", "events")
+
+    def __init__(self, sock: socket.socket, address, now: float) -> None:
+        self.sock: socket.socket = sock
+        self.address = address
+        self.inbuf: bytearray = bytearray()
+        self.outbuf: bytearray = bytearray()
+        # Queries waiting for an upstream answer
+        self.outstanding: int = 0
+        self.last_active: float = now
+        self.eof: bool = False
+        self.closed: bool = False
+        self.events: int = selectors.EVENT_READ
+
+
+class Inflight:
+    """
+    A question sent upstream, with every client waiting for its answer.
+    """
+
+    __slots__ = ("key", "ident", "waiters", "deadline")
+
+    def __init__(self, key: CacheKey, ident: int, deadline: float) -> None:
+        self.key: CacheKey = key
+        self.ident: int = ident
+        # The clients, their queries and the largest response each accepts
+        self.waiters: list[tuple[object, Query, int]] = []
+        self.deadline: float = deadline
+
+
+class DNSServer:
+    """
+    Authoritative and forwarding DNS server on non-blocking UDP and TCP sockets.
+
+    Every readable event drains up to RECV_BATCH datagrams with recvfrom_into() into one
+    preallocated buffer, and every response is built by one reused MessageWriter, so the hot
+    path allocates little more than the parsed query. UDP responses are limited to 512 bytes,
+    or to the EDNS0 payload size of the client up to `max_udp_size`; larger ones are truncated
+    and the client retries over TCP, where connections stay open for further queries.
+
+    Queries for names in a loaded zone are answered authoritatively from its compiled index,
+    which holds every response ready to be copied into the writer; reload() brings the zones
+    up to date with their files. Others are resolved through the upstream resolver, if one is
+    set, or refused. Upstream answers are kept in an AnswerCache and served from it, with the
+    transaction ID and flags of the client patched in, until their TTL runs out. Identical
+    questions arriving while one is outstanding upstream wait for that answer instead of
+    being sent again. With `reuse_port` several processes bind the same port and the kernel
+    spreads datagrams and connections over them. With `metrics`, the counters are collected
+    into it, and query handling, zone answers and cache lookups are timed.
+    """
+
+    def __init__(self, host: str, port: int, zones: list[CompiledZone] | None = None,
+                 upstream: tuple[str, int] | None = None, reuse_port: bool = False,
+                 cache_size: int = 10000, max_ttl: int = 86400, max_udp_size: int = EDNS_UDP_SIZE,
+                 metrics: Metrics | None = None) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.zones: dict[bytes, CompiledZone] = {zone.origin: zone for zone in zones or []}
+        self.upstream_address: tuple[str, int] | None = upstream
+        self.reuse_port: bool = reuse_port
+        self.max_udp_size: int = max_udp_size
+        self.selector: selectors.BaseSelector = selectors.DefaultSelector()
+        self.udp: socket.socket | None = None
+        self.tcp: socket.socket | None = None
+        self.upstream: socket.socket | None = None
+        # TCP connections, least recently active first
+        self.connections: OrderedDict[TCPConnection, None] = OrderedDict()
+        self.recv_buffer: bytearray = bytearray(MAX_MESSAGE_SIZE)
+        self.recv_view: memoryview = memoryview(self.recv_buffer)
+        self.writer: MessageWriter = MessageWriter(udp_size=max_udp_size)
+        self.cache: AnswerCache | None = AnswerCache(cache_size, max_ttl) if cache_size > 0 else None
+        # Questions outstanding upstream, by upstream transaction ID in deadline order and by key
+        self.pending: OrderedDict[int, Inflight] = OrderedDict()
+        self.inflight: dict[CacheKey, Inflight] = {}
+        # Monotonic time of the last wakeup, precise enough for deadlines and TTLs
+        self.now: float = time.monotonic()
+        self.reload_requested: bool = False
+        self.counters: dict[str, int] = {
+            "queries": 0, "tcp_queries": 0, "answered": 0, "cache_hits": 0, "coalesced": 0, "forwarded": 0,
+            "relayed": 0, "timeouts": 0, "malformed": 0, "truncated": 0, "tcp_accepted": 0,
+        }
+        if metrics is not None:
+            metrics.collect(self.stats, counters=[*self.counters, "hits", "misses", "expirations", "evictions"])
+            metrics.instrument(self, {"_on_udp": "udp_batch", "handle": "query", "answer": "answer",
+                                      "_on_upstream": "upstream", "_flush": "tcp_send"})
+            if self.cache is not None:
+                metrics.instrument(self.cache, {"get": "cache_lookup"})
+
+    def bind(self) -> None:
+        """
+        Create the UDP socket, the TCP listener, and the socket to the upstream resolver if one
+        is set.
+        """
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                udp.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+            except OSError:
+                pass
+        udp.bind((self.host, self.port))
+        udp.setblocking(False)
+        self.selector.register(udp, selectors.EVENT_READ, self._on_udp)
+        self.udp = udp
+        tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        tcp.bind((self.host, self.port))
+        tcp.listen(TCP_BACKLOG)
+        tcp.setblocking(False)
+        self.selector.register(tcp, selectors.EVENT_READ, self._on_accept)
+        self.tcp = tcp
+        if self.upstream_address is not None:
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            upstream.connect(self.upstream_address)
+            upstream.setblocking(False)
+            self.selector.register(upstream, selectors.EVENT_READ, self._on_upstream)
+            self.upstream = upstream
+        logger.info("Serving DNS on %s:%d (%d zones, upstream %s)", self.host, self.port, len(self.zones),
+                    "%s:%d" % self.upstream_address if self.upstream_address else "none")
+
+    def serve_forever(self) -> None:
+        """
+        Run the event loop until interrupted.
+        """
+        if self.udp is None:
+            self.bind()
+        try:
+            while True:
+                timeout = POLL_INTERVAL
+                if self.pending:
+                    timeout = min(timeout, max(0.0, next(iter(self.pending.values())).deadline - self.now))
+                events = self.selector.select(timeout)
+                self.now = time.monotonic()
+                for key, mask in events:
+                    key.data(mask)
+                if self.pending:
+                    self._expire_pending()
+                if self.connections:
+                    self._expire_idle()
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+        finally:
+            self.shutdown()
+
+    def request_reload(self) -> None:
+        """
+        Reload the zones at the next iteration of the event loop. Safe to call from a signal
+        handler.
+        """
+        self.reload_requested = True
+
+    def reload(self) -> None:
+        """
+        Bring every zone up to date with its file. A zone that fails to load keeps being served
+        as it was.
+        """
+        for origin, zone in list(self.zones.items()):
+            try:
+                self.zones[origin] = zone.reload()
+            except (OSError, ZoneError) as e:
+                logger.error("Failed to reload zone %s: %s", wire_to_name(origin), e)
+
+    def shutdown(self) -> None:
+        """
+        Close the sockets and connections.
+        """
+        for conn in list(self.connections):
+            self._close(conn)
+        for sock in (self.udp, self.tcp, self.upstream):
+            if sock is not None:
+                self.selector.unregister(sock)
+                sock.close()
+        self.udp = self.tcp = self.upstream = None
+        self.selector.close()
+        logger.info("Statistics: %s", self.stats())
+
+    def stats(self) -> dict[str, int | dict]:
+        """
+        :return: Query and cache counters of this process.
+        """
+        stats: dict[str, int | dict] = {**self.counters, "pending": len(self.pending),
+                                        "tcp_connections": len(self.connections)}
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def _on_udp(self, mask: int) -> None:
+        udp = self.udp
+        for _ in range(RECV_BATCH):
+            try:
+                size, address = udp.recvfrom_into(self.recv_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # E.g. ICMP port unreachable reported for an earlier response
+                logger.debug("Receive failed: %s", e)
+                continue
+            self.counters["queries"] += 1
+            response = self.handle(self.recv_view[:size], address)
+            if response is not None:
+                if response[2] & (FLAG_TC >> 8):
+                    self.counters["truncated"] += 1
+                try:
+                    udp.sendto(response, address)
+                except OSError as e:
+                    logger.debug("Failed to answer %s: %s", address, e)
+
+    def handle(self, packet: memoryview, address, stream: bool = False) -> memoryview | None:
+        """
+        Answer one query.
+        :param packet: The received message.
+        :param address: The client address, or its TCPConnection, needed when the query is
+            forwarded.
+        :param stream: Whether the query came over TCP, which takes responses of any size.
+        :return: The response to send, a view of the writer's buffer, or None if there is
+            nothing to send now.
+        """
+        writer = self.writer
+        try:
+            query = parse_query(packet)
+        except FormatError:
+            self.counters["malformed"] += 1
+            if len(packet) < HEADER.size:
+                return None
+            ident, flags = struct.unpack_from("!HH", packet)
+            if flags & FLAG_QR:
+                # Never answer responses, or two servers could bounce messages forever
+                return None
+            writer.begin_header_only(ident, flags, RCODE_FORMERR)
+            return writer.finish()
+        ra = FLAG_RA if self.upstream is not None else 0
+        if query.edns_version:
+            # Only EDNS version 0 exists (RFC 6891 section 6.1.3)
+            writer.begin(query, ra, RCODE_BADVERS)
+            return writer.finish()
+        if query.opcode != 0:
+            writer.begin(query, ra, RCODE_NOTIMP)
+            return writer.finish()
+        if query.qclass != CLASS_IN:
+            writer.begin(query, ra, RCODE_REFUSED)
+            return writer.finish()
+
+        limit = MAX_MESSAGE_SIZE if stream else min(query.udp_size, self.max_udp_size)
+        zone = self.find_zone(query.key)
+        if zone is not None:
+            self.counters["answered"] += 1
+            return self.answer(query, zone, limit)
+        if self.upstream is not None:
+            return self.resolve(query, address, limit)
+        writer.begin(query, ra, RCODE_REFUSED)
+        return writer.finish()
+
+    def find_zone(self, key: bytes) -> CompiledZone | None:
+        """
+        :param key: A lower-cased name in wire format.
+        :return: The most specific loaded zone containing the name, or None.
+        """
+        zones = self.zones
+        if not zones:
+            return None
+        offset = 0
+        while True:
+            zone = zones.get(key[offset:])
+            if zone is not None:
+                return zone
+            if not key[offset]:
+                return None
+            offset += key[offset] + 1
+
+    def answer(self, query: Query, zone: CompiledZone, limit: int) -> memoryview:
+        """
+        Build an authoritative response, or a referral, from a zone.
+        :param query: The query.
+        :param zone: The zone containing the query name.
+        :param limit: The largest response the client accepts.
+        :return: The response.
+        """
+        return zone.lookup(query.key, query.qtype).write(self.writer, query,
+                                                         FLAG_RA if self.upstream is not None else 0, limit)
+
+    def resolve(self, query: Query, address, limit: int) -> memoryview | None:
+        """
+        Answer a query from the cache, or wait for the upstream answer to it.
+        :param query: The query.
+        :param address: The client to send the answer to once it arrives.
+        :param limit: The largest response the client accepts.
+        :return: The cached response, or None if the answer comes from upstream later.
+        """
+        key = (query.key, query.qtype, query.qclass)
+        if self.cache is not None:
+            entry = self.cache.get(key, self.now)
+            if entry is not None:
+                self.counters["cache_hits"] += 1
+                response = self.writer.load(entry.render(self.now), query, limit)
+                self._address_to(response, query)
+                return response
+        inflight = self.inflight.get(key)
+        if inflight is None:
+            inflight = self.forward(query, key)
+            if inflight is None:
+                self.writer.begin(query, FLAG_RA, RCODE_SERVFAIL)
+                return self.writer.finish()
+        else:
+            self.counters["coalesced"] += 1
+        inflight.waiters.append((address, query, limit))
+        if isinstance(address, TCPConnection):
+            address.outstanding += 1
+        return None
+
+    def forward(self, query: Query, key: CacheKey) -> Inflight | None:
+        """
+        Send a question to the upstream resolver under a fresh random transaction ID.
+        :param query: The query asking the question. Its name is sent with the client's
+            capitalisation, which the answer echoes. The question is sent with an OPT record,
+            so that large answers are not truncated on the way.
+        :param key: The question.
+        :return: The outstanding question, or None if it could not be sent.
+        """
+        if len(self.pending) >= MAX_PENDING:
+            return None
+        ident = random.getrandbits(16)
+        while ident in self.pending:
+            ident = random.getrandbits(16)
+        try:
+            self.upstream.send(build_query(ident, query.qname, query.qtype, query.qclass,
+                                           udp_size=self.max_udp_size))
+        except OSError as e:
+            logger.warning("Failed to forward query: %s", e)
+            return None
+        inflight = Inflight(key, ident, self.now + UPSTREAM_TIMEOUT)
+        self.pending[ident] = inflight
+        self.inflight[key] = inflight
+        self.counters["forwarded"] += 1
+        return inflight
+
+    def _on_upstream(self, mask: int) -> None:
+        buffer, view = self.recv_buffer, self.recv_view
+        for _ in range(RECV_BATCH):
+            try:
+                size = self.upstream.recv_into(buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.debug("Upstream receive failed: %s", e)
+                continue
+            if size < HEADER.size:
+                continue
+            response = view[:size]
+            inflight = self.pending.get(ID.unpack_from(buffer)[0])
+            if inflight is None or not self._matches(response, inflight.key):
+                continue
+            del self.pending[inflight.ident]
+            del self.inflight[inflight.key]
+            self.counters["relayed"] += 1
+            try:
+                # The OPT record of the upstream applies to this hop only; clients get their own
+                message = strip_opt(response)
+            except FormatError:
+                for address, query, _ in inflight.waiters:
+                    self._fail(address, query)
+                continue
+            if self.cache is not None:
+                self.cache.store(inflight.key, message, self.now)
+            for address, query, limit in inflight.waiters:
+                relayed = self.writer.load(message, query, limit)
+                self._address_to(relayed, query)
+                self._deliver(address, relayed)
+
+    @staticmethod
+    def _matches(response: memoryview, key: CacheKey) -> bool:
+        """
+        :return: Whether a response echoes the question, as a guard against spoofed or stale
+            answers.
+        """
+        name, qtype, qclass = key
+        end = HEADER.size + len(name)
+        if not response[2] & 0x80 or len(response) < end + 4:
+            return False
+        return (bytes(response[HEADER.size:end]).lower() == name
+                and struct.unpack_from("!HH", response, end) == (qtype, qclass))
+
+    @staticmethod
+    def _address_to(response: memoryview, query: Query) -> None:
+        """
+        Patch a response to the question of the query, from upstream or the cache, for the
+        client that sent the query: its transaction ID, its RD flag and the capitalisation of
+        its question name, which some clients randomise and check. The answer is not
+        authoritative coming from here, and recursion is available.
+        """
+        ID.pack_into(response, 0, query.id)
+        response[2] = response[2] & ~((FLAG_AA | FLAG_RD) >> 8) | (query.flags & FLAG_RD) >> 8
+        response[3] |= FLAG_RA
+        response[HEADER.size:HEADER.size + len(query.qname)] = query.qname
+
+    def _expire_pending(self) -> None:
+        now = self.now
+        while self.pending:
+            ident, inflight = next(iter(self.pending.items()))
+            if inflight.deadline > now:
+                return
+            del self.pending[ident]
+            del self.inflight[inflight.key]
+            self.counters["timeouts"] += 1
+            for address, query, _ in inflight.waiters:
+                self._fail(address, query)
+
+    def _fail(self, address, query: Query) -> None:
+        self.writer.begin(query, FLAG_RA, RCODE_SERVFAIL)
+        self._deliver(address, self.writer.finish())
+
+    def _deliver(self, address, response: memoryview) -> None:
+        """
+        Send the answer to a query that waited for the upstream resolver.
+        :param address: The UDP client address or the TCPConnection the query came from.
+        :param response: The response.
+        """
+        if isinstance(address, TCPConnection):
+            address.outstanding -= 1
+            if not address.closed:
+                self._queue(address, response)
+                self._flush(address)
+            return
+        if response[2] & (FLAG_TC >> 8):
+            self.counters["truncated"] += 1
+        try:
+            self.udp.sendto(response, address)
+        except OSError as e:
+            logger.debug("Failed to relay answer to %s: %s", address, e)
+
+    def _on_accept(self, mask: int) -> None:
+        for _ in range(RECV_BATCH):
+            try:
+                sock, address = self.tcp.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.warning("Failed to accept connection: %s", e)
+                return
+            if len(self.connections) >= MAX_TCP_CONNECTIONS:
+                # Make room by closing the connection that has been idle longest (RFC 7766 6.2.3)
+                self._close(next(iter(self.connections)))
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = TCPConnection(sock, address, self.now)
+            self.connections[conn] = None
+            self.selector.register(sock, selectors.EVENT_READ, functools.partial(self._on_tcp, conn))
+            self.counters["tcp_accepted"] += 1
+
+    def _on_tcp(self, conn: TCPConnection, mask: int) -> None:
+        if mask & selectors.EVENT_READ:
+            try:
+                data = conn.sock.recv(TCP_RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                self._close(conn)
+                return
+            if data is not None:
+                if data:
+                    conn.inbuf += data
+                    conn.last_active = self.now
+                    self.connections.move_to_end(conn)
+                else:
+                    conn.eof = True
+        self._process(conn)
+        self._flush(conn)
+
+    def _process(self, conn: TCPConnection) -> None:
+        """
+        Answer every complete query in the input of a connection, as long as the output queue
+        is not backed up.
+        """
+        inbuf = conn.inbuf
+        offset = 0
+        with memoryview(inbuf) as view:
+            while len(inbuf) - offset >= LENGTH.size and len(conn.outbuf) < OUTBUF_HIGH_WATER:
+                end = offset + LENGTH.size + LENGTH.unpack_from(inbuf, offset)[0]
+                if end > len(inbuf):
+                    break
+                self.counters["queries"] += 1
+                self.counters["tcp_queries"] += 1
+                response = self.handle(view[offset + LENGTH.size:end], conn, stream=True)
+                if response is not None:
+                    self._queue(conn, response)
+                offset = end
+        if offset:
+            del inbuf[:offset]
+
+    @staticmethod
+    def _queue(conn: TCPConnection, response: memoryview) -> None:
+        conn.outbuf += LENGTH.pack(len(response))
+        conn.outbuf += response
+
+    def _flush(self, conn: TCPConnection) -> None:
+        """
+        Send as much queued output as the socket takes, and watch the connection for what it
+        can do next: more input while its output is not backed up, and writability while
+        output is left. A connection is closed once the client has finished sending and every
+        answer is out.
+        """
+        if conn.closed:
+            return
+        if conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+                del conn.outbuf[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self._close(conn)
+                return
+        if conn.eof and not conn.outbuf and not conn.outstanding:
+            self._close(conn)
+            return
+        events = 0
+        if not conn.eof and len(conn.outbuf) < OUTBUF_HIGH_WATER:
+            events |= selectors.EVENT_READ
+        if conn.outbuf:
+            events |= selectors.EVENT_WRITE
+        if events != conn.events:
+            if not conn.events:
+                self.selector.register(conn.sock, events, functools.partial(self._on_tcp, conn))
+            elif not events:
+                # Only waiting for upstream answers
+                self.selector.unregister(conn.sock)
+            else:
+                self.selector.modify(conn.sock, events, functools.partial(self._on_tcp, conn))
+            conn.events = events
+
+    def _expire_idle(self) -> None:
+        deadline = self.now - TCP_IDLE_TIMEOUT
+        while self.connections:
+            conn = next(iter(self.connections))
+            if conn.last_active > deadline:
+                return
+            if conn.outstanding or conn.outbuf:
+                # Still busy; look again after another timeout
+                conn.last_active = self.now
+                self.connections.move_to_end(conn)
+                continue
+            self._close(conn)
+
+    def _close(self, conn: TCPConnection) -> None:
+        if conn.closed:
+            return
+        conn.closed = True
+        self.connections.pop(conn, None)
+        if conn.events:
+            self.selector.unregister(conn.sock)
+        conn.sock.close()
+
+
+def serve_workers(host: str, port: int, workers: int, zones: list[CompiledZone],
+                  upstream: tuple[str, int] | None, metrics_address: str | None = None, profile: str | None = None,
+                  **options) -> None:
+    """
+    Fork worker processes that each run a DNSServer on their own SO_REUSEPORT socket. The
+    zones are loaded once, before forking, and shared copy-on-write. SIGHUP is passed on to
+    the workers, which then reload the zones. If any worker exits the rest are stopped as well.
+    :param host: The host to listen at.
+    :param port: The port to listen at.
+    :param workers: The number of worker processes, typically one per core.
+    :param zones: The authoritative zones.
+    :param upstream: The resolver to forward other queries to, if any.
+    :param metrics_address: Where worker 0 serves its metrics; worker n at the port plus n, or
+                            at the socket path suffixed with ".n". No metrics if None.
+    :param profile: The file worker 0 writes its profile to; worker n appends ".n".
+    :param options: Further keyword arguments for every DNSServer, such as the cache size.
+    """
+    children: list[int] = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(_run_worker(host, port, worker_id, zones, upstream, options,
+                                 worker_address(metrics_address, worker_id),
+                                 f"{profile}.{worker_id}" if profile and worker_id else profile))
+        children.append(pid)
+
+    def forward_signal(signum, frame) -> None:
+        for child in children:
+            os.kill(child, signum)
+
+    signal.signal(signal.SIGHUP, forward_signal)
+    # Unwind on SIGTERM too, so that the workers are stopped and write their profiles
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        pid, status = os.wait()
+        logger.error("Worker %d exited with status %d, stopping", children.index(pid), status)
+        children.remove(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
+def _run_worker(host: str, port: int, worker_id: int, zones: list[CompiledZone], upstream: tuple[str, int] | None,
+                options: dict, metrics_address: str | None, profile: str | None) -> int:
+    metrics = Metrics("dns") if metrics_address else None
+    exporter = Exporter(metrics, metrics_address, profile)
+    if profile is None:
+        signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+    else:
+        # Unwind on SIGTERM, so that the profile is written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server = DNSServer(host, port, zones, upstream, reuse_port=True, metrics=metrics, **options)
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.request_reload())
+        exporter.start()
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        return 0
+    except Exception:
+        logger.exception("Worker %d crashed", worker_id)
+        return 1
+    finally:
+        exporter.close()
+    return 0
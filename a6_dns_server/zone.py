@@ -0,0 +1,262 @@
+import socket
+import struct
+
+from a6_dns_server.message import (CLASS_IN, TYPE_A, TYPE_AAAA, TYPE_CNAME, TYPE_MX, TYPE_NS, TYPE_PTR, TYPE_SOA,
+                                   TYPE_SRV, TYPE_TXT, TYPES, name_to_wire)
+
+DEFAULT_TTL = 3600
+
+
+class ZoneError(ValueError):
+    """
+    Raised when a zone file cannot be parsed.
+    """
+
+
+class Record:
+    """
+    A resource record with its owner name and RDATA in wire format. Names inside the RDATA are
+    stored uncompressed.
+    """
+
+    __slots__ = ("name", "rtype", "rclass", "ttl", "rdata")
+
+    def __init__(self, name: bytes, rtype: int, rclass: int, ttl: int, rdata: bytes) -> None:
+        self.name: bytes = name
+        self.rtype: int = rtype
+        self.rclass: int = rclass
+        self.ttl: int = ttl
+        self.rdata: bytes = rdata
+
+
+def _absolute(name: str, origin: str) -> str:
+    if name == "@":
+        return origin
+    if name.endswith("."):
+        return name
+    return f"{name}.{origin}" if origin != "." else f"{name}."
+
+
+def _character_string(text: str) -> bytes:
+    data = text.encode()
+    if len(data) > 255:
+        raise ZoneError(f"Character string longer than 255 bytes: {text!r}")
+    return bytes([len(data)]) + data
+
+
+def encode_rdata(rtype: int, fields: list[str], origin: str) -> bytes:
+    """
+    Convert the RDATA fields of a master file line to wire format.
+    :param rtype: The record type.
+    :param fields: The whitespace separated RDATA fields, quotes already removed for TXT.
+    :param origin: The origin relative names are completed with.
+    :return: The RDATA.
+    :raises ZoneError: If the type is unsupported or the fields do not match it.
+    """
+    try:
+        if rtype == TYPE_A:
+            return socket.inet_pton(socket.AF_INET, fields[0])
+        if rtype == TYPE_AAAA:
+            return socket.inet_pton(socket.AF_INET6, fields[0])
+        if rtype in (TYPE_NS, TYPE_CNAME, TYPE_PTR):
+            return name_to_wire(_absolute(fields[0], origin))
+        if rtype == TYPE_MX:
+            return struct.pack("!H", int(fields[0])) + name_to_wire(_absolute(fields[1], origin))
+        if rtype == TYPE_TXT:
+            return b"".join(_character_string(field) for field in fields)
+        if rtype == TYPE_SRV:
+            return (struct.pack("!HHH", int(fields[0]), int(fields[1]), int(fields[2]))
+                    + name_to_wire(_absolute(fields[3], origin)))
+        if rtype == TYPE_SOA:
+            return (name_to_wire(_absolute(fields[0], origin)) + name_to_wire(_absolute(fields[1], origin))
+                    + struct.pack("!IIIII", *(int(field) for field in fields[2:7])))
+    except (IndexError, ValueError, OSError) as e:
+        raise ZoneError(f"Invalid RDATA for type {rtype}: {' '.join(fields)}") from e
+    raise ZoneError(f"Unsupported record type {rtype}")
+
+
+def _tokens(line: str) -> list[str]:
+    """
+    Split a line into fields, keeping quoted strings (without the quotes) as one field and
+    dropping comments.
+    """
+    tokens: list[str] = []
+    current: list[str] = []
+    quoted = False
+    escaped = False
+    for char in line:
+        if quoted:
+            if escaped:
+                current.append(char)
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                tokens.append("".join(current))
+                current = []
+                quoted = False
+            else:
+                current.append(char)
+        elif char == '"':
+            quoted = True
+        elif char == ";":
+            break
+        elif char.isspace() or char in "()":
+            if current:
+                tokens.append("".join(current))
+                current = []
+            if char in "()":
+                tokens.append(char)
+        else:
+            current.append(char)
+    if quoted:
+        raise ZoneError(f"Unterminated string in {line!r}")
+    if current:
+        tokens.append("".join(current))
+    return tokens
+
+
+def parse_zone(text: str, origin: str = ".", default_ttl: int = DEFAULT_TTL) -> tuple[str, list[Record]]:
+    """
+    Parse the subset of the master file format (RFC 1035 section 5) used by simple zones:
+    $ORIGIN and $TTL, "@", relative names, omitted owner/TTL/class, parentheses spanning lines
+    and the types A, AAAA, NS, CNAME, PTR, MX, TXT, SRV and SOA.
+    :param text: The zone file contents.
+    :param origin: The initial origin.
+    :param default_ttl: The TTL used until a $TTL directive.
+    :return: The final origin and the records in file order.
+    :raises ZoneError: If a line cannot be parsed.
+    """
+    records: list[Record] = []
+    origin = origin if origin.endswith(".") else origin + "."
+    ttl = default_ttl
+    owner: str | None = None
+    pending: list[str] = []
+    depth = 0
+    owner_omitted = False
+
+    for number, line in enumerate(text.splitlines(), 1):
+        tokens = _tokens(line)
+        if depth == 0:
+            owner_omitted = bool(line) and line[0].isspace()
+        for token in tokens:
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+            else:
+                pending.append(token)
+        if depth > 0 or not pending:
+            continue
+        fields, pending = pending, []
+        try:
+            if fields[0] == "$ORIGIN":
+                origin = _absolute(fields[1], origin)
+                continue
+            if fields[0] == "$TTL":
+                ttl = int(fields[1])
+                continue
+            if not owner_omitted:
+                owner = _absolute(fields.pop(0), origin)
+            if owner is None:
+                raise ZoneError("Record without an owner name")
+            record_ttl, rclass = ttl, CLASS_IN
+            while fields and fields[0].upper() not in TYPES:
+                field = fields.pop(0)
+                if field.isdigit():
+                    record_ttl = int(field)
+                elif field.upper() != "IN":
+                    raise ZoneError(f"Unsupported class or type {field!r}")
+            rtype = TYPES[fields.pop(0).upper()]
+            records.append(Record(name_to_wire(owner), rtype, rclass, record_ttl,
+                                  encode_rdata(rtype, fields, origin)))
+        except (IndexError, ValueError) as e:
+            raise ZoneError(f"Line {number}: {e or 'incomplete record'}") from e
+    if depth:
+        raise ZoneError("Unbalanced parentheses")
+    return origin, records
+
+
+def load_zone(path: str, origin: str = ".") -> tuple[str, list[Record]]:
+    """
+    :param path: The zone file.
+    :param origin: The initial origin, used when the file has no $ORIGIN.
+    :return: The final origin and the records of the file.
+    """
+    with open(path) as file:
+        return parse_zone(file.read(), origin)
+
+
+class Zone:
+    """
+    The records of one authoritative zone, grouped by lower-cased owner name and type.
+    """
+
+    def __init__(self, origin: bytes, records: list[Record]) -> None:
+        self.origin: bytes = origin.lower()
+        self.rrsets: dict[bytes, dict[int, list[Record]]] = {}
+        # Every owner name and the empty non-terminals above it, which exist without records
+        self.names: set[bytes] = set()
+        # Names below the origin with NS records, where authority is delegated to other servers
+        self.delegations: set[bytes] = set()
+        soa: Record | None = None
+        for record in records:
+            key = record.name.lower()
+            if not self.contains(key):
+                raise ZoneError(f"Record outside of the zone: {record.name!r}")
+            self.rrsets.setdefault(key, {}).setdefault(record.rtype, []).append(record)
+            if record.rtype == TYPE_SOA and key == self.origin:
+                soa = record
+            elif record.rtype == TYPE_NS and key != self.origin:
+                self.delegations.add(key)
+            while key not in self.names and key != self.origin:
+                self.names.add(key)
+                key = key[key[0] + 1:]
+        if soa is None:
+            raise ZoneError("Zone has no SOA record at its origin")
+        self.names.add(self.origin)
+        # Negative answers are cached for the lesser of the SOA TTL and its MINIMUM (RFC 2308)
+        minimum = struct.unpack_from("!I", soa.rdata, len(soa.rdata) - 4)[0]
+        self.soa: Record = Record(soa.name, soa.rtype, soa.rclass, min(soa.ttl, minimum), soa.rdata)
+
+    @classmethod
+    def from_file(cls, path: str, origin: str = ".") -> "Zone":
+        origin, records = load_zone(path, origin)
+        soa = next((record for record in records if record.rtype == TYPE_SOA), None)
+        return cls(soa.name if soa is not None else name_to_wire(origin), records)
+
+    def contains(self, key: bytes) -> bool:
+        """
+        :param key: A lower-cased name in wire format.
+        :return: Whether the name is at or below the zone's origin.
+        """
+        offset = 0
+        while True:
+            if key[offset:] == self.origin:
+                return True
+            if not key[offset]:
+                return False
+            offset += key[offset] + 1
+
+    def delegation(self, key: bytes) -> bytes | None:
+        """
+        :param key: A lower-cased name in the zone, in wire format.
+        :return: The topmost delegation at or above the name, or None if the zone is
+            authoritative for it.
+        """
+        if not self.delegations:
+            return None
+        cut = None
+        while key != self.origin:
+            if key in self.delegations:
+                cut = key
+            key = key[key[0] + 1:]
+        return cut
+
+    def signature(self, key: bytes) -> frozenset:
+        """
+        :param key: A lower-cased name in wire format.
+        :return: A value equal for two zones exactly when they hold the same records at the name.
+        """
+        return frozenset((record.name, record.rtype, record.ttl, record.rdata)
+                         for rrset in self.rrsets.get(key, {}).values() for record in rrset)
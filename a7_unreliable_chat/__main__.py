@@ -1,12 +1,26 @@
+import os
+import sys
 from argparse import Namespace, ArgumentParser
 
+from a7_unreliable_chat.client import ChatClient
+from a7_unreliable_chat.transport import DEFAULT_RTO, DEFAULT_WINDOW
+from lab_common.metrics import Exporter, Metrics, parse_address
+
 
 def parse_arguments() -> Namespace:
     """
     Parse command line arguments for the unreliable chat client.
-    The three valid options are:
+    The valid options are:
         --address: The host to connect to. Default is "0.0.0.0"
         --port: The port to connect to. Default is 6778
+        --tcp: Talk to a line based TCP chat server, such as infrastructure/reliable_server,
+               instead of a UDP one
+        --window: The number of unacknowledged messages in flight per peer. Default is 32
+        --rto: The retransmission timeout in seconds until the RTT is measured. Default is 1.0
+        --metrics: Serve Prometheus metrics, including the RTT samples of every peer connection,
+                   at [host]:port or a Unix socket path. Default is none
+        --profile: Sample the stacks of the client and write them, folded for flame graphs, to
+                   this file on exit. Default is none
     :return: The parsed arguments in a Namespace object.
     """
 
@@ -19,12 +33,78 @@ def parse_arguments() -> Namespace:
                         type=str, help="Set server address", default="0.0.0.0")
     parser.add_argument("-p", "--port",
                         type=int, help="Set server port", default=6778)
+    parser.add_argument("--tcp", action="store_true",
+                        help="Connect to the server over TCP instead of UDP")
+    parser.add_argument("-w", "--window",
+                        type=int, help="Set the send window per peer", default=DEFAULT_WINDOW)
+    parser.add_argument("--rto",
+                        type=float, help="Set the initial retransmission timeout in seconds", default=DEFAULT_RTO)
+    parser.add_argument("--metrics",
+                        type=parse_address, help="Set the address serving Prometheus metrics")
+    parser.add_argument("--profile",
+                        type=str, help="Set the file the sampled stacks are written to")
 
     return parser.parse_args()
 
 
+def read_login() -> str | None:
+    """
+    Read one line from standard input without buffering beyond it, so the lines that follow
+    are left for the client's own reads of the file descriptor.
+    :return: The stripped line, or None at end of input.
+    """
+    line = bytearray()
+    while True:
+        byte = os.read(sys.stdin.fileno(), 1)
+        if not byte:
+            return line.decode("utf-8", "replace").strip() if line else None
+        if byte == b"\n":
+            return line.decode("utf-8", "replace").strip()
+        line += byte
+
+
 def main() -> None:
-    pass
+    args: Namespace = parse_arguments()
+
+    print("Welcome to Chat Client. Enter your login: ")
+    while True:
+        user_name = read_login()
+        if user_name is None or user_name == "!quit":
+            return
+        if not user_name or any(char in " !@#$%^&*," for char in user_name):
+            print(f"Cannot log in as {user_name}. That username contains disallowed characters.")
+            print("Enter your login:")
+            continue
+
+        metrics = Metrics("unreliable_chat") if args.metrics else None
+        try:
+            client = ChatClient(args.address, args.port, args.tcp, args.window, args.rto, metrics)
+            reply = client.login(user_name)
+        except OSError as e:
+            print(f"Cannot connect to server: {e}")
+            return
+        if reply is not None and reply.startswith("HELLO"):
+            print(f"Successfully logged in as {user_name}!")
+            break
+        client.close()
+        if reply == "BUSY":
+            print("Cannot log in. The server is full!")
+            return
+        if reply == "IN-USE":
+            print(f"Cannot log in as {user_name}. That username is already in use.")
+        else:
+            print(f"Error: {reply or 'The server did not answer'}")
+        print("Enter your login:")
+
+    exporter = Exporter(metrics, args.metrics, args.profile)
+    exporter.start()
+    try:
+        client.run()
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        exporter.close()
+        client.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,261 @@
+import os
+import selectors
+import socket
+import sys
+import time
+from collections import deque
+
+from a7_unreliable_chat.codec import FrameError, from_text, to_text
+from a7_unreliable_chat.transport import DEFAULT_RTO, DEFAULT_WINDOW, Connection
+from lab_common.framing import LineFramer, LineTooLongError
+from lab_common.metrics import Histogram, Metrics
+
+LOGIN_ATTEMPTS = 5
+LOGIN_TIMEOUT = 1.0
+# Longest wait for outstanding messages to be acknowledged after !quit
+LINGER = 5.0
+POLL_INTERVAL = 1.0
+RECV_SIZE = 65536
+
+
+class ChatClient:
+    """
+    Chat client that sends its messages through a reliable transport connection per peer.
+
+    Every frame of a connection travels in base64 as the text of an ordinary chat message:
+    the client sends `SEND <peer> <frame>` and the peer receives `DELIVERY <sender> <frame>`,
+    so the chat server relays the frames without knowing about them, however much it drops,
+    corrupts or reorders. The server is reached over UDP with one line per datagram, or over TCP.
+    """
+
+    def __init__(self, host: str, port: int, tcp: bool = False, window: int = DEFAULT_WINDOW,
+                 rto: float = DEFAULT_RTO, metrics: Metrics | None = None) -> None:
+        """
+        :param host: The chat server address.
+        :param port: The chat server port.
+        :param tcp: Talk to a line based TCP server instead of a datagram one.
+        :param window: The send window of each peer connection.
+        :param rto: The initial retransmission timeout of each peer connection.
+        :param metrics: Collect the statistics of every peer connection and their RTT samples
+                        into it, and time the handling of server lines and sending of frames.
+        """
+        self.tcp: bool = tcp
+        self.window: int = window
+        self.rto: float = rto
+        if tcp:
+            self.sock: socket.socket = socket.create_connection((host, port))
+            # A window of frames goes out back to back; Nagle would hold all but the first
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.connect((host, port))
+        self.framer: LineFramer = LineFramer()
+        self.connections: dict[str, Connection] = {}
+        # Over TCP the server answers the SENDs in order, which tells whose peer a reply is about
+        self.send_replies: deque[str] = deque()
+        self.running: bool = True
+        self.quit_at: float | None = None
+        self.rtt_histogram: Histogram | None = None
+        if metrics is not None:
+            self.rtt_histogram = metrics.histogram("rtt", "Round trip times sampled by the peer connections")
+            metrics.collect(self.stats, "peer_", ("sent", "retransmits", "fast_retransmits", "timeouts", "delivered",
+                                                  "duplicates", "corrupted", "restarts"))
+            metrics.instrument(self, {"_on_server": "receive", "_flush": "send"})
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def send_line(self, line: str | bytes) -> None:
+        """
+        Send one protocol line to the server.
+        :param line: The line without its newline.
+        """
+        data = line.encode("utf-8") if isinstance(line, str) else line
+        if self.tcp:
+            self.sock.sendall(data + b"\n")
+        else:
+            self.sock.send(data + b"\n")
+
+    def receive_lines(self) -> list[bytes]:
+        """
+        :return: The complete lines received from the server.
+        :raises ConnectionError: If the server closed the connection.
+        """
+        if self.tcp:
+            if not self.framer.recv_into(self.sock):
+                raise ConnectionError("Connection closed by server")
+            return list(self.framer.lines())
+        try:
+            datagram = self.sock.recv(RECV_SIZE)
+        except ConnectionRefusedError:
+            return []
+        return [line for line in datagram.split(b"\n") if line]
+
+    def login(self, user_name: str) -> str | None:
+        """
+        Send HELLO-FROM until the server answers, resending it over UDP where it may be lost.
+        :param user_name: The login.
+        :return: The server's reply, or None if it never answered.
+        """
+        self.sock.settimeout(LOGIN_TIMEOUT)
+        try:
+            for _ in range(1 if self.tcp else LOGIN_ATTEMPTS):
+                self.send_line(f"HELLO-FROM {user_name}")
+                deadline = time.monotonic() + LOGIN_TIMEOUT
+                while time.monotonic() < deadline:
+                    try:
+                        lines = self.receive_lines()
+                    except socket.timeout:
+                        break
+                    for line in lines:
+                        reply = line.decode("utf-8", "replace").strip()
+                        if reply.startswith(("HELLO", "IN-USE", "BUSY", "BAD-")):
+                            return reply
+            return None
+        finally:
+            self.sock.settimeout(None)
+
+    def connection(self, peer: str) -> Connection:
+        """
+        :param peer: The user name of the peer.
+        :return: The transport connection to the peer, created on first use.
+        """
+        connection = self.connections.get(peer)
+        if connection is None:
+            connection = self.connections[peer] = Connection(self.window, self.rto,
+                                                             rtt_histogram=self.rtt_histogram)
+        return connection
+
+    def stats(self) -> dict[str, dict]:
+        """
+        :return: The statistics of every peer connection, by peer.
+        """
+        return {peer: connection.stats() for peer, connection in self.connections.items()}
+
+    def run(self) -> None:
+        """
+        Relay standard input and server lines until !quit or end of input, then wait up to
+        LINGER seconds for outstanding messages to be acknowledged.
+        """
+        # select() rather than epoll, which refuses standard input redirected from a file
+        selector = selectors.SelectSelector()
+        selector.register(self.sock, selectors.EVENT_READ, self._on_server)
+        stdin = sys.stdin.fileno()
+        selector.register(stdin, selectors.EVENT_READ)
+        pending_input = b""
+        try:
+            while self.running:
+                now = time.monotonic()
+                self._flush(now)
+                if self.quit_at is not None:
+                    if now >= self.quit_at or all(c.idle for c in self.connections.values()):
+                        break
+                deadlines = [d for d in (c.next_deadline() for c in self.connections.values()) if d is not None]
+                timeout = min([POLL_INTERVAL] + [d - now for d in deadlines])
+                for key, _ in selector.select(max(0.0, timeout)):
+                    if key.data is None:
+                        data = os.read(stdin, RECV_SIZE)
+                        if not data:
+                            selector.unregister(stdin)
+                            self._quit()
+                            continue
+                        pending_input += data
+                        *lines, pending_input = pending_input.split(b"\n")
+                        for line in lines:
+                            self._on_stdin(line.decode("utf-8", "replace").strip())
+                    else:
+                        key.data()
+        finally:
+            selector.close()
+
+    def _quit(self) -> None:
+        if self.quit_at is None:
+            self.quit_at = time.monotonic() + LINGER
+            print("\nExiting...")
+
+    def _flush(self, now: float) -> None:
+        for peer, connection in list(self.connections.items()):
+            for frame in connection.poll(now):
+                self.send_line(b"SEND %s %s" % (peer.encode("utf-8"), to_text(frame)))
+                if self.tcp:
+                    self.send_replies.append(peer)
+            if connection.failed:
+                print(f"Giving up on {peer}: {len(connection.in_flight) + len(connection.queue)} "
+                      f"messages were not acknowledged")
+                del self.connections[peer]
+
+    def _on_stdin(self, message: str) -> None:
+        if not message or self.quit_at is not None:
+            return
+        if message == "!quit":
+            self._quit()
+        elif message == "!who":
+            self.send_line("LIST")
+        elif message == "!stats":
+            for peer, connection in self.connections.items():
+                print(f"{peer}: {connection.stats()}")
+        elif message.startswith("@"):
+            parts = message.split(maxsplit=1)
+            peer = parts[0][1:]
+            if not peer:
+                print("Invalid format. Use '@username message' or commands (!quit, !who, !stats)")
+                return
+            self.connection(peer).send((parts[1] if len(parts) > 1 else "").encode("utf-8"))
+        else:
+            print("Invalid format. Use '@username message' or commands (!quit, !who, !stats)")
+
+    def _on_server(self) -> None:
+        try:
+            lines = self.receive_lines()
+        except BlockingIOError:
+            return
+        except (ConnectionError, LineTooLongError) as e:
+            print(f"Connection error: {e}")
+            self.running = False
+            return
+        now = time.monotonic()
+        for line in lines:
+            header, _, rest = line.partition(b" ")
+            if header == b"DELIVERY":
+                sender, _, text = rest.partition(b" ")
+                peer = sender.decode("utf-8", "replace")
+                connection = self.connections.get(peer)
+                try:
+                    frame = from_text(text.strip())
+                except FrameError:
+                    if connection is not None:
+                        connection.corrupted += 1
+                    continue
+                if connection is None:
+                    # Only a frame that passes its checksum opens a connection, so a corrupted
+                    # sender name does not leave a connection to a user that does not exist
+                    connection = Connection(self.window, self.rto, rtt_histogram=self.rtt_histogram)
+                    messages = connection.receive(frame, now)
+                    if connection.corrupted:
+                        continue
+                    self.connections[peer] = connection
+                else:
+                    messages = connection.receive(frame, now)
+                for message in messages:
+                    print(f"From {peer}: {message.decode('utf-8', 'replace')}")
+            elif header == b"SEND-OK":
+                if self.send_replies:
+                    self.send_replies.popleft()
+            elif header == b"LIST-OK":
+                users = [user for user in rest.decode("utf-8", "replace").replace(",", " ").split() if user]
+                print(f"There are {len(users)} online users:")
+                for user in users:
+                    print(user)
+            elif header in (b"BAD-DEST-USER", b"BAD_DEST_USER"):
+                if not self.send_replies:
+                    print("The destination user does not exist")
+                    continue
+                peer = self.send_replies.popleft()
+                if self.connections.pop(peer, None) is not None:
+                    print(f"The destination user {peer} does not exist")
+            elif header in (b"BAD-RQST-HDR", b"BAD-RQST-BODY", b"BAD_RQST_HDR", b"BAD_RQST_BODY"):
+                # Corrupted requests are answered with these; the transport resends its frames
+                if self.send_replies:
+                    self.send_replies.popleft()
+            else:
+                print(f"Error: Unknown message header '{header.decode('utf-8', 'replace')}'")
@@ -0,0 +1,116 @@
+import binascii
+import struct
+import zlib
+
+# crc32 of everything after it, connection IDs of the sender and of the intended receiver,
+# sequence number, cumulative ACK, selective ACK bitmap, flags, payload length
+HEADER = struct.Struct("!IIIIIIBH")
+CRC = struct.Struct("!I")
+CRC_SIZE = CRC.size
+
+FLAG_DATA = 0x01
+FLAG_ACK = 0x02
+
+# Bit i of the bitmap acknowledges sequence number ack + 1 + i
+SACK_BITS = 32
+SEQ_MASK = 0xFFFFFFFF
+MAX_PAYLOAD = 0xFFFF
+
+
+class FrameError(ValueError):
+    """
+    Raised when a frame is truncated, malformed or fails its checksum.
+    """
+
+
+def pack_frame(buffer: bytearray | memoryview, offset: int, flags: int, seq: int, ack: int, sack: int,
+               payload: bytes | memoryview = b"", source: int = 0, destination: int = 0) -> int:
+    """
+    Write a frame into a preallocated buffer.
+    :param buffer: The buffer; it must have room for HEADER.size + len(payload) bytes at offset.
+    :param offset: Where the frame starts.
+    :param flags: FLAG_DATA and/or FLAG_ACK.
+    :param seq: The sequence number; only its low 32 bits are sent.
+    :param ack: The cumulative acknowledgement; only its low 32 bits are sent.
+    :param sack: The selective ACK bitmap.
+    :param payload: The message of a data frame.
+    :param source: The connection ID of the sender.
+    :param destination: The connection ID of the receiver, 0 while the sender does not know it.
+    :return: The offset just past the frame.
+    """
+    length = len(payload)
+    if length > MAX_PAYLOAD:
+        raise ValueError(f"Payload of {length} bytes does not fit in a frame")
+    start = offset + HEADER.size
+    end = start + length
+    HEADER.pack_into(buffer, offset, 0, source, destination, seq & SEQ_MASK, ack & SEQ_MASK, sack, flags, length)
+    buffer[start:end] = payload
+    CRC.pack_into(buffer, offset, zlib.crc32(memoryview(buffer)[offset + CRC_SIZE:end]))
+    return end
+
+
+def encode(flags: int, seq: int, ack: int, sack: int, payload: bytes | memoryview = b"", source: int = 0,
+           destination: int = 0) -> bytearray:
+    """
+    :return: A frame in a buffer of exactly its size; see pack_frame for the parameters.
+    """
+    frame = bytearray(HEADER.size + len(payload))
+    pack_frame(frame, 0, flags, seq, ack, sack, payload, source, destination)
+    return frame
+
+
+def verify(frame: bytes | bytearray | memoryview) -> bool:
+    """
+    :param frame: A received frame.
+    :return: Whether the frame is long enough and its checksum matches.
+    """
+    return len(frame) >= HEADER.size and CRC.unpack_from(frame)[0] == zlib.crc32(memoryview(frame)[CRC_SIZE:])
+
+
+def unpack_frame(frame: bytes | bytearray | memoryview) -> tuple[int, int, int, int, int, int, memoryview]:
+    """
+    Verify and decode a frame without copying its payload.
+    :param frame: A received frame, for example a slice of a receive buffer.
+    :return: The flags, source and destination connection IDs, 32-bit sequence number, 32-bit
+             cumulative ACK, selective ACK bitmap and a view of the payload, which is only
+             valid as long as the frame's buffer is not reused.
+    :raises FrameError: If the frame is truncated or corrupted.
+    """
+    view = memoryview(frame)
+    if len(view) < HEADER.size:
+        raise FrameError("Truncated frame")
+    crc, source, destination, seq, ack, sack, flags, length = HEADER.unpack_from(view)
+    if crc != zlib.crc32(view[CRC_SIZE:]):
+        raise FrameError("Checksum mismatch")
+    if HEADER.size + length != len(view):
+        raise FrameError("Frame length does not match its header")
+    return flags, source, destination, seq, ack, sack, view[HEADER.size:]
+
+
+def to_text(frame: bytes | bytearray | memoryview) -> bytes:
+    """
+    :param frame: A frame.
+    :return: The frame in base64, to travel as the text of a chat message.
+    """
+    return binascii.b2a_base64(frame, newline=False)
+
+
+def from_text(text: bytes) -> bytes:
+    """
+    :param text: A frame in base64.
+    :return: The frame.
+    :raises FrameError: If the text is not valid base64.
+    """
+    try:
+        return binascii.a2b_base64(text)
+    except binascii.Error:
+        raise FrameError("Invalid base64") from None
+
+
+def unwrap(value: int, reference: int) -> int:
+    """
+    :param value: A 32-bit sequence number from the wire.
+    :param reference: A nearby full sequence number.
+    :return: The full sequence number closest to reference whose low 32 bits are value.
+    """
+    return reference + ((value - reference + 0x80000000) & SEQ_MASK) - 0x80000000
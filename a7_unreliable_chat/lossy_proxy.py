@@ -0,0 +1,338 @@
+import heapq
+import logging
+import random
+import selectors
+import signal
+import socket
+import time
+from argparse import ArgumentParser, Namespace
+from functools import partial
+
+from lab_common.metrics import Exporter, Metrics, parse_address
+
+logger = logging.getLogger(__name__)
+
+MAX_DATAGRAM_SIZE = 65535
+POLL_INTERVAL = 0.5
+RECV_BATCH = 64
+
+
+class Impairment:
+    """
+    What happens to each datagram crossing the proxy in one direction. All probabilities are
+    per datagram and all draws come from one seeded generator, so a run can be reproduced.
+    """
+
+    __slots__ = ("drop", "flip", "duplicate", "reorder", "reorder_delay", "delay", "jitter", "bandwidth",
+                 "queue_limit")
+
+    def __init__(self, drop: float = 0.0, flip: float = 0.0, duplicate: float = 0.0, reorder: float = 0.0,
+                 reorder_delay: float = 0.02, delay: float = 0.0, jitter: float = 0.0, bandwidth: int = 0,
+                 queue_limit: int = 100) -> None:
+        """
+        :param drop: The probability that a datagram is dropped.
+        :param flip: The probability that one random bit of a datagram is flipped.
+        :param duplicate: The probability that a datagram is delivered twice.
+        :param reorder: The probability that a datagram is held back by `reorder_delay` extra
+                        seconds, so later ones overtake it.
+        :param reorder_delay: See `reorder`.
+        :param delay: The one-way delay in seconds.
+        :param jitter: The delay varies uniformly by up to this many seconds either way.
+        :param bandwidth: The link rate in bytes per second, 0 for unlimited.
+        :param queue_limit: With a bandwidth cap, the number of datagrams waiting for the link
+                            beyond which new ones are dropped.
+        """
+        self.drop: float = drop
+        self.flip: float = flip
+        self.duplicate: float = duplicate
+        self.reorder: float = reorder
+        self.reorder_delay: float = reorder_delay
+        self.delay: float = delay
+        self.jitter: float = jitter
+        self.bandwidth: int = bandwidth
+        self.queue_limit: int = queue_limit
+
+
+class Link:
+    """
+    One direction of the proxy: the impairment applied to it, the time its (bandwidth capped)
+    link becomes free, and its counters.
+    """
+
+    __slots__ = ("impairment", "busy_until", "queued", "counters")
+
+    def __init__(self, impairment: Impairment) -> None:
+        self.impairment: Impairment = impairment
+        self.busy_until: float = 0.0
+        self.queued: int = 0
+        self.counters: dict[str, int] = {
+            "received": 0, "delivered": 0, "dropped": 0, "overflowed": 0, "corrupted": 0, "duplicated": 0,
+            "reordered": 0, "bytes": 0,
+        }
+
+
+class LossyProxy:
+    """
+    UDP proxy that relays datagrams between its clients and one upstream address through a
+    simulated bad network: datagrams are dropped, corrupted, duplicated, reordered, delayed
+    and squeezed through a bandwidth cap, in both directions.
+
+    Every client address gets its own socket towards the upstream, as behind a NAT, so the
+    upstream's replies can be routed back. Datagrams waiting out their delay are kept in a
+    heap ordered by release time; the event loop sleeps until the earliest one is due.
+    """
+
+    def __init__(self, host: str, port: int, upstream: tuple[str, int], impairment: Impairment,
+                 return_impairment: Impairment | None = None, seed: int | None = None,
+                 metrics: Metrics | None = None) -> None:
+        """
+        :param host: The address to listen at.
+        :param port: The port to listen at, 0 for any.
+        :param upstream: The address to relay client datagrams to.
+        :param impairment: What happens to datagrams from clients to the upstream.
+        :param return_impairment: What happens to datagrams from the upstream to clients; the
+                                  same as `impairment` if not given.
+        :param seed: The seed of the random generator.
+        :param metrics: Collect the counters of both directions into it, and time the handling
+                        of received and released datagrams.
+        """
+        self.host: str = host
+        self.port: int = port
+        self.upstream_address: tuple[str, int] = upstream
+        self.forward: Link = Link(impairment)
+        self.backward: Link = Link(return_impairment or impairment)
+        self.random: random.Random = random.Random(seed)
+        self.selector: selectors.BaseSelector = selectors.DefaultSelector()
+        self.sock: socket.socket | None = None
+        # Socket towards the upstream per client address
+        self.clients: dict[tuple, socket.socket] = {}
+        # (release time, tie breaker, link, socket, datagram, destination or None if connected)
+        self.scheduled: list[tuple[float, int, Link, socket.socket, bytes, tuple | None]] = []
+        self.sequence: int = 0
+        self.running: bool = False
+        if metrics is not None:
+            metrics.collect(self.stats, counters=self.forward.counters)
+            metrics.instrument(self, {"_on_client": "client_batch", "_on_upstream": "upstream_batch",
+                                      "_release": "release"})
+
+    def bind(self) -> None:
+        """
+        Create the listening socket; with port 0 the chosen port is stored in `port`.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.host, self.port))
+        sock.setblocking(False)
+        self.port = sock.getsockname()[1]
+        self.selector.register(sock, selectors.EVENT_READ, self._on_client)
+        self.sock = sock
+        logger.info("Relaying %s:%d to %s:%d", self.host, self.port, *self.upstream_address)
+
+    def serve_forever(self) -> None:
+        """
+        Run the event loop until stop() is called or the process is interrupted.
+        """
+        if self.sock is None:
+            self.bind()
+        self.running = True
+        try:
+            while self.running:
+                timeout = POLL_INTERVAL
+                if self.scheduled:
+                    timeout = min(timeout, max(0.0, self.scheduled[0][0] - time.monotonic()))
+                for key, _ in self.selector.select(timeout):
+                    key.data()
+                self._release(time.monotonic())
+        finally:
+            self.shutdown()
+
+    def stop(self) -> None:
+        """
+        Leave the event loop at its next iteration. Safe to call from a signal handler.
+        """
+        self.running = False
+
+    def shutdown(self) -> None:
+        """
+        Close the sockets.
+        """
+        for sock in [self.sock, *self.clients.values()]:
+            if sock is not None:
+                self.selector.unregister(sock)
+                sock.close()
+        self.sock = None
+        self.clients.clear()
+        self.selector.close()
+        logger.info("Statistics: %s", self.stats())
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """
+        :return: The counters of both directions.
+        """
+        return {"forward": dict(self.forward.counters), "backward": dict(self.backward.counters)}
+
+    def _on_client(self) -> None:
+        for _ in range(RECV_BATCH):
+            try:
+                data, address = self.sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            upstream = self.clients.get(address)
+            if upstream is None:
+                upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                upstream.connect(self.upstream_address)
+                upstream.setblocking(False)
+                self.selector.register(upstream, selectors.EVENT_READ, partial(self._on_upstream, address))
+                self.clients[address] = upstream
+            self._impair(self.forward, data, upstream, None)
+
+    def _on_upstream(self, address: tuple) -> None:
+        upstream = self.clients[address]
+        for _ in range(RECV_BATCH):
+            try:
+                data = upstream.recv(MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            self._impair(self.backward, data, self.sock, address)
+
+    def _impair(self, link: Link, data: bytes, sock: socket.socket, destination: tuple | None) -> None:
+        impairment = link.impairment
+        counters = link.counters
+        draw = self.random.random
+        counters["received"] += 1
+        if draw() < impairment.drop:
+            counters["dropped"] += 1
+            return
+        if data and draw() < impairment.flip:
+            corrupted = bytearray(data)
+            bit = self.random.randrange(len(corrupted) * 8)
+            corrupted[bit >> 3] ^= 1 << (bit & 7)
+            data = bytes(corrupted)
+            counters["corrupted"] += 1
+        copies = 1
+        if draw() < impairment.duplicate:
+            copies = 2
+            counters["duplicated"] += 1
+        now = time.monotonic()
+        for _ in range(copies):
+            release = now
+            if impairment.bandwidth:
+                if link.queued >= impairment.queue_limit:
+                    counters["overflowed"] += 1
+                    continue
+                link.busy_until = max(link.busy_until, now) + len(data) / impairment.bandwidth
+                link.queued += 1
+                release = link.busy_until
+            release += max(0.0, impairment.delay + self.random.uniform(-impairment.jitter, impairment.jitter))
+            if draw() < impairment.reorder:
+                release += impairment.reorder_delay
+                counters["reordered"] += 1
+            self.sequence += 1
+            heapq.heappush(self.scheduled, (release, self.sequence, link, sock, data, destination))
+
+    def _release(self, now: float) -> None:
+        scheduled = self.scheduled
+        while scheduled and scheduled[0][0] <= now:
+            _, _, link, sock, data, destination = heapq.heappop(scheduled)
+            if link.impairment.bandwidth:
+                link.queued -= 1
+            try:
+                if destination is None:
+                    sock.send(data)
+                else:
+                    sock.sendto(data, destination)
+            except OSError:
+                continue
+            link.counters["delivered"] += 1
+            link.counters["bytes"] += len(data)
+
+
+def add_impairment_arguments(parser: ArgumentParser) -> None:
+    """
+    Register the impairment options shared by the proxy and the unreliable chat benchmark.
+    """
+    parser.add_argument("--drop", type=float, default=0.0, help="Probability of dropping a datagram")
+    parser.add_argument("--flip", type=float, default=0.0, help="Probability of flipping one bit of a datagram")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="Probability of delivering a datagram twice")
+    parser.add_argument("--reorder", type=float, default=0.0,
+                        help="Probability of holding a datagram back so later ones overtake it")
+    parser.add_argument("--reorder-delay", type=float, default=0.02,
+                        help="Seconds a reordered datagram is held back")
+    parser.add_argument("--delay", type=float, default=0.0, help="One-way delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum deviation from the delay in seconds")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Link rate in bytes/sec, 0 for unlimited")
+    parser.add_argument("--queue-limit", type=int, default=100,
+                        help="Datagrams queued for a capped link before new ones are dropped")
+    parser.add_argument("--seed", type=int, help="Seed of the random generator")
+
+
+def impairment_from_arguments(args: Namespace, drop: float | None = None) -> Impairment:
+    """
+    :param args: Arguments registered by add_impairment_arguments.
+    :param drop: Overrides the drop probability.
+    :return: The impairment the arguments describe.
+    """
+    return Impairment(args.drop if drop is None else drop, args.flip, args.duplicate, args.reorder,
+                      args.reorder_delay, args.delay, args.jitter, args.bandwidth, args.queue_limit)
+
+
+def parse_arguments() -> Namespace:
+    """
+    Parse command line arguments for the lossy proxy.
+    The valid options are:
+        --address: The host to listen at. Default is "127.0.0.1"
+        --port: The port to listen at. Default is 6779
+        --upstream: The address datagrams are relayed to, as host:port. Default is "127.0.0.1:6778"
+        --drop, --flip, --duplicate, --reorder: Per datagram probabilities of each impairment
+        --reorder-delay: Seconds a reordered datagram is held back. Default is 0.02
+        --delay, --jitter: One-way delay and its maximum deviation in seconds. Default is 0
+        --bandwidth: Link rate in bytes/sec, 0 for unlimited. Default is 0
+        --queue-limit: Datagrams queued for a capped link before new ones are dropped. Default is 100
+        --seed: Seed of the random generator. Default is random
+        --metrics: Serve Prometheus metrics at [host]:port or a Unix socket path. Default is none
+        --profile: Sample the stacks of the event loop and write them, folded for flame graphs,
+                   to this file on exit. Default is none
+    Both directions are impaired alike.
+    :return: The parsed arguments in a Namespace object.
+    """
+
+    parser: ArgumentParser = ArgumentParser(
+        prog="python -m a7_unreliable_chat.lossy_proxy",
+        description="UDP proxy simulating a lossy network in front of an unreliable chat server.",
+    )
+    parser.add_argument("-a", "--address",
+                        type=str, help="Set proxy address", default="127.0.0.1")
+    parser.add_argument("-p", "--port",
+                        type=int, help="Set proxy port", default=6779)
+    parser.add_argument("-u", "--upstream",
+                        type=str, help="Relay to this address (host:port)", default="127.0.0.1:6778")
+    add_impairment_arguments(parser)
+    parser.add_argument("--metrics",
+                        type=parse_address, help="Set the address serving Prometheus metrics")
+    parser.add_argument("--profile",
+                        type=str, help="Set the file the sampled stacks are written to")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args: Namespace = parse_arguments()
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s - %(levelname)s] %(message)s")
+
+    upstream_host, _, upstream_port = args.upstream.rpartition(":")
+    metrics = Metrics("proxy") if args.metrics else None
+    proxy = LossyProxy(args.address, args.port, (upstream_host or "127.0.0.1", int(upstream_port)),
+                       impairment_from_arguments(args), seed=args.seed, metrics=metrics)
+    # Leave the loop on SIGTERM as well, so the counters are logged
+    signal.signal(signal.SIGTERM, lambda signum, frame: proxy.stop())
+    exporter = Exporter(metrics, args.metrics, args.profile)
+    exporter.start()
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        exporter.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+import random
+from collections import deque
+
+from a7_unreliable_chat.codec import (FLAG_ACK, FLAG_DATA, HEADER, SACK_BITS, FrameError, encode, pack_frame,
+                                      unpack_frame, unwrap)
+from lab_common.metrics import Histogram
+
+DEFAULT_WINDOW = 32
+# Initial retransmission timeout and its bounds, as in RFC 6298 but with the 200 ms floor of
+# Linux instead of one second
+DEFAULT_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+INITIAL_CWND = 4
+DUP_ACK_THRESHOLD = 3
+MAX_TRANSMISSIONS = 10
+
+
+class Segment:
+    """
+    A sent but not yet acknowledged message.
+    """
+
+    __slots__ = ("seq", "frame", "sent_at", "transmissions", "sacked", "lost", "repaired")
+
+    def __init__(self, seq: int, frame: bytearray) -> None:
+        self.seq: int = seq
+        self.frame: bytearray = frame
+        self.sent_at: float = 0.0
+        self.transmissions: int = 0
+        self.sacked: bool = False
+        self.lost: bool = False       # Presumed lost and waiting to be retransmitted
+        self.repaired: bool = False   # Already retransmitted by fast retransmit
+
+
+class Connection:
+    """
+    Selective-repeat reliable delivery of messages to one peer over a channel that may drop,
+    corrupt, duplicate and reorder frames.
+
+    The connection does no I/O itself: the owner hands it received frames and the current
+    time, and sends the frames it returns from poll(), so it runs the same over a socket, a
+    chat server relay or a simulated channel. Frames are binary (see codec), each data
+    segment is encoded once when it is first sent, and acknowledgements are packed into one
+    reused buffer.
+
+    The receiver buffers segments that arrive out of order and acknowledges cumulatively,
+    with a bitmap of the segments it holds above the gap as selective ACKs, so the sender
+    only resends what is missing. The acknowledgements for all frames received between two polls are
+    coalesced into one; every segment it newly reports as selectively acknowledged counts as
+    one duplicate ACK.
+
+    The sender keeps at most `window` segments unacknowledged, the receiver's buffer, and at
+    most `cwnd` segments in the network. The congestion window grows by one segment per ACKed
+    segment in slow start and by one segment per round trip above `ssthresh`. Once
+    `DUP_ACK_THRESHOLD` duplicate ACKs show that later segments got through, the holes below
+    them are retransmitted and the window is halved, once per window of data (fast retransmit
+    and recovery). When the retransmission timer expires, every unacknowledged segment is
+    presumed lost, the window collapses to one segment and the timeout doubles.
+
+    The timeout follows RFC 6298: a smoothed RTT and its mean deviation (Jacobson/Karels),
+    sampled only from segments that were sent once (Karn), so an ACK for a retransmission is
+    never mistaken for a sample.
+
+    Every connection picks a random ID, and every frame carries the ID of its sender and the
+    peer's ID as far as the sender knows it, as the verification tags of SCTP do. A frame with
+    a new sender ID means the peer started over, after a restart or a new login: the receiver
+    forgets what it received from the old peer, and the sender numbers its unacknowledged
+    messages again from 0, so they are not taken for duplicates. A frame addressed to another
+    ID was meant for an earlier connection on this side; it is dropped but answered, which
+    tells the peer the new ID. Only data sent before the first frame from the peer carries no
+    peer ID, so a stale frame of that kind that outlives a restart of the peer is still accepted.
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW, rto: float = DEFAULT_RTO,
+                 max_transmissions: int = MAX_TRANSMISSIONS, rtt_histogram: Histogram | None = None) -> None:
+        """
+        :param window: The maximum number of unacknowledged segments, and the number of
+                       segments beyond a gap the receiver buffers.
+        :param rto: The retransmission timeout in seconds until the first RTT sample.
+        :param max_transmissions: The number of times a segment is sent before the connection
+                                  gives up on the peer; 0 never gives up.
+        :param rtt_histogram: Where every RTT sample is recorded in nanoseconds, if given.
+        """
+        self.window: int = max(1, window)
+        self.rto: float = rto
+        self.max_transmissions: int = max_transmissions
+        # Connection IDs of this side, of the peer once it is known, and of earlier peers
+        self.epoch: int = random.getrandbits(32) or 1
+        self.peer_epoch: int = 0
+        self.retired: set[int] = set()
+        # Sender
+        self.queue: deque[bytes] = deque()
+        self.in_flight: dict[int, Segment] = {}
+        self.next_seq: int = 0
+        self.send_base: int = 0
+        self.dup_acks: int = 0
+        self.timer: float | None = None
+        self.failed: bool = False
+        # RTT estimation and congestion control
+        self.srtt: float | None = None
+        self.rttvar: float | None = None
+        self.rtt_histogram: Histogram | None = rtt_histogram
+        self.cwnd: float = float(min(INITIAL_CWND, self.window))
+        self.ssthresh: float = float(self.window)
+        self.recovery: int = 0  # No window reduction until send_base passes this sequence number
+        self.urgent: Segment | None = None  # First hole of a recovery, sent regardless of cwnd
+        self.delivered_sent_at: float = float("-inf")  # Latest send time of an acknowledged segment
+        # Receiver
+        self.expected: int = 0
+        self.buffer: dict[int, bytes] = {}
+        self.ack_pending: bool = False
+        self.ack_frame: bytearray = bytearray(HEADER.size)
+        # Counters
+        self.sent: int = 0
+        self.retransmits: int = 0
+        self.fast_retransmits: int = 0
+        self.timeouts: int = 0
+        self.delivered: int = 0
+        self.duplicates: int = 0
+        self.corrupted: int = 0
+        self.restarts: int = 0
+
+    @property
+    def idle(self) -> bool:
+        """
+        :return: Whether every message handed to send() has been acknowledged.
+        """
+        return not self.queue and not self.in_flight
+
+    @property
+    def pipe(self) -> int:
+        """
+        :return: The number of segments presumed to be in the network.
+        """
+        return sum(1 for segment in self.in_flight.values() if not segment.sacked and not segment.lost)
+
+    def send(self, payload: bytes) -> None:
+        """
+        Queue a message for reliable, in-order delivery.
+        :param payload: The message; it must not contain a newline.
+        """
+        self.queue.append(payload)
+
+    def receive(self, frame: bytes | bytearray | memoryview, now: float) -> list[bytes]:
+        """
+        Process a frame from the peer.
+        :param frame: The received frame; it may be a view of a receive buffer that is reused
+                      afterwards.
+        :param now: The current monotonic time.
+        :return: The messages that became deliverable, in order.
+        """
+        try:
+            flags, source, destination, seq, ack, sack, payload = unpack_frame(frame)
+        except FrameError:
+            self.corrupted += 1
+            return []
+        if source != self.peer_epoch:
+            if source in self.retired:
+                return []
+            if self.peer_epoch:
+                self._on_restart()
+            self.peer_epoch = source
+        if destination and destination != self.epoch:
+            self.ack_pending = True
+            return []
+        if flags & FLAG_ACK and destination:
+            self._on_ack(unwrap(ack, self.send_base), sack, now)
+        if flags & FLAG_DATA:
+            return self._on_data(unwrap(seq, self.expected), payload)
+        return []
+
+    def poll(self, now: float) -> list[bytearray]:
+        """
+        :param now: The current monotonic time.
+        :return: The frames to send now: a pending acknowledgement, then lost segments and new
+                 segments as far as the congestion and send windows allow. They are only valid
+                 until the next call.
+        """
+        frames: list[bytearray] = []
+        if self.ack_pending:
+            pack_frame(self.ack_frame, 0, FLAG_ACK, 0, self.expected, self._sack_bitmap(), b"", self.epoch,
+                       self.peer_epoch)
+            frames.append(self.ack_frame)
+            self.ack_pending = False
+        if self.failed:
+            return frames
+        if self.timer is not None and self.timer + self.rto <= now and not self._on_timeout():
+            return frames
+        if self.urgent is not None:
+            if self.urgent.lost:
+                self.urgent.lost = False
+                self._transmit(self.urgent, now, frames)
+            self.urgent = None
+        pipe = self.pipe
+        for segment in self.in_flight.values():
+            if pipe >= self.cwnd:
+                return frames
+            if segment.lost:
+                segment.lost = False
+                pipe += 1
+                self._transmit(segment, now, frames)
+        while self.queue and pipe < self.cwnd and self.next_seq - self.send_base < self.window:
+            segment = Segment(self.next_seq, encode(FLAG_DATA, self.next_seq, 0, 0, self.queue.popleft(), self.epoch,
+                                                    self.peer_epoch))
+            self.in_flight[segment.seq] = segment
+            self.next_seq += 1
+            pipe += 1
+            self._transmit(segment, now, frames)
+        return frames
+
+    def next_deadline(self) -> float | None:
+        """
+        :return: The monotonic time at which poll() has work to do, or None if only a received
+                 frame or a new message can create work.
+        """
+        if self.ack_pending or (self.urgent is not None and not self.failed):
+            return 0.0
+        if self.failed:
+            return None
+        if self.pipe < self.cwnd:
+            if self.queue and self.next_seq - self.send_base < self.window:
+                return 0.0
+            if any(segment.lost for segment in self.in_flight.values()):
+                return 0.0
+        return self.timer + self.rto if self.timer is not None else None
+
+    def stats(self) -> dict[str, int | float | None]:
+        """
+        :return: The connection's counters, queue sizes, RTT estimate and congestion state.
+        """
+        return {
+            "queued": len(self.queue),
+            "in_flight": len(self.in_flight),
+            "sent": self.sent,
+            "retransmits": self.retransmits,
+            "fast_retransmits": self.fast_retransmits,
+            "timeouts": self.timeouts,
+            "delivered": self.delivered,
+            "buffered": len(self.buffer),
+            "duplicates": self.duplicates,
+            "corrupted": self.corrupted,
+            "restarts": self.restarts,
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "rto": self.rto,
+            "cwnd": self.cwnd,
+            "ssthresh": self.ssthresh,
+        }
+
+    def _transmit(self, segment: Segment, now: float, frames: list[bytearray]) -> None:
+        if segment.transmissions:
+            self.retransmits += 1
+        segment.transmissions += 1
+        segment.sent_at = now
+        self.sent += 1
+        if self.timer is None:
+            self.timer = now
+        frames.append(segment.frame)
+
+    def _on_timeout(self) -> bool:
+        """
+        Presume every unacknowledged segment lost, collapse the congestion window and back
+        off the timer.
+        :return: False if the connection gave up instead.
+        """
+        first = next((segment for segment in self.in_flight.values() if not segment.sacked), None)
+        if first is None:
+            self.timer = None
+            return True
+        if self.max_transmissions and first.transmissions >= self.max_transmissions:
+            self.failed = True
+            return False
+        self.timeouts += 1
+        self.ssthresh = max(self.pipe / 2, 2.0)
+        self.cwnd = 1.0
+        self.recovery = self.next_seq
+        self.dup_acks = 0
+        for segment in self.in_flight.values():
+            if not segment.sacked:
+                segment.lost = True
+                segment.repaired = False
+        self.rto = min(self.rto * 2, MAX_RTO)
+        self.urgent = None
+        # Restarted by the retransmission of the first segment
+        self.timer = None
+        return True
+
+    def _on_restart(self) -> None:
+        """
+        Start over with a peer that started over: forget what the old peer sent, and queue
+        the messages it did not acknowledge again in front of the rest, to be numbered from 0.
+        """
+        self.restarts += 1
+        self.retired.add(self.peer_epoch)
+        self.expected = 0
+        self.buffer = {}
+        unacknowledged = [bytes(segment.frame[HEADER.size:]) for _, segment in sorted(self.in_flight.items())]
+        self.queue.extendleft(reversed(unacknowledged))
+        self.in_flight = {}
+        self.next_seq = 0
+        self.send_base = 0
+        self.dup_acks = 0
+        self.timer = None
+        self.failed = False
+        self.cwnd = float(min(INITIAL_CWND, self.window))
+        self.recovery = 0
+        self.urgent = None
+        self.delivered_sent_at = float("-inf")
+
+    def _sample_rtt(self, rtt: float) -> None:
+        if self.rtt_histogram is not None:
+            self.rtt_histogram.record(int(rtt * 1e9))
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def _on_data(self, seq: int, payload: memoryview) -> list[bytes]:
+        # Duplicates and segments beyond the buffer are dropped, but still acknowledged so a
+        # sender whose ACK was lost learns that the segment arrived
+        self.ack_pending = True
+        if seq < self.expected or seq in self.buffer:
+            self.duplicates += 1
+            return []
+        if seq >= self.expected + self.window:
+            return []
+        self.buffer[seq] = bytes(payload)
+        delivered = []
+        while self.expected in self.buffer:
+            delivered.append(self.buffer.pop(self.expected))
+            self.expected += 1
+        self.delivered += len(delivered)
+        return delivered
+
+    def _sack_bitmap(self) -> int:
+        bitmap = 0
+        for seq in self.buffer:
+            offset = seq - self.expected - 1
+            if offset < SACK_BITS:
+                bitmap |= 1 << offset
+        return bitmap
+
+    def _on_ack(self, ack: int, sack: int, now: float) -> None:
+        if ack > self.next_seq:
+            return
+        acked = 0
+        newest: Segment | None = None
+        if ack > self.send_base:
+            for seq in range(self.send_base, ack):
+                segment = self.in_flight.pop(seq, None)
+                if segment is not None and not segment.sacked:
+                    acked += 1
+                    if newest is None or segment.sent_at >= newest.sent_at:
+                        newest = segment
+            self.send_base = ack
+            self.dup_acks = 0
+            self.failed = False
+            self.timer = now if self.in_flight else None
+        elif self.in_flight:
+            self.dup_acks += 1
+        highest = ack + sack.bit_length() + 1 if sack else ack
+        while sack:
+            lowest = sack & -sack
+            sack ^= lowest
+            segment = self.in_flight.get(ack + lowest.bit_length())
+            if segment is not None and not segment.sacked:
+                segment.sacked = True
+                segment.lost = False
+                acked += 1
+                if newest is None or segment.sent_at >= newest.sent_at:
+                    newest = segment
+                # Every newly reported segment stands for the duplicate ACK it would have
+                # triggered on its own
+                self.dup_acks += 1
+        # The latest transmission among the newly acknowledged segments is what triggered this
+        # ACK. Karn's algorithm: if that was a retransmission, the sample is ambiguous
+        if newest is not None:
+            self.delivered_sent_at = max(self.delivered_sent_at, newest.sent_at)
+            if newest.transmissions == 1:
+                self._sample_rtt(now - newest.sent_at)
+        for _ in range(acked):
+            self.cwnd += 1.0 if self.cwnd < self.ssthresh else 1.0 / self.cwnd
+        self.cwnd = min(self.cwnd, float(self.window))
+        if self.dup_acks >= DUP_ACK_THRESHOLD:
+            self._fast_retransmit(highest)
+
+    def _fast_retransmit(self, highest: int) -> None:
+        # Mark each hole below the highest selectively acknowledged segment lost, once; a lost
+        # retransmission is left to the timer. As in RACK, a hole counts as lost only once a
+        # segment sent more than a quarter RTT after it got through; until then it may merely
+        # have been overtaken by segments sent at about the same time.
+        reordering = self.srtt / 4 if self.srtt is not None else 0.0
+        holes: list[Segment] = []
+        for seq in range(self.send_base, highest):
+            segment = self.in_flight.get(seq)
+            if (segment is not None and not segment.sacked and not segment.repaired
+                    and segment.sent_at + reordering < self.delivered_sent_at):
+                segment.repaired = True
+                segment.lost = True
+                holes.append(segment)
+        if not holes:
+            return
+        self.fast_retransmits += len(holes)
+        if self.send_base >= self.recovery:
+            # Halve the window once per window of data, however many holes it had, and resend
+            # the first hole at once; the rest follow as the shrunken window allows
+            self.recovery = self.next_seq
+            self.ssthresh = max((self.pipe + len(holes)) / 2, 2.0)
+            self.cwnd = self.ssthresh
+            self.urgent = holes[0]
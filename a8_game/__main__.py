@@ -1,6 +1,82 @@
+import logging
+import signal
+from argparse import Namespace, ArgumentParser
+
+from a8_game.server import GameServer
+from lab_common.metrics import Exporter, Metrics, parse_address
+
+
+def parse_arguments() -> Namespace:
+    """
+    Parse command line arguments for the game server.
+    The valid options are:
+        --address: The host to listen at. Default is "0.0.0.0"
+        --port: The UDP port to listen at. Default is 7000
+        --tick-rate: Simulation ticks and snapshots per second. Default is 30
+        --npcs: The number of non-player entities. Default is 200
+        --width, --height: The size of the world. Default is 2000 by 2000
+        --max-clients: Players beyond this are rejected. Default is 1000
+        --seed: Seed of the world's random generator. Default is random
+        --view-distance: How far players see along each axis, 0 for the whole world. Default is 400
+        --no-numpy: Keep the world in array.array columns even if NumPy is installed
+        --metrics: Serve Prometheus metrics at [host]:port or a Unix socket path. Default is none
+        --profile: Sample the stacks of the game loop and write them, folded for flame graphs,
+                   to this file on exit. Default is none
+    :return: The parsed arguments in a Namespace object.
+    """
+
+    parser: ArgumentParser = ArgumentParser(
+        prog="python -m a8_game",
+        description="A8 Game Server assignment for the VU Computer Networks course.",
+        epilog="Authors: Your group name"
+    )
+    parser.add_argument("-a", "--address",
+                        type=str, help="Set server address", default="0.0.0.0")
+    parser.add_argument("-p", "--port",
+                        type=int, help="Set server port", default=7000)
+    parser.add_argument("-t", "--tick-rate",
+                        type=int, help="Set the simulation ticks per second", default=30)
+    parser.add_argument("-n", "--npcs",
+                        type=int, help="Set the number of non-player entities", default=200)
+    parser.add_argument("--width",
+                        type=int, help="Set the width of the world", default=2000)
+    parser.add_argument("--height",
+                        type=int, help="Set the height of the world", default=2000)
+    parser.add_argument("--max-clients",
+                        type=int, help="Set the maximum number of players", default=1000)
+    parser.add_argument("--seed",
+                        type=int, help="Set the seed of the world's random generator")
+    parser.add_argument("--view-distance",
+                        type=float, help="Set how far players see, 0 for everything", default=400.0)
+    parser.add_argument("--no-numpy", action="store_true",
+                        help="Do not use NumPy for the world even if it is installed")
+    parser.add_argument("--metrics",
+                        type=parse_address, help="Set the address serving Prometheus metrics")
+    parser.add_argument("--profile",
+                        type=str, help="Set the file the sampled stacks are written to")
+
+    return parser.parse_args()
+
+
 def main() -> None:
-    # TODO: Your implementation here
-    pass
+    args: Namespace = parse_arguments()
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s - %(levelname)s] %(message)s")
+
+    metrics = Metrics("game") if args.metrics else None
+    server = GameServer(args.address, args.port, args.tick_rate, args.npcs, args.width, args.height,
+                        args.max_clients, args.seed, args.view_distance, False if args.no_numpy else None,
+                        metrics)
+    # Leave the loop on SIGTERM as well, so the statistics are logged
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    exporter = Exporter(metrics, args.metrics, args.profile)
+    exporter.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        exporter.close()
 
 
 if __name__ == "__main__":
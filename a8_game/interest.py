@@ -0,0 +1,98 @@
+import math
+
+from a8_game.world import World, numpy
+
+
+class SpatialGrid:
+    """
+    Uniform grid over the world for area of interest queries: which entities lie within a
+    square around a point. The grid is rebuilt from the world's columns after every step,
+    which is cheaper than tracking entities as they cross cells when most of them move.
+
+    With NumPy the rebuild sorts the slots by cell, so each cell is a contiguous run of that
+    order found by binary search. Entities move little between ticks, so the previous order is
+    nearly sorted already and is sorted again with a stable (adaptive) sort, which then runs
+    in about linear time. Without NumPy each cell keeps a list of its slots. A query only
+    looks at the cells the square overlaps, so its cost depends on the density of the world
+    around the point and not on the number of entities in it.
+    """
+
+    def __init__(self, world: World, cell_size: float) -> None:
+        """
+        :param world: The world to index.
+        :param cell_size: The side of a cell, best about the radius of the queries.
+        """
+        self.world: World = world
+        self.cell_size: float = cell_size
+        self.columns: int = int(world.width // cell_size) + 1
+        self.rows: int = int(world.height // cell_size) + 1
+        # NumPy: the slots ordered by cell and the cell of each; otherwise slots by cell
+        self.order = None
+        self.sorted_cells = None
+        self.cells: dict[int, list[int]] = {}
+
+    def rebuild(self) -> None:
+        """
+        Index the current positions of the world's entities.
+        """
+        world = self.world
+        n = world.count
+        # Coordinates are never negative, so truncation rounds down
+        scale = 1 / self.cell_size
+        if world.use_numpy:
+            cells = (world.x[:n] * scale).astype(numpy.int64) * self.rows
+            cells += (world.y[:n] * scale).astype(numpy.int64)
+            order = self.order
+            if order is None or len(order) != n:
+                # Entities joined or left, so the previous order is not a permutation of the slots
+                order = numpy.argsort(cells, kind="stable")
+            else:
+                order = order[numpy.argsort(cells[order], kind="stable")]
+            self.order = order
+            self.sorted_cells = cells[order]
+            return
+        rows = self.rows
+        cells: dict[int, list[int]] = {}
+        for slot, (x, y) in enumerate(zip(world.x, world.y)):
+            cell = int(x * scale) * rows + int(y * scale)
+            members = cells.get(cell)
+            if members is None:
+                cells[cell] = [slot]
+            else:
+                members.append(slot)
+        self.cells = cells
+
+    def query(self, x: float, y: float, radius: float):
+        """
+        :param x: The centre of the area.
+        :param y: The centre of the area.
+        :param radius: Half the side of the square area.
+        :return: The slots of the entities in the area as of the last rebuild, as a NumPy index
+                 array with NumPy and a list otherwise.
+        """
+        world = self.world
+        # Cells are found exactly as in rebuild(), but rounding down, as the area may extend past
+        # the edges of the world
+        scale = 1 / self.cell_size
+        first_column = max(0, math.floor((x - radius) * scale))
+        last_column = min(self.columns - 1, math.floor((x + radius) * scale))
+        first_row = max(0, math.floor((y - radius) * scale))
+        last_row = min(self.rows - 1, math.floor((y + radius) * scale))
+        if world.use_numpy:
+            # The overlapped cells of each grid column form one contiguous run of cell numbers
+            starts = numpy.arange(first_column, last_column + 1) * self.rows + first_row
+            begins = numpy.searchsorted(self.sorted_cells, starts, side="left").tolist()
+            ends = numpy.searchsorted(self.sorted_cells, starts + (last_row - first_row), side="right").tolist()
+            order = self.order
+            candidates = numpy.concatenate([order[begin:end] for begin, end in zip(begins, ends)])
+            near = (numpy.abs(world.x[candidates] - x) <= radius) & (numpy.abs(world.y[candidates] - y) <= radius)
+            return candidates[near]
+        xs = world.x
+        ys = world.y
+        result = []
+        for column in range(first_column, last_column + 1):
+            for cell in range(column * self.rows + first_row, column * self.rows + last_row + 1):
+                for slot in self.cells.get(cell, ()):
+                    if abs(xs[slot] - x) <= radius and abs(ys[slot] - y) <= radius:
+                        result.append(slot)
+        return result
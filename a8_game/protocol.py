@@ -0,0 +1,137 @@
+import struct
+from itertools import compress
+
+# Client to server
+MSG_JOIN = 1
+MSG_INPUT = 2
+MSG_LEAVE = 3
+MSG_STATS = 4
+# Server to client
+MSG_WELCOME = 1
+MSG_SNAPSHOT = 2
+MSG_REJECT = 3
+MSG_STATS_REPLY = 4
+
+TYPE = struct.Struct("!B")
+# Type, input sequence number, last completely received snapshot tick, movement x and y
+INPUT = struct.Struct("!BIIbb")
+# Type, entity ID of the player, tick rate, world width and height
+WELCOME = struct.Struct("!BIHHH")
+# Type, tick, baseline tick (0 for none), part index, part count, changed entities, removed entities
+SNAPSHOT = struct.Struct("!BIIBBHH")
+ENTITY_ID = struct.Struct("!I")
+
+# An entity's state on the wire: quantized x, quantized y, kind. Each changed entity is sent as
+# its ID, a bit mask of the fields that differ from the baseline and those fields.
+FIELDS = 3
+FIELD_MASK = (1 << FIELDS) - 1
+RECORDS = [struct.Struct("!IB" + "H" * bin(mask).count("1")) for mask in range(FIELD_MASK + 1)]
+# Which fields of a state each mask selects
+SELECTORS = [tuple(mask >> bit & 1 for bit in range(FIELDS)) for mask in range(FIELD_MASK + 1)]
+
+KIND_PLAYER = 1
+KIND_NPC = 2
+
+QUANTIZATION = 65535
+# Snapshot datagrams stay below a typical path MTU; larger snapshots are split into parts
+MAX_DATAGRAM_SIZE = 1200
+MAX_PARTS = 255
+
+State = tuple[int, int, int]
+
+
+def quantize(value: float, size: float) -> int:
+    """
+    :param value: A coordinate in [0, size].
+    :param size: The extent of the world along the axis.
+    :return: The coordinate as a 16-bit integer.
+    """
+    return int(value * QUANTIZATION / size)
+
+
+def dequantize(value: int, size: float) -> float:
+    """
+    :return: The coordinate a quantized value stands for; see quantize.
+    """
+    return value * size / QUANTIZATION
+
+
+def encode_snapshot(tick: int, baseline_tick: int, baseline: dict[int, State] | None,
+                    current: dict[int, State]) -> list[bytes]:
+    """
+    Encode the difference between two states as snapshot datagrams.
+    :param tick: The tick of the current state.
+    :param baseline_tick: The tick of the baseline, 0 without one.
+    :param baseline: The state the client is known to have, None to send everything.
+    :param current: The state to bring the client to.
+    :return: One datagram per part, each at most MAX_DATAGRAM_SIZE bytes.
+    """
+    records = bytearray()
+    boundaries = [0]
+    counts = [[0, 0]]
+    limit = MAX_DATAGRAM_SIZE - SNAPSHOT.size
+    part_end = limit
+    get = baseline.get if baseline is not None else {}.get
+    full = RECORDS[FIELD_MASK].pack
+    for entity_id, state in current.items():
+        old = get(entity_id)
+        if old is None:
+            record = full(entity_id, FIELD_MASK, *state)
+        elif old == state:
+            continue
+        else:
+            # One bit per field that differs, for the FIELDS == 3 fields
+            mask = (state[0] != old[0]) | (state[1] != old[1]) << 1 | (state[2] != old[2]) << 2
+            record = RECORDS[mask].pack(entity_id, mask, *compress(state, SELECTORS[mask]))
+        if len(records) + len(record) > part_end:
+            boundaries.append(len(records))
+            counts.append([0, 0])
+            part_end = len(records) + limit
+        records += record
+        counts[-1][0] += 1
+    if baseline is not None:
+        for entity_id in baseline:
+            if entity_id not in current:
+                if len(records) + ENTITY_ID.size > part_end:
+                    boundaries.append(len(records))
+                    counts.append([0, 0])
+                    part_end = len(records) + limit
+                records += ENTITY_ID.pack(entity_id)
+                counts[-1][1] += 1
+    if len(boundaries) > MAX_PARTS:
+        raise ValueError(f"Snapshot needs {len(boundaries)} datagrams, more than {MAX_PARTS}")
+    boundaries.append(len(records))
+    parts = len(counts)
+    return [SNAPSHOT.pack(MSG_SNAPSHOT, tick, baseline_tick, index, parts, changed, removed)
+            + records[boundaries[index]:boundaries[index + 1]]
+            for index, (changed, removed) in enumerate(counts)]
+
+
+def apply_snapshot(state: dict[int, State], datagram: bytes | memoryview) -> None:
+    """
+    Apply one snapshot part to a copy of its baseline state.
+    :param state: The baseline state, updated in place.
+    :param datagram: A snapshot datagram.
+    :raises ValueError: If the datagram is truncated.
+    """
+    _, _, _, _, _, changed, removed = SNAPSHOT.unpack_from(datagram)
+    offset = SNAPSHOT.size
+    try:
+        for _ in range(changed):
+            mask = datagram[offset + ENTITY_ID.size] & FIELD_MASK
+            record = RECORDS[mask]
+            entity_id, _, *fields = record.unpack_from(datagram, offset)
+            offset += record.size
+            if mask == FIELD_MASK:
+                state[entity_id] = tuple(fields)
+                continue
+            values = list(state.get(entity_id, (0, 0, 0)))
+            for bit in range(FIELDS):
+                if mask & (1 << bit):
+                    values[bit] = fields.pop(0)
+            state[entity_id] = tuple(values)
+        for _ in range(removed):
+            state.pop(ENTITY_ID.unpack_from(datagram, offset)[0], None)
+            offset += ENTITY_ID.size
+    except (IndexError, struct.error):
+        raise ValueError("Truncated snapshot") from None
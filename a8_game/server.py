@@ -0,0 +1,356 @@
+import json
+import logging
+import selectors
+import socket
+import time
+from collections import deque
+
+from a8_game.protocol import (INPUT, KIND_NPC, KIND_PLAYER, MSG_INPUT, MSG_JOIN, MSG_LEAVE, MSG_REJECT,
+                              MSG_STATS, MSG_STATS_REPLY, MSG_WELCOME, TYPE, WELCOME, State, encode_snapshot)
+from a8_game.interest import SpatialGrid
+from a8_game.world import World
+from lab_common.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_DATAGRAM_SIZE = 2048
+# Datagrams read per readable event before the tick gets a turn
+RECV_BATCH = 256
+SOCKET_BUFFER_SIZE = 4 << 20
+# Snapshots kept per client as delta baselines; a client whose last acknowledged snapshot is
+# older gets a full one
+HISTORY = 32
+# Ticks simulated back to back when the loop has fallen behind, before the rest are skipped
+MAX_CATCH_UP = 5
+CLIENT_TIMEOUT = 5.0
+# Tick durations kept for the percentiles in stats()
+TICK_SAMPLES = 1000
+
+
+class Client:
+    """
+    A player: their address, their entity, the snapshots they were sent, and the newest one
+    they acknowledged, which is the baseline of the deltas they are sent.
+    """
+
+    __slots__ = ("address", "entity_id", "acked", "frames", "input_seq", "last_seen")
+
+    def __init__(self, address: tuple, entity_id: int, now: float) -> None:
+        self.address: tuple = address
+        self.entity_id: int = entity_id
+        # 0 until the first snapshot is acknowledged, so the first one sent is full
+        self.acked: int = 0
+        # The states sent in the latest HISTORY snapshots by tick, oldest first
+        self.frames: dict[int, dict[int, State]] = {}
+        self.input_seq: int = 0
+        self.last_seen: float = now
+
+
+class GameServer:
+    """
+    Authoritative game server over UDP with a fixed-timestep simulation.
+
+    The event loop waits for datagrams no longer than until the next tick is due, so reading
+    input never delays the simulation and a slow tick never blocks input. Every tick advances
+    the World by exactly 1 / tick_rate seconds; after a stall up to MAX_CATCH_UP ticks are run
+    back to back and the rest are skipped, so the loop cannot spiral. Inputs simply update the
+    player's velocity and take effect at the next tick.
+
+    After each tick every client gets a snapshot of the entities within `view_distance` of
+    their player, found through a SpatialGrid, so the work per client depends on how crowded
+    their surroundings are rather than on the size of the world. The snapshot is encoded
+    against the newest one they acknowledged (their inputs carry the ack) and holds only the
+    entities that changed or came into view since, and those that left. The states sent in
+    the last HISTORY snapshots are kept as baselines; a client that acknowledged nothing
+    recent gets a full snapshot. Lost snapshots need no retransmission: the next one is
+    encoded against the same, older baseline and so carries every change since.
+
+    With a view distance of 0 every client sees the whole world; clients with the same
+    baseline then share one encoding.
+
+    With `metrics`, the statistics are collected into it, and ticks, broadcasts, snapshots and
+    batches of received datagrams are timed.
+    """
+
+    def __init__(self, host: str, port: int, tick_rate: int = 30, npcs: int = 200, width: int = 2000,
+                 height: int = 2000, max_clients: int = 1000, seed: int | None = None,
+                 view_distance: float = 400.0, use_numpy: bool | None = None,
+                 metrics: Metrics | None = None) -> None:
+        """
+        :param host: The address to listen at.
+        :param port: The port to listen at, 0 for any.
+        :param tick_rate: Simulation ticks (and snapshots) per second.
+        :param npcs: The number of non-player entities in the world.
+        :param width: The extent of the world along x.
+        :param height: The extent of the world along y.
+        :param max_clients: Players beyond this are rejected.
+        :param seed: The seed of the world's random generator.
+        :param view_distance: How far players see along each axis, 0 for the whole world.
+        :param use_numpy: See World.
+        :param metrics: Where to collect the statistics and timings, if anywhere.
+        """
+        self.host: str = host
+        self.port: int = port
+        self.tick_rate: int = tick_rate
+        self.dt: float = 1.0 / tick_rate
+        self.max_clients: int = max_clients
+        self.view_distance: float = view_distance
+        self.world: World = World(width, height, seed, use_numpy)
+        for _ in range(npcs):
+            self.world.spawn(KIND_NPC)
+        self.grid: SpatialGrid | None = SpatialGrid(self.world, view_distance) if view_distance else None
+        self.selector: selectors.BaseSelector = selectors.DefaultSelector()
+        self.sock: socket.socket | None = None
+        self.clients: dict[tuple, Client] = {}
+        # 0 means no baseline, so ticks start at 1
+        self.tick: int = 0
+        self.tick_times: deque[float] = deque(maxlen=TICK_SAMPLES)
+        self.recv_buffer: bytearray = bytearray(MAX_DATAGRAM_SIZE)
+        self.recv_view: memoryview = memoryview(self.recv_buffer)
+        self.running: bool = False
+        self.counters: dict[str, int] = {
+            "ticks": 0, "skipped_ticks": 0, "joined": 0, "left": 0, "timed_out": 0, "rejected": 0, "inputs": 0,
+            "malformed": 0, "full_snapshots": 0, "delta_snapshots": 0, "encodings": 0, "visible": 0,
+            "datagrams_sent": 0, "bytes_sent": 0, "send_failures": 0, "oversized_snapshots": 0,
+        }
+        if metrics is not None:
+            metrics.collect(self.stats, counters=self.counters)
+            metrics.instrument(self, {"step": "tick", "broadcast": "broadcast"}, every=1)
+            metrics.instrument(self, {"snapshot": "snapshot", "_on_datagram": "receive"})
+
+    def bind(self) -> None:
+        """
+        Create the UDP socket; with port 0 the chosen port is stored in `port`.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+            except OSError:
+                pass
+        sock.bind((self.host, self.port))
+        sock.setblocking(False)
+        self.port = sock.getsockname()[1]
+        self.selector.register(sock, selectors.EVENT_READ, self._on_datagram)
+        self.sock = sock
+        logger.info("Game server listening at %s:%d, %d ticks/sec", self.host, self.port, self.tick_rate)
+
+    def serve_forever(self) -> None:
+        """
+        Run the event loop and the simulation until stop() is called or the process is
+        interrupted.
+        """
+        if self.sock is None:
+            self.bind()
+        self.running = True
+        next_tick = time.monotonic()
+        try:
+            while self.running:
+                for key, _ in self.selector.select(max(0.0, next_tick - time.monotonic())):
+                    key.data()
+                now = time.monotonic()
+                if now < next_tick:
+                    continue
+                ticks = 0
+                while now >= next_tick and ticks < MAX_CATCH_UP:
+                    started = time.perf_counter()
+                    self.step()
+                    ticks += 1
+                    next_tick += self.dt
+                    if now < next_tick or ticks == MAX_CATCH_UP:
+                        self.broadcast()
+                    self.tick_times.append(time.perf_counter() - started)
+                if now >= next_tick:
+                    skipped = int((now - next_tick) / self.dt) + 1
+                    self.counters["skipped_ticks"] += skipped
+                    next_tick += skipped * self.dt
+                self._expire(now)
+        finally:
+            self.shutdown()
+
+    def stop(self) -> None:
+        """
+        Leave the event loop at its next iteration. Safe to call from a signal handler.
+        """
+        self.running = False
+
+    def shutdown(self) -> None:
+        """
+        Close the socket.
+        """
+        if self.sock is not None:
+            self.selector.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+        self.selector.close()
+        logger.info("Statistics: %s", self.stats())
+
+    def stats(self) -> dict[str, int | dict]:
+        """
+        :return: The counters, and the tick durations of the last TICK_SAMPLES ticks in
+                 milliseconds against the tick budget. Headroom is the share of the budget the
+                 99th percentile tick leaves unused.
+        """
+        samples = sorted(self.tick_times)
+        budget = self.dt * 1000
+        tick: dict[str, float | None] = {"p50": None, "p99": None, "max": None, "budget": budget, "headroom": None}
+        if samples:
+            tick["p50"] = samples[len(samples) // 2] * 1000
+            tick["p99"] = samples[min(len(samples) - 1, len(samples) * 99 // 100)] * 1000
+            tick["max"] = samples[-1] * 1000
+            tick["headroom"] = 1 - tick["p99"] / budget
+        return {**self.counters, "tick": self.tick, "clients": len(self.clients),
+                "entities": len(self.world), "tick_ms": tick}
+
+    def step(self) -> None:
+        """
+        Advance the simulation by one tick.
+        """
+        self.tick += 1
+        self.world.step(self.dt)
+        if self.grid is not None:
+            self.grid.rebuild()
+        self.counters["ticks"] += 1
+
+    def broadcast(self) -> None:
+        """
+        Send every client a snapshot of the current tick.
+        """
+        # The whole world and its encodings by baseline tick, when every client sees everything
+        everything = None if self.grid is not None else self.world.states()
+        encoded: dict[int, list[bytes]] = {}
+        sendto = self.sock.sendto
+        counters = self.counters
+        for client in self.clients.values():
+            for datagram in self.snapshot(client, everything, encoded):
+                try:
+                    sendto(datagram, client.address)
+                except OSError:
+                    counters["send_failures"] += 1
+                    continue
+                counters["datagrams_sent"] += 1
+                counters["bytes_sent"] += len(datagram)
+
+    def snapshot(self, client: Client, everything: dict[int, State] | None = None,
+                 encoded: dict[int, list[bytes]] | None = None) -> list[bytes]:
+        """
+        Encode the current tick for a client as a delta against their acknowledged snapshot.
+        :param client: The client.
+        :param everything: Without a view distance, the state of the whole world.
+        :param encoded: Without a view distance, the encodings of this tick by baseline tick
+                        made for other clients, shared with them.
+        :return: The datagrams to send, none if the snapshot does not fit in MAX_PARTS datagrams.
+        """
+        tick = self.tick
+        frames = client.frames
+        # Only the newest acknowledged snapshot is used as a baseline, so older ones are of no use
+        while frames and (len(frames) >= HISTORY or next(iter(frames)) < client.acked):
+            del frames[next(iter(frames))]
+        baseline = client.acked if client.acked in frames else 0
+        if everything is None:
+            x, y = self.world.position(client.entity_id)
+            current = self.world.states(self.grid.query(x, y, self.view_distance))
+        else:
+            current = everything
+        frames[tick] = current
+        counters = self.counters
+        counters["delta_snapshots" if baseline else "full_snapshots"] += 1
+        counters["visible"] += len(current)
+        if everything is not None and encoded is not None:
+            datagrams = encoded.get(baseline)
+            if datagrams is None:
+                datagrams = encoded[baseline] = self._encode(tick, baseline, frames.get(baseline), current)
+            if not datagrams:
+                del frames[tick]
+            return datagrams
+        datagrams = self._encode(tick, baseline, frames.get(baseline), current)
+        if not datagrams:
+            del frames[tick]
+        return datagrams
+
+    def _encode(self, tick: int, baseline_tick: int, baseline: dict[int, State] | None,
+                current: dict[int, State]) -> list[bytes]:
+        """
+        :return: The datagrams of a snapshot, none if it is too large to send; the client then
+                 misses this tick and keeps its baseline, so a later, smaller delta can reach it.
+        """
+        counters = self.counters
+        counters["encodings"] += 1
+        try:
+            return encode_snapshot(tick, baseline_tick, baseline, current)
+        except ValueError as e:
+            if not counters["oversized_snapshots"]:
+                logger.warning("Not sending a snapshot: %s; lower the view distance or the number of NPCs", e)
+            counters["oversized_snapshots"] += 1
+            return []
+
+    def _on_datagram(self) -> None:
+        sock = self.sock
+        view = self.recv_view
+        for _ in range(RECV_BATCH):
+            try:
+                size, address = sock.recvfrom_into(self.recv_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.debug("Receive failed: %s", e)
+                continue
+            if size:
+                self.handle(view[:size], address)
+
+    def handle(self, datagram: memoryview, address: tuple) -> None:
+        """
+        Process one datagram from a client.
+        """
+        kind = datagram[0]
+        client = self.clients.get(address)
+        if kind == MSG_INPUT and client is not None and len(datagram) == INPUT.size:
+            _, seq, ack, dx, dy = INPUT.unpack_from(datagram)
+            client.last_seen = time.monotonic()
+            # Acknowledgements and inputs may arrive out of order; only newer ones count
+            if client.acked < ack <= self.tick:
+                client.acked = ack
+            if seq > client.input_seq:
+                client.input_seq = seq
+                self.world.steer(client.entity_id, dx, dy)
+            self.counters["inputs"] += 1
+        elif kind == MSG_JOIN:
+            self._join(client, address)
+        elif kind == MSG_LEAVE:
+            # A LEAVE from an unknown address is a repeat, or comes after a timeout
+            if client is not None:
+                self._remove(client)
+                self.counters["left"] += 1
+        elif kind == MSG_STATS:
+            self._send(TYPE.pack(MSG_STATS_REPLY) + json.dumps(self.stats()).encode(), address)
+        else:
+            self.counters["malformed"] += 1
+
+    def _join(self, client: Client | None, address: tuple) -> None:
+        if client is None:
+            if len(self.clients) >= self.max_clients:
+                self.counters["rejected"] += 1
+                self._send(TYPE.pack(MSG_REJECT), address)
+                return
+            client = Client(address, self.world.spawn(KIND_PLAYER), time.monotonic())
+            self.clients[address] = client
+            self.counters["joined"] += 1
+        # A repeated JOIN means the WELCOME was lost
+        world = self.world
+        self._send(WELCOME.pack(MSG_WELCOME, client.entity_id, self.tick_rate, world.width, world.height), address)
+
+    def _remove(self, client: Client) -> None:
+        del self.clients[client.address]
+        self.world.remove(client.entity_id)
+
+    def _expire(self, now: float) -> None:
+        deadline = now - CLIENT_TIMEOUT
+        for client in [client for client in self.clients.values() if client.last_seen < deadline]:
+            self._remove(client)
+            self.counters["timed_out"] += 1
+
+    def _send(self, datagram: bytes, address: tuple) -> None:
+        try:
+            self.sock.sendto(datagram, address)
+        except OSError as e:
+            logger.debug("Failed to send to %s: %s", address, e)
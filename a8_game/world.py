@@ -0,0 +1,219 @@
+import random
+from array import array
+
+from a8_game.protocol import KIND_NPC, KIND_PLAYER, QUANTIZATION, State
+
+try:
+    import numpy
+except ImportError:  # Optional; without it the columns are array.array and the updates plain loops
+    numpy = None
+
+PLAYER_SPEED = 120.0
+NPC_SPEED = 40.0
+# NPCs alternate between walking and standing still for random periods of up to these seconds
+NPC_WALK = 3.0
+NPC_REST = 6.0
+INITIAL_CAPACITY = 1024
+
+# Column name and array.array type code
+COLUMNS = (("ids", "I"), ("kinds", "B"), ("x", "d"), ("y", "d"), ("vx", "d"), ("vy", "d"), ("timer", "d"),
+           ("qx", "H"), ("qy", "H"))
+
+
+class World:
+    """
+    The authoritative game state, advanced by the server in fixed steps.
+
+    Entities are stored as a structure of arrays: one column per field, indexed by slot, rather
+    than one object per entity. With NumPy the columns are NumPy arrays with spare capacity and
+    step() updates all entities with a handful of vectorised operations; without it they are
+    array.array columns updated in a loop. Removing an entity moves the last one into its slot,
+    so the live entities always fill slots 0 to count - 1; `slots` maps entity IDs to slots.
+
+    Players move as their latest input says. NPCs wander in straight lines, now and then stopping
+    for a while, and bounce off the edges of the world. After every step the positions are also
+    kept quantized, as they are sent to clients.
+    """
+
+    def __init__(self, width: int, height: int, seed: int | None = None, use_numpy: bool | None = None) -> None:
+        """
+        :param width: The extent of the world along x.
+        :param height: The extent of the world along y.
+        :param seed: The seed of the generator that places and steers NPCs.
+        :param use_numpy: Whether to keep the columns in NumPy arrays; by default whenever NumPy
+                          is installed.
+        """
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ValueError("NumPy is not installed")
+        self.width: int = width
+        self.height: int = height
+        self.use_numpy: bool = use_numpy
+        self.random: random.Random = random.Random(seed)
+        self.generator = numpy.random.default_rng(seed) if use_numpy else None
+        self.count: int = 0
+        self.slots: dict[int, int] = {}
+        # IDs start at 1 and are never reused, so a client cannot mistake a new entity for an old one
+        self.next_id: int = 1
+        for name, code in COLUMNS:
+            setattr(self, name, numpy.zeros(INITIAL_CAPACITY, code) if use_numpy else array(code))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def spawn(self, kind: int) -> int:
+        """
+        Add an entity at a random position, standing still.
+        :param kind: KIND_PLAYER or KIND_NPC.
+        :return: The ID of the new entity.
+        """
+        draw = self.random.uniform
+        entity_id = self.next_id
+        self.next_id += 1
+        x = draw(0, self.width)
+        y = draw(0, self.height)
+        values = (entity_id, kind, x, y, 0.0, 0.0, draw(0, NPC_REST) if kind == KIND_NPC else 0.0,
+                  int(x * QUANTIZATION / self.width), int(y * QUANTIZATION / self.height))
+        slot = self.count
+        if self.use_numpy:
+            if slot == len(self.ids):
+                for name, _ in COLUMNS:
+                    column = getattr(self, name)
+                    setattr(self, name, numpy.concatenate((column, numpy.zeros_like(column))))
+            for (name, _), value in zip(COLUMNS, values):
+                getattr(self, name)[slot] = value
+        else:
+            for (name, _), value in zip(COLUMNS, values):
+                getattr(self, name).append(value)
+        self.slots[entity_id] = slot
+        self.count += 1
+        return entity_id
+
+    def remove(self, entity_id: int) -> None:
+        slot = self.slots.pop(entity_id, None)
+        if slot is None:
+            return
+        last = self.count - 1
+        for name, _ in COLUMNS:
+            column = getattr(self, name)
+            column[slot] = column[last]
+            if not self.use_numpy:
+                column.pop()
+        if slot != last:
+            self.slots[int(self.ids[slot])] = slot
+        self.count = last
+
+    def steer(self, entity_id: int, dx: int, dy: int) -> None:
+        """
+        Apply a player's input.
+        :param entity_id: The player's entity.
+        :param dx: The direction along x, from -127 to 127.
+        :param dy: The direction along y, from -127 to 127.
+        """
+        slot = self.slots.get(entity_id)
+        if slot is not None and self.kinds[slot] == KIND_PLAYER:
+            self.vx[slot] = PLAYER_SPEED * max(-127, min(127, dx)) / 127
+            self.vy[slot] = PLAYER_SPEED * max(-127, min(127, dy)) / 127
+
+    def position(self, entity_id: int) -> tuple[float, float] | None:
+        """
+        :return: The position of an entity, None if there is no such entity.
+        """
+        slot = self.slots.get(entity_id)
+        return None if slot is None else (float(self.x[slot]), float(self.y[slot]))
+
+    def step(self, dt: float) -> None:
+        """
+        Advance the world by dt seconds.
+        """
+        if self.use_numpy:
+            self._step_numpy(dt)
+        else:
+            self._step_arrays(dt)
+
+    def states(self, slots=None) -> dict[int, State]:
+        """
+        :param slots: The slots of the entities to include, a list or NumPy index array; all
+                      entities if not given.
+        :return: The state of the entities as sent to clients, by entity ID.
+        """
+        if self.use_numpy:
+            if slots is None:
+                slots = slice(0, self.count)
+            return dict(zip(self.ids[slots].tolist(),
+                            zip(self.qx[slots].tolist(), self.qy[slots].tolist(), self.kinds[slots].tolist())))
+        if slots is None:
+            slots = range(self.count)
+        ids, qx, qy, kinds = self.ids, self.qx, self.qy, self.kinds
+        return {ids[slot]: (qx[slot], qy[slot], kinds[slot]) for slot in slots}
+
+    def _step_numpy(self, dt: float) -> None:
+        n = self.count
+        kinds, x, y, vx, vy, timer = (self.kinds[:n], self.x[:n], self.y[:n], self.vx[:n], self.vy[:n],
+                                      self.timer[:n])
+        npc = kinds == KIND_NPC
+        timer -= dt
+        expired = npc & (timer <= 0)
+        if expired.any():
+            walking = (vx != 0) | (vy != 0)
+            stop = numpy.flatnonzero(expired & walking)
+            start = numpy.flatnonzero(expired & ~walking)
+            uniform = self.generator.uniform
+            vx[stop] = 0.0
+            vy[stop] = 0.0
+            timer[stop] = uniform(0, NPC_REST, len(stop))
+            vx[start] = uniform(-NPC_SPEED, NPC_SPEED, len(start))
+            vy[start] = uniform(-NPC_SPEED, NPC_SPEED, len(start))
+            timer[start] = uniform(0, NPC_WALK, len(start))
+        x += vx * dt
+        y += vy * dt
+        for position, velocity, size in ((x, vx, self.width), (y, vy, self.height)):
+            outside = (position < 0) | (position > size)
+            if outside.any():
+                velocity[outside & npc] *= -1
+                numpy.clip(position, 0, size, out=position)
+        self.qx[:n] = x * (QUANTIZATION / self.width)
+        self.qy[:n] = y * (QUANTIZATION / self.height)
+
+    def _step_arrays(self, dt: float) -> None:
+        width = self.width
+        height = self.height
+        x_scale = QUANTIZATION / width
+        y_scale = QUANTIZATION / height
+        kinds, x, y, vx, vy, timer, qx, qy = (self.kinds, self.x, self.y, self.vx, self.vy, self.timer,
+                                              self.qx, self.qy)
+        draw = self.random.uniform
+        for slot in range(self.count):
+            dx = vx[slot]
+            dy = vy[slot]
+            npc = kinds[slot] == KIND_NPC
+            if npc:
+                left = timer[slot] - dt
+                if left <= 0:
+                    if dx or dy:
+                        dx = dy = 0.0
+                        left = draw(0, NPC_REST)
+                    else:
+                        dx = draw(-NPC_SPEED, NPC_SPEED)
+                        dy = draw(-NPC_SPEED, NPC_SPEED)
+                        left = draw(0, NPC_WALK)
+                    vx[slot] = dx
+                    vy[slot] = dy
+                timer[slot] = left
+            if not (dx or dy):
+                continue
+            nx = x[slot] + dx * dt
+            ny = y[slot] + dy * dt
+            if not 0 <= nx <= width:
+                nx = min(max(nx, 0.0), width)
+                if npc:
+                    vx[slot] = -dx
+            if not 0 <= ny <= height:
+                ny = min(max(ny, 0.0), height)
+                if npc:
+                    vy[slot] = -dy
+            x[slot] = nx
+            y[slot] = ny
+            qx[slot] = int(nx * x_scale)
+            qy[slot] = int(ny * y_scale)
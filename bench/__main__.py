@@ -0,0 +1,69 @@
+from argparse import Namespace, ArgumentParser
+
+from bench import chat, codec, dns, game, http, tick, unreliable
+from bench.stats import write_report
+from lab_common.resources import raise_fd_limit
+
+
+def parse_arguments() -> Namespace:
+    """
+    Parse command line arguments for the benchmark suite.
+    The first argument selects the benchmark; see `python -m bench <benchmark> --help`.
+    Every benchmark accepts:
+        --output: Write the JSON report to this file instead of stdout
+    :return: The parsed arguments in a Namespace object.
+    """
+
+    parser: ArgumentParser = ArgumentParser(
+        prog="python -m bench",
+        description="Load generators and benchmarks for the Computer Networks lab servers.",
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    chat_parser = subparsers.add_parser("chat", help="Load test the chat protocol (a3_chat_server)")
+    chat.add_arguments(chat_parser)
+    chat_parser.set_defaults(func=chat.run)
+
+    http_parser = subparsers.add_parser("http", help="Measure requests/sec of the HTTP server (a5_http_server)")
+    http.add_arguments(http_parser)
+    http_parser.set_defaults(func=http.run)
+
+    dns_parser = subparsers.add_parser("dns", help="Measure queries/sec of the DNS server (a6_dns_server)")
+    dns.add_arguments(dns_parser)
+    dns_parser.set_defaults(func=dns.run)
+
+    unreliable_parser = subparsers.add_parser(
+        "unreliable", help="Sweep loss rates and windows of the unreliable chat transport (a7_unreliable_chat)")
+    unreliable.add_arguments(unreliable_parser)
+    unreliable_parser.set_defaults(func=unreliable.run)
+
+    codec_parser = subparsers.add_parser(
+        "codec", help="Measure frames/sec of the unreliable chat frame codec (a7_unreliable_chat)")
+    codec.add_arguments(codec_parser)
+    codec_parser.set_defaults(func=codec.run)
+
+    game_parser = subparsers.add_parser(
+        "game", help="Measure tick headroom and snapshot bandwidth of the game server with bots (a8_game)")
+    game.add_arguments(game_parser)
+    game_parser.set_defaults(func=game.run)
+
+    tick_parser = subparsers.add_parser(
+        "tick", help="Measure game server tick time against the number of entities, without sockets (a8_game)")
+    tick.add_arguments(tick_parser)
+    tick_parser.set_defaults(func=tick.run)
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("-o", "--output", type=str, help="Write the JSON report to this file")
+    return parser.parse_args()
+
+
+# Execute using `python -m bench`
+def main() -> None:
+    args: Namespace = parse_arguments()
+    raise_fd_limit()
+    report = args.func(args)
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+import asyncio
+import os
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from collections import deque
+
+from bench.stats import ProcessSampler, latency_summary, spawn_server
+
+SCENARIOS = ("login", "send", "list", "churn", "channel")
+
+
+def add_arguments(parser: ArgumentParser) -> None:
+    """
+    Register the options of the chat benchmark on a (sub)parser.
+    """
+    parser.add_argument("-a", "--address", type=str, default="127.0.0.1", help="Chat server address")
+    parser.add_argument("-p", "--port", type=int, default=5378, help="Chat server port")
+    parser.add_argument("-s", "--scenario", choices=SCENARIOS, default="send", help="Workload to run")
+    parser.add_argument("-c", "--clients", type=int, default=1000,
+                        help="Clients for the login, list and churn scenarios")
+    parser.add_argument("--senders", type=int, default=100,
+                        help="Sending clients in the send scenario; members that also send in the channel scenario")
+    parser.add_argument("--receivers", type=int, default=100, help="Receiving clients in the send scenario")
+    parser.add_argument("--fan-out", type=int, default=1,
+                        help="Distinct receivers each sender cycles over in the send scenario")
+    parser.add_argument("--members", type=int, default=10000, help="Members of the channel in the channel scenario")
+    parser.add_argument("--window", type=int, default=32, help="Unacknowledged SENDs allowed per sender")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Messages per second per sender, 0 for as fast as the window allows")
+    parser.add_argument("--message-size", type=int, default=32, help="Bytes of padding per message")
+    parser.add_argument("--concurrency", type=int, default=500, help="Simultaneous connection attempts")
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="Seconds of steady-state load")
+    parser.add_argument("--prefix", type=str, default=f"b{os.getpid() % 100000}x", help="Username prefix")
+    parser.add_argument("--server-pid", type=int, help="Sample RSS and CPU time of this process")
+    parser.add_argument("--spawn", action="store_true",
+                        help="Start python -m a3_chat_server on the port and sample it")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for --spawn")
+
+
+class Recorder:
+    """
+    Counters and samples shared by every simulated client.
+    """
+
+    def __init__(self) -> None:
+        self.delivery_ns: list[int] = []
+        self.deliveries: int = 0
+        self.acks: int = 0
+        self.rejected: int = 0
+        self.recording: bool = False
+
+
+class BenchClient:
+    """
+    One simulated chat user on an asyncio stream.
+    A background task reads every line: DELIVERY lines carry the send timestamp and yield a
+    latency sample, SEND-OK/BAD-DEST-USER open the sender's window again and LIST-OK and
+    JOIN-OK resolve the oldest pending request.
+    """
+
+    def __init__(self, name: str, recorder: Recorder, window: int = 1) -> None:
+        self.name: str = name
+        self.recorder: Recorder = recorder
+        self.window: asyncio.Semaphore = asyncio.Semaphore(window)
+        self.requests: deque[asyncio.Future] = deque()
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.task: asyncio.Task | None = None
+
+    async def login(self, host: str, port: int) -> bytes:
+        """
+        Connect and perform the HELLO-FROM handshake.
+        :return: The server's reply line.
+        """
+        self.reader, self.writer = await asyncio.open_connection(host, port, limit=1 << 20)
+        self.writer.write(b"HELLO-FROM " + self.name.encode() + b"\n")
+        reply = await self.reader.readline()
+        if reply.startswith(b"HELLO"):
+            self.task = asyncio.get_running_loop().create_task(self._read_loop())
+        return reply
+
+    async def _read_loop(self) -> None:
+        recorder = self.recorder
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            if line.startswith(b"DELIVERY "):
+                recorder.deliveries += 1
+                if recorder.recording:
+                    # DELIVERY [#<channel>] <sender> <perf_counter_ns> <padding>
+                    if line.startswith(b"DELIVERY #"):
+                        stamp = line.split(b" ", 4)[3]
+                    else:
+                        stamp = line.split(b" ", 3)[2]
+                    recorder.delivery_ns.append(time.perf_counter_ns() - int(stamp))
+            elif line.startswith(b"SEND-OK"):
+                recorder.acks += 1
+                self.window.release()
+            elif line.startswith((b"LIST-OK", b"JOIN-OK")):
+                if self.requests:
+                    self.requests.popleft().set_result(line)
+            else:
+                recorder.rejected += 1
+                self.window.release()
+
+    def send(self, destination: str, padding: bytes) -> None:
+        self.writer.write(b"SEND %s %d %s\n" % (destination.encode(), time.perf_counter_ns(), padding))
+
+    async def request(self, line: bytes) -> bytes:
+        """
+        Send a request answered by LIST-OK or JOIN-OK and wait for the reply.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.requests.append(future)
+        self.writer.write(line)
+        return await future
+
+    async def list_users(self) -> bytes:
+        return await self.request(b"LIST\n")
+
+    async def close(self) -> None:
+        if self.writer is None:
+            return
+        try:
+            self.writer.write(b"QUIT\n")
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+        if self.task is not None:
+            self.task.cancel()
+
+
+async def login_all(args: Namespace, names: list[str], recorder: Recorder,
+                    window: int = 1) -> tuple[list[BenchClient], list[int], float]:
+    """
+    Log in one client per name with bounded concurrency.
+    :return: The logged in clients, the per-login latencies in ns and the elapsed seconds.
+    """
+    gate = asyncio.Semaphore(args.concurrency)
+    latencies: list[int] = []
+    clients: list[BenchClient] = []
+
+    async def one(name: str) -> None:
+        async with gate:
+            client = BenchClient(name, recorder, window)
+            start = time.perf_counter_ns()
+            try:
+                reply = await client.login(args.address, args.port)
+            except OSError:
+                recorder.rejected += 1
+                return
+            if reply.startswith(b"HELLO"):
+                latencies.append(time.perf_counter_ns() - start)
+                clients.append(client)
+            else:
+                recorder.rejected += 1
+                await client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(name) for name in names))
+    return clients, latencies, time.perf_counter() - start
+
+
+async def scenario_login(args: Namespace, recorder: Recorder) -> dict:
+    names = [f"{args.prefix}{i}" for i in range(args.clients)]
+    clients, latencies, elapsed = await login_all(args, names, recorder)
+    # Hold every connection idle for a moment so the RSS sample reflects the logged in state
+    await asyncio.sleep(min(args.duration, 2.0))
+    await asyncio.gather(*(client.close() for client in clients))
+    return {
+        "logins": len(clients),
+        "login_rate": len(clients) / elapsed if elapsed else None,
+        "login_latency_ms": latency_summary(latencies),
+    }
+
+
+async def scenario_send(args: Namespace, recorder: Recorder) -> dict:
+    receivers = [f"{args.prefix}r{i}" for i in range(args.receivers)]
+    senders = [f"{args.prefix}s{i}" for i in range(args.senders)]
+    clients, _, _ = await login_all(args, receivers + senders, recorder, args.window)
+    sender_names = set(senders)
+    sending = [client for client in clients if client.name in sender_names]
+    padding = b"x" * args.message_size
+    fan_out = max(1, min(args.fan_out, len(receivers)))
+    deadline = time.perf_counter() + args.duration
+
+    async def pump(index: int, client: BenchClient) -> int:
+        targets = [receivers[(index * fan_out + k) % len(receivers)] for k in range(fan_out)]
+        interval = 1.0 / args.rate if args.rate > 0 else 0.0
+        next_send = time.perf_counter()
+        sent = 0
+        while time.perf_counter() < deadline:
+            await client.window.acquire()
+            client.send(targets[sent % fan_out], padding)
+            sent += 1
+            if interval:
+                next_send += interval
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif sent % args.window == 0:
+                await client.writer.drain()
+        return sent
+
+    recorder.recording = True
+    start_deliveries = recorder.deliveries
+    start = time.perf_counter()
+    sent = sum(await asyncio.gather(*(pump(i, client) for i, client in enumerate(sending))))
+    elapsed = time.perf_counter() - start
+    delivered = recorder.deliveries - start_deliveries
+    # Let in-flight messages arrive so their latency is counted
+    drain_deadline = time.perf_counter() + 5.0
+    while recorder.deliveries - start_deliveries < sent and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.05)
+    recorder.recording = False
+    await asyncio.gather(*(client.close() for client in clients))
+    return {
+        "sent": sent,
+        "delivered": recorder.deliveries - start_deliveries,
+        "messages_per_sec": delivered / elapsed if elapsed else None,
+        "fan_out": fan_out,
+        "fan_in": len(sending) * fan_out / len(receivers) if receivers else None,
+        "delivery_latency_ms": latency_summary(recorder.delivery_ns),
+    }
+
+
+async def scenario_channel(args: Namespace, recorder: Recorder) -> dict:
+    names = [f"{args.prefix}m{i}" for i in range(args.members)]
+    clients, _, _ = await login_all(args, names, recorder, args.window)
+    channel = f"#{args.prefix}".encode()
+    gate = asyncio.Semaphore(args.concurrency)
+
+    async def join(client: BenchClient) -> None:
+        async with gate:
+            await client.request(b"JOIN " + channel + b"\n")
+
+    await asyncio.gather(*(join(client) for client in clients))
+    # Every sender is a member too, so it receives the other senders' messages
+    sending = clients[:max(1, min(args.senders, len(clients)))]
+    padding = b"x" * args.message_size
+    deadline = time.perf_counter() + args.duration
+
+    async def pump(client: BenchClient) -> int:
+        interval = 1.0 / args.rate if args.rate > 0 else 0.0
+        next_send = time.perf_counter()
+        sent = 0
+        while time.perf_counter() < deadline:
+            await client.window.acquire()
+            client.send(channel.decode(), padding)
+            sent += 1
+            if interval:
+                next_send += interval
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await client.writer.drain()
+        return sent
+
+    recorder.recording = True
+    start_deliveries = recorder.deliveries
+    start = time.perf_counter()
+    sent = sum(await asyncio.gather(*(pump(client) for client in sending)))
+    elapsed = time.perf_counter() - start
+    delivered = recorder.deliveries - start_deliveries
+    expected = sent * (len(clients) - 1)
+    drain_deadline = time.perf_counter() + 5.0
+    while recorder.deliveries - start_deliveries < expected and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.05)
+    recorder.recording = False
+    await asyncio.gather(*(client.close() for client in clients))
+    return {
+        "members": len(clients),
+        "sent": sent,
+        "delivered": recorder.deliveries - start_deliveries,
+        "expected": expected,
+        "messages_per_sec": sent / elapsed if elapsed else None,
+        "deliveries_per_sec": delivered / elapsed if elapsed else None,
+        "delivery_latency_ms": latency_summary(recorder.delivery_ns),
+    }
+
+
+async def scenario_list(args: Namespace, recorder: Recorder) -> dict:
+    names = [f"{args.prefix}{i}" for i in range(args.clients)]
+    clients, _, _ = await login_all(args, names, recorder)
+    deadline = time.perf_counter() + args.duration
+    latencies: list[int] = []
+
+    async def storm(client: BenchClient) -> None:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter_ns()
+            await client.list_users()
+            latencies.append(time.perf_counter_ns() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(storm(client) for client in clients))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(client.close() for client in clients))
+    return {
+        "lists": len(latencies),
+        "lists_per_sec": len(latencies) / elapsed if elapsed else None,
+        "list_latency_ms": latency_summary(latencies),
+    }
+
+
+async def scenario_churn(args: Namespace, recorder: Recorder) -> dict:
+    deadline = time.perf_counter() + args.duration
+    latencies: list[int] = []
+
+    async def loop(index: int) -> None:
+        name = f"{args.prefix}c{index}"
+        while time.perf_counter() < deadline:
+            client = BenchClient(name, recorder)
+            start = time.perf_counter_ns()
+            try:
+                reply = await client.login(args.address, args.port)
+            except OSError:
+                recorder.rejected += 1
+                continue
+            if reply.startswith(b"HELLO"):
+                latencies.append(time.perf_counter_ns() - start)
+            else:
+                recorder.rejected += 1
+            await client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(loop(i) for i in range(args.clients)))
+    elapsed = time.perf_counter() - start
+    return {
+        "logins": len(latencies),
+        "login_rate": len(latencies) / elapsed if elapsed else None,
+        "login_latency_ms": latency_summary(latencies),
+    }
+
+
+async def run_async(args: Namespace) -> dict:
+    recorder = Recorder()
+    sampler = ProcessSampler(args.server_pid)
+    sampler.start()
+    scenario = globals()[f"scenario_{args.scenario}"]
+    start = time.perf_counter()
+    results = await scenario(args, recorder)
+    elapsed = time.perf_counter() - start
+    return {
+        "benchmark": "chat",
+        "scenario": args.scenario,
+        "params": {key: value for key, value in vars(args).items() if key not in ("func", "output")},
+        "elapsed_sec": elapsed,
+        "rejected": recorder.rejected,
+        "results": results,
+        "server": sampler.stop(),
+    }
+
+
+def run(args: Namespace) -> dict:
+    """
+    Run one chat scenario, optionally against a freshly spawned server.
+    :return: The JSON-serialisable report.
+    """
+    server = None
+    if args.spawn:
+        limit = args.clients + args.senders + args.receivers + args.members + 1024
+        server = spawn_server([sys.executable, "-m", "a3_chat_server", "-a", args.address,
+                               "-p", str(args.port), "-m", str(limit), "-w", str(args.workers)])
+        args.server_pid = server.pid
+    try:
+        return asyncio.run(run_async(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
@@ -0,0 +1,67 @@
+import os
+import time
+from argparse import ArgumentParser, Namespace
+
+from a7_unreliable_chat.codec import FLAG_DATA, HEADER, pack_frame, unpack_frame, verify
+
+
+def add_arguments(parser: ArgumentParser) -> None:
+    """
+    Register the options of the codec microbenchmark on a (sub)parser.
+    """
+    parser.add_argument("-s", "--size", dest="sizes", type=int, nargs="+", default=[0, 64, 512, 1400],
+                        help="Payload sizes in bytes")
+    parser.add_argument("-n", "--iterations", type=int, default=200000, help="Frames per measurement")
+
+
+def python_checksum(data: bytes) -> int:
+    """
+    Fletcher-16 in a Python loop, the checksum of the former text frames, as the baseline that
+    the C-backed CRC32 is compared with.
+    """
+    low = high = 0
+    for byte in data:
+        low = (low + byte) % 255
+        high = (high + low) % 255
+    return (high << 8) | low
+
+
+def rate(function, iterations: int) -> float:
+    """
+    :return: Calls of the function per second over `iterations` calls.
+    """
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return iterations / (time.perf_counter() - started)
+
+
+def run(args: Namespace) -> dict:
+    """
+    Measure frames per second for encoding into a preallocated buffer, decoding (which
+    verifies), verifying alone, and the Python loop checksum baseline, for every payload size.
+    :return: The JSON-serialisable report.
+    """
+    results = []
+    for size in args.sizes:
+        payload = os.urandom(size)
+        buffer = bytearray(HEADER.size + size)
+        view = memoryview(buffer)
+        pack_frame(buffer, 0, FLAG_DATA, 1, 0, 0, payload)
+        # The checksum baseline is slow enough that a tenth of the iterations suffices
+        baseline_iterations = max(1, args.iterations // 10)
+        result = {
+            "payload_bytes": size,
+            "frame_bytes": len(buffer),
+            "encode_per_sec": rate(lambda: pack_frame(buffer, 0, FLAG_DATA, 1, 0, 0, payload), args.iterations),
+            "decode_per_sec": rate(lambda: unpack_frame(view), args.iterations),
+            "verify_per_sec": rate(lambda: verify(view), args.iterations),
+            "python_checksum_per_sec": rate(lambda: python_checksum(buffer), baseline_iterations),
+        }
+        result["verify_speedup"] = result["verify_per_sec"] / result["python_checksum_per_sec"]
+        results.append(result)
+    return {
+        "benchmark": "codec",
+        "params": {key: value for key, value in vars(args).items() if key not in ("func", "output")},
+        "results": results,
+    }
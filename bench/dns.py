@@ -0,0 +1,262 @@
+import multiprocessing
+import socket
+import struct
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+
+from a6_dns_server.message import EDNS_UDP_SIZE, FLAG_TC, HEADER, TYPES, build_query, name_to_wire
+from bench.stats import ProcessSampler, latency_summary, spawn_server
+
+DEFAULT_NAMES = ["www.lab.example.", "api.lab.example.", "cdn.lab.example.", "mail.lab.example.",
+                 "nope.lab.example."]
+TRANSPORTS = ("udp", "tcp", "both")
+LENGTH = struct.Struct("!H")
+# Every n-th reply contributes a latency sample, bounding the memory and pickling cost
+SAMPLE_EVERY = 8
+
+
+def add_arguments(parser: ArgumentParser) -> None:
+    """
+    Register the options of the DNS benchmark on a (sub)parser.
+    """
+    parser.add_argument("-a", "--address", type=str, default="127.0.0.1", help="DNS server address")
+    parser.add_argument("-p", "--port", type=int, default=8053, help="DNS server port")
+    parser.add_argument("-n", "--name", dest="names", action="append",
+                        help="Name to query, repeat to cycle over several (default: names in the example zone)")
+    parser.add_argument("-t", "--qtype", choices=sorted(TYPES), default="A", help="Query type")
+    parser.add_argument("-T", "--transport", choices=TRANSPORTS, default="udp",
+                        help="Query over UDP, over one reused TCP connection per client, or measure both "
+                             "(try -n pool.lab.example. for answers too large for plain UDP)")
+    parser.add_argument("--edns", type=int, default=EDNS_UDP_SIZE,
+                        help="EDNS0 UDP payload size to advertise, 0 for none")
+    parser.add_argument("-c", "--clients", type=int, default=4, help="Client processes")
+    parser.add_argument("--window", type=int, default=64, help="Outstanding queries per client")
+    parser.add_argument("-d", "--duration", type=float, default=5.0, help="Seconds of load")
+    parser.add_argument("--timeout", type=float, default=0.5,
+                        help="Seconds without a reply after which outstanding queries count as lost")
+    parser.add_argument("--server-pid", type=int, help="Sample RSS and CPU time of this process")
+    parser.add_argument("--spawn", action="store_true",
+                        help="Start python -m a6_dns_server with the example zone on the port and sample it")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for --spawn")
+    parser.add_argument("--zone", type=str, default="a6_dns_server/zones/lab.example.zone",
+                        help="Zone file served by --spawn")
+    parser.add_argument("--upstream", type=str, help="Upstream resolver for --spawn (host[:port])")
+    parser.add_argument("--forward", action="store_true",
+                        help="With --spawn, serve the zone from a second server on port+1 and let the "
+                             "server under test forward to it, measuring the answer cache")
+    parser.add_argument("--cache-size", type=int, help="Answer cache entries of the spawned server")
+
+
+def udp_client(args: Namespace, queries: list[bytes], start_at: float, results) -> None:
+    """
+    Keep `args.window` queries in flight on one UDP socket until the deadline and send the
+    counters and latency samples back through `results`.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect((args.address, args.port))
+    sock.settimeout(args.timeout)
+    sent_at = [0] * 65536
+    rcodes = [0] * 16
+    truncated = 0
+    samples: list[int] = []
+    buffer = bytearray(65535)
+    pack_id = struct.Struct("!H").pack_into
+    templates = [bytearray(query) for query in queries]
+    count = len(templates)
+    sent = received = lost = outstanding = 0
+    ident = 0
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        while outstanding < args.window:
+            ident = (ident + 1) & 0xFFFF
+            template = templates[ident % count]
+            pack_id(template, 0, ident)
+            sent_at[ident] = time.perf_counter_ns()
+            sock.send(template)
+            sent += 1
+            outstanding += 1
+        try:
+            size = sock.recv_into(buffer)
+        except socket.timeout:
+            lost += outstanding
+            outstanding = 0
+            sent_at = [0] * 65536
+            continue
+        except ConnectionRefusedError:
+            continue
+        reply_id, flags = struct.unpack_from("!HH", buffer)
+        started = sent_at[reply_id]
+        if not started or size < HEADER.size:
+            continue
+        sent_at[reply_id] = 0
+        outstanding -= 1
+        received += 1
+        rcodes[flags & 0x0F] += 1
+        if flags & FLAG_TC:
+            truncated += 1
+        if received % SAMPLE_EVERY == 0:
+            samples.append(time.perf_counter_ns() - started)
+    results.send({"sent": sent, "received": received, "lost": lost, "truncated": truncated, "rcodes": rcodes,
+                  "samples": samples})
+    results.close()
+
+
+def tcp_client(args: Namespace, queries: list[bytes], start_at: float, results) -> None:
+    """
+    Keep `args.window` queries in flight on one TCP connection until the deadline, writing
+    each batch of queries with one send, and send the counters and latency samples back
+    through `results`.
+    """
+    sock = socket.create_connection((args.address, args.port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.settimeout(args.timeout)
+    sent_at = [0] * 65536
+    rcodes = [0] * 16
+    samples: list[int] = []
+    pack_id = struct.Struct("!H").pack_into
+    templates = [bytearray(LENGTH.pack(len(query)) + query) for query in queries]
+    count = len(templates)
+    pending = bytearray()
+    sent = received = lost = outstanding = 0
+    ident = 0
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        if outstanding < args.window:
+            batch = bytearray()
+            now = time.perf_counter_ns()
+            while outstanding < args.window:
+                ident = (ident + 1) & 0xFFFF
+                template = templates[ident % count]
+                pack_id(template, LENGTH.size, ident)
+                sent_at[ident] = now
+                batch += template
+                sent += 1
+                outstanding += 1
+            sock.sendall(batch)
+        try:
+            data = sock.recv(1 << 16)
+        except socket.timeout:
+            lost += outstanding
+            outstanding = 0
+            continue
+        if not data:
+            break
+        pending += data
+        offset = 0
+        while len(pending) - offset >= LENGTH.size:
+            end = offset + LENGTH.size + LENGTH.unpack_from(pending, offset)[0]
+            if end > len(pending):
+                break
+            reply_id, flags = struct.unpack_from("!HH", pending, offset + LENGTH.size)
+            offset = end
+            started = sent_at[reply_id]
+            if not started:
+                continue
+            sent_at[reply_id] = 0
+            outstanding -= 1
+            received += 1
+            rcodes[flags & 0x0F] += 1
+            if received % SAMPLE_EVERY == 0:
+                samples.append(time.perf_counter_ns() - started)
+        del pending[:offset]
+    sock.close()
+    results.send({"sent": sent, "received": received, "lost": lost, "truncated": 0, "rcodes": rcodes,
+                  "samples": samples})
+    results.close()
+
+
+def run_clients(args: Namespace, target, queries: list[bytes]) -> dict:
+    """
+    Run `args.clients` client processes with the given target function and merge their counters.
+    """
+    context = multiprocessing.get_context("fork")
+    pipes = []
+    processes = []
+    start_at = time.time() + 0.2
+    for _ in range(args.clients):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=target, args=(args, queries, start_at, sender))
+        process.start()
+        sender.close()
+        pipes.append(receiver)
+        processes.append(process)
+    reports = [pipe.recv() for pipe in pipes]
+    for process in processes:
+        process.join()
+
+    samples = [sample for report in reports for sample in report["samples"]]
+    received = sum(report["received"] for report in reports)
+    rcodes = [sum(report["rcodes"][i] for report in reports) for i in range(16)]
+    return {
+        "sent": sum(report["sent"] for report in reports),
+        "received": received,
+        "lost": sum(report["lost"] for report in reports),
+        "truncated": sum(report["truncated"] for report in reports),
+        "queries_per_sec": received / args.duration,
+        "rcodes": {str(code): count for code, count in enumerate(rcodes) if count},
+        "latency_ms": latency_summary(samples),
+    }
+
+
+def run(args: Namespace) -> dict:
+    """
+    Measure queries/sec and latency of the DNS server from several client processes, optionally
+    against a freshly spawned server.
+    :return: The JSON-serialisable report.
+    """
+    args.names = args.names or DEFAULT_NAMES
+    queries = [build_query(0, name_to_wire(name), TYPES[args.qtype], udp_size=args.edns) for name in args.names]
+    servers = []
+    if args.spawn:
+        command = [sys.executable, "-m", "a6_dns_server", "-a", args.address, "-p", str(args.port),
+                   "-w", str(args.workers)]
+        if args.forward:
+            # A local authoritative server stands in for the upstream resolver
+            upstream = spawn_server([sys.executable, "-m", "a6_dns_server", "-a", args.address,
+                                     "-p", str(args.port + 1), "-z", args.zone])
+            servers.append(upstream)
+            args.upstream = f"{args.address}:{args.port + 1}"
+        else:
+            command += ["-z", args.zone]
+        if args.upstream:
+            command += ["-u", args.upstream]
+        if args.cache_size is not None:
+            command += ["--cache-size", str(args.cache_size)]
+        servers.append(spawn_server(command))
+        args.server_pid = servers[-1].pid
+    samplers = {"server": ProcessSampler(args.server_pid)}
+    if args.forward and servers:
+        samplers["upstream"] = ProcessSampler(servers[0].pid)
+    transports = ("udp", "tcp") if args.transport == "both" else (args.transport,)
+    clients = {"udp": udp_client, "tcp": tcp_client}
+    by_transport = {}
+    try:
+        for transport in transports:
+            cpu_start = {name: sampler.cpu_seconds() for name, sampler in samplers.items()}
+            results = run_clients(args, clients[transport], queries)
+            cpu_end = {name: sampler.cpu_seconds() for name, sampler in samplers.items()}
+            for name in samplers:
+                start, end = cpu_start[name], cpu_end[name]
+                cpu = end - start if start is not None and end is not None else None
+                results[f"{name}_cpu_seconds"] = cpu
+                results[f"{name}_cpu_us_per_query"] = (cpu * 1e6 / results["received"]
+                                                       if cpu and results["received"] else None)
+            by_transport[transport] = results
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+    if len(by_transport) == 1:
+        results = by_transport[transports[0]]
+    else:
+        results = dict(by_transport)
+        udp_qps = by_transport["udp"]["queries_per_sec"]
+        results["tcp_to_udp_qps"] = by_transport["tcp"]["queries_per_sec"] / udp_qps if udp_qps else None
+    return {
+        "benchmark": "dns",
+        "params": {key: value for key, value in vars(args).items() if key not in ("func", "output")},
+        "results": results,
+    }
@@ -0,0 +1,269 @@
+import json
+import multiprocessing
+import random
+import selectors
+import socket
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+
+from a8_game.protocol import (FIELD_MASK, INPUT, MSG_INPUT, MSG_JOIN, MSG_LEAVE, MSG_SNAPSHOT, MSG_STATS,
+                              MSG_STATS_REPLY, MSG_WELCOME, RECORDS, SNAPSHOT, TYPE, WELCOME, State, apply_snapshot)
+from bench.stats import ProcessSampler, spawn_server
+
+RECV_SIZE = 2048
+JOIN_TIMEOUT = 5.0
+
+
+class Bot:
+    """
+    A headless player: joins, steers at random, and acknowledges every snapshot it receives
+    completely. Verifying bots also rebuild the world from the snapshots, as a real client
+    would; the rest skip that work so that one process can run many bots.
+    """
+
+    __slots__ = ("sock", "verify", "entity_id", "acked", "input_seq", "frames", "parts")
+
+    def __init__(self, sock: socket.socket, verify: bool) -> None:
+        self.sock: socket.socket = sock
+        self.verify: bool = verify
+        self.entity_id: int = 0
+        # The newest completely received snapshot
+        self.acked: int = 0
+        self.input_seq: int = 0
+        # Completed states by tick, kept as long as the server may use them as baselines
+        self.frames: dict[int, dict[int, State]] = {}
+        # Parts received so far of incomplete snapshots, by tick
+        self.parts: dict[int, list[bytes | None]] = {}
+
+
+def add_arguments(parser: ArgumentParser) -> None:
+    """
+    Register the options of the game server benchmark on a (sub)parser.
+    """
+    parser.add_argument("-a", "--address", type=str, default="127.0.0.1", help="Game server address")
+    parser.add_argument("-p", "--port", type=int, default=7000, help="Game server port")
+    parser.add_argument("-c", "--clients", type=int, default=200, help="Bots in total")
+    parser.add_argument("-P", "--processes", type=int, default=4, help="Processes the bots are spread over")
+    parser.add_argument("-r", "--input-rate", type=float, default=10.0, help="Inputs per second per bot")
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="Seconds of load")
+    parser.add_argument("--verify-every", type=int, default=10,
+                        help="Every n-th bot decodes the snapshots and checks them, the others only acknowledge")
+    parser.add_argument("--server-pid", type=int, help="Sample the CPU time of this process")
+    parser.add_argument("--spawn", action="store_true", help="Start python -m a8_game on the port and sample it")
+    parser.add_argument("--tick-rate", type=int, default=30, help="Ticks per second of the spawned server")
+    parser.add_argument("--npcs", type=int, default=200, help="Non-player entities of the spawned server")
+
+
+def join(bots: list[Bot]) -> None:
+    """
+    Send JOIN from every bot until each has been welcomed.
+    :raises RuntimeError: If some bots were not welcomed within JOIN_TIMEOUT seconds.
+    """
+    deadline = time.monotonic() + JOIN_TIMEOUT
+    waiting = list(bots)
+    while waiting:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{len(waiting)} bots were not welcomed by the server")
+        for bot in waiting:
+            bot.sock.send(TYPE.pack(MSG_JOIN))
+        time.sleep(0.2)
+        for bot in waiting:
+            while True:
+                try:
+                    data = bot.sock.recv(RECV_SIZE)
+                except (BlockingIOError, ConnectionRefusedError):
+                    break
+                if data[:1] == bytes((MSG_WELCOME,)) and len(data) == WELCOME.size:
+                    bot.entity_id = WELCOME.unpack(data)[1]
+        waiting = [bot for bot in waiting if not bot.entity_id]
+
+
+def receive(bot: Bot, datagram: bytes, counters: dict[str, int]) -> None:
+    """
+    Store a snapshot part and apply the snapshot once all of its parts are in.
+    """
+    _, tick, baseline, index, count, _, _ = SNAPSHOT.unpack_from(datagram)
+    if tick <= bot.acked or index >= count:
+        counters["stale"] += 1
+        return
+    parts = bot.parts.get(tick)
+    if parts is None:
+        parts = bot.parts[tick] = [None] * count
+    parts[index] = datagram
+    if None in parts:
+        return
+    for old in [old for old in bot.parts if old <= tick]:
+        del bot.parts[old]
+    if not bot.verify:
+        counters["delta_snapshots" if baseline else "full_snapshots"] += 1
+        bot.acked = tick
+        return
+    if baseline and baseline not in bot.frames:
+        counters["missing_baseline"] += 1
+        return
+    state = dict(bot.frames[baseline]) if baseline else {}
+    try:
+        for part in parts:
+            apply_snapshot(state, part)
+    except ValueError:
+        counters["malformed"] += 1
+        return
+    counters["delta_snapshots" if baseline else "full_snapshots"] += 1
+    counters["verified_bytes"] += sum(len(part) for part in parts)
+    # What the same state would have cost as a full snapshot
+    counters["full_equivalent_bytes"] += len(state) * RECORDS[FIELD_MASK].size + SNAPSHOT.size * count
+    if bot.entity_id not in state:
+        counters["missing_self"] += 1
+    frames = bot.frames
+    frames[tick] = state
+    bot.acked = tick
+    # The server only moves baselines forward, so older states are of no further use
+    for old in [old for old in frames if old < baseline]:
+        del frames[old]
+
+
+def bots(args: Namespace, first: int, count: int, start_at: float, results) -> None:
+    """
+    Run `count` bots, numbered from `first`, and send their counters over the `args.duration`
+    seconds from `start_at` back through `results`. Until then the bots already play, so the
+    server is in its steady state when the measurement begins.
+    """
+    selector = selectors.DefaultSelector()
+    players = []
+    for number in range(first, first + count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((args.address, args.port))
+        sock.setblocking(False)
+        bot = Bot(sock, number % args.verify_every == 0)
+        players.append(bot)
+        selector.register(sock, selectors.EVENT_READ, bot)
+    counters = dict.fromkeys(("datagrams", "bytes", "inputs", "full_snapshots", "delta_snapshots", "verified_bytes",
+                              "full_equivalent_bytes", "stale", "missing_baseline", "missing_self", "malformed"), 0)
+    steer = random.Random()
+    try:
+        join(players)
+        interval = 1.0 / args.input_rate
+        next_input = time.monotonic()
+        measure_at = next_input + start_at - time.time()
+        deadline = measure_at + args.duration
+        measuring = False
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if not measuring and now >= measure_at:
+                measuring = True
+                counters = dict.fromkeys(counters, 0)
+            if now >= next_input:
+                for bot in players:
+                    bot.input_seq += 1
+                    try:
+                        bot.sock.send(INPUT.pack(MSG_INPUT, bot.input_seq, bot.acked, steer.randint(-127, 127),
+                                                 steer.randint(-127, 127)))
+                    except OSError:
+                        continue
+                    counters["inputs"] += 1
+                next_input += interval
+            wake_at = min(next_input, deadline if measuring else measure_at)
+            for key, _ in selector.select(max(0.0, wake_at - time.monotonic())):
+                bot = key.data
+                while True:
+                    try:
+                        data = bot.sock.recv(RECV_SIZE)
+                    except (BlockingIOError, ConnectionRefusedError):
+                        break
+                    counters["datagrams"] += 1
+                    counters["bytes"] += len(data)
+                    if data[0] == MSG_SNAPSHOT and len(data) >= SNAPSHOT.size:
+                        receive(bot, data, counters)
+        for bot in players:
+            bot.sock.send(TYPE.pack(MSG_LEAVE))
+    finally:
+        selector.close()
+        for bot in players:
+            bot.sock.close()
+    results.send(counters)
+    results.close()
+
+
+def query_stats(args: Namespace) -> dict | None:
+    """
+    :return: The statistics of the server, or None if it does not answer.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect((args.address, args.port))
+        sock.settimeout(1.0)
+        for _ in range(3):
+            sock.send(TYPE.pack(MSG_STATS))
+            try:
+                while True:
+                    data = sock.recv(65535)
+                    if data[:1] == bytes((MSG_STATS_REPLY,)):
+                        return json.loads(data[1:])
+            except (socket.timeout, ConnectionRefusedError):
+                continue
+    return None
+
+
+def run(args: Namespace) -> dict:
+    """
+    Load the game server with bots spread over several processes and report the bandwidth per
+    client, how much the deltas save over full snapshots, and the server's tick durations
+    against its tick budget.
+    :return: The JSON-serialisable report.
+    """
+    server = None
+    if args.spawn:
+        server = spawn_server([sys.executable, "-m", "a8_game", "-a", args.address, "-p", str(args.port),
+                               "-t", str(args.tick_rate), "-n", str(args.npcs),
+                               "--max-clients", str(args.clients)])
+        args.server_pid = server.pid
+    sampler = ProcessSampler(args.server_pid)
+    context = multiprocessing.get_context("fork")
+    pipes = []
+    processes = []
+    # Leave time to join, then for the server to settle
+    start_at = time.time() + JOIN_TIMEOUT + 1.0
+    try:
+        first = 0
+        for index in range(args.processes):
+            count = args.clients // args.processes + (index < args.clients % args.processes)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=bots, args=(args, first, count, start_at, sender))
+            process.start()
+            first += count
+            sender.close()
+            pipes.append(receiver)
+            processes.append(process)
+        time.sleep(max(0.0, start_at - time.time()))
+        cpu_start = sampler.cpu_seconds()
+        reports = [pipe.recv() for pipe in pipes]
+        cpu_end = sampler.cpu_seconds()
+        for process in processes:
+            process.join()
+        server_stats = query_stats(args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    totals = {key: sum(report[key] for report in reports) for key in reports[0]}
+    snapshots = totals["full_snapshots"] + totals["delta_snapshots"]
+    results = {
+        **totals,
+        "snapshots_per_client_per_sec": snapshots / args.clients / args.duration,
+        "bytes_per_client_per_sec": totals["bytes"] / args.clients / args.duration,
+        # Bytes received by the verifying bots, against full snapshots of the same states
+        "delta_to_full_bytes": totals["verified_bytes"] / totals["full_equivalent_bytes"]
+        if totals["full_equivalent_bytes"] else None,
+        "server_cpu_seconds": cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None,
+        "server": server_stats,
+    }
+    if server_stats is not None:
+        results["tick_ms"] = server_stats["tick_ms"]
+    return {
+        "benchmark": "game",
+        "params": {key: value for key, value in vars(args).items() if key not in ("func", "output")},
+        "results": results,
+    }
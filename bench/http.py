@@ -0,0 +1,222 @@
+import asyncio
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from collections import deque
+
+from bench.stats import ProcessSampler, latency_summary, spawn_server
+
+MODES = ("keep-alive", "close", "both")
+# The page and images a browser fetches for personal_cats.html
+DEFAULT_PATHS = ["/personal_cats.html", "/img/gleb_cat.jpeg", "/img/standing_cat.jpg"]
+
+
+def add_arguments(parser: ArgumentParser) -> None:
+    """
+    Register the options of the HTTP benchmark on a (sub)parser.
+    """
+    parser.add_argument("-a", "--address", type=str, default="127.0.0.1", help="HTTP server address")
+    parser.add_argument("-p", "--port", type=int, default=8000, help="HTTP server port")
+    parser.add_argument("-m", "--mode", choices=MODES, default="both",
+                        help="Reuse connections, open one per request, or measure both")
+    parser.add_argument("-c", "--connections", type=int, default=50, help="Concurrent connections")
+    parser.add_argument("--pipeline", type=int, default=1,
+                        help="Requests written back to back per round trip in keep-alive mode")
+    parser.add_argument("--path", dest="paths", action="append",
+                        help="Path to request, repeat to cycle over several (default: personal_cats.html "
+                             "and its images)")
+    parser.add_argument("-e", "--accept-encoding", type=str,
+                        help="Accept-Encoding to send, e.g. 'gzip, deflate'; compare runs with and without "
+                             "it for bytes and server CPU per request")
+    parser.add_argument("--header", dest="headers", action="append", default=[],
+                        help="Extra request header line, e.g. 'Cache-Control: no-cache'")
+    parser.add_argument("-d", "--duration", type=float, default=5.0, help="Seconds per mode")
+    parser.add_argument("--server-pid", type=int, help="Sample RSS and CPU time of this process")
+    parser.add_argument("--spawn", action="store_true",
+                        help="Start python -m a5_http_server on the port and sample it")
+    parser.add_argument("--directory", type=str, default="a5_http_server/public",
+                        help="Directory served by --spawn")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for --spawn")
+
+
+class ResponseReader(asyncio.Protocol):
+    """
+    Client side of one HTTP connection. Responses are matched to requests in order, so several
+    requests may be outstanding when pipelining. Bodies are delimited by Content-Length.
+    """
+
+    def __init__(self) -> None:
+        self.transport: asyncio.Transport | None = None
+        self.buffer: bytearray = bytearray()
+        self.scanned: int = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        # Status, bytes, content coding and Connection: close of the response being read
+        self.current: tuple[int, int, str, bool] | None = None
+        self.body_left: int = 0
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer += data
+        while True:
+            if self.current is None:
+                end = self.buffer.find(b"\r\n\r\n", self.scanned)
+                if end == -1:
+                    self.scanned = max(0, len(self.buffer) - 3)
+                    return
+                head = bytes(self.buffer[:end]).lower()
+                del self.buffer[:end + 4]
+                self.scanned = 0
+                status = int(head[9:12])
+                length = 0
+                start = head.find(b"\r\ncontent-length:")
+                if start != -1:
+                    stop = head.find(b"\r\n", start + 2)
+                    length = int(head[start + 17:stop if stop != -1 else None])
+                encoding = "identity"
+                start = head.find(b"\r\ncontent-encoding:")
+                if start != -1:
+                    stop = head.find(b"\r\n", start + 2)
+                    encoding = head[start + 19:stop if stop != -1 else None].strip().decode()
+                self.current = (status, end + 4 + length, encoding, b"\r\nconnection: close" in head)
+                self.body_left = length
+            taken = min(self.body_left, len(self.buffer))
+            del self.buffer[:taken]
+            self.body_left -= taken
+            if self.body_left:
+                return
+            result, self.current = self.current, None
+            if self.waiters:
+                self.waiters.popleft().set_result(result)
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError("Connection closed by server"))
+
+    def request(self, data: bytes) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.transport.write(data)
+        return waiter
+
+
+class Tally:
+    """
+    Counters and latency samples of one benchmark mode.
+    """
+
+    def __init__(self) -> None:
+        self.latency_ns: list[int] = []
+        self.statuses: dict[int, int] = {}
+        self.encodings: dict[str, int] = {}
+        self.bytes: int = 0
+        self.connects: int = 0
+        self.errors: int = 0
+
+
+async def run_mode(args: Namespace, keep_alive: bool, sampler: ProcessSampler) -> dict:
+    """
+    Load the server from `args.connections` concurrent clients for `args.duration` seconds.
+    :param keep_alive: Whether connections are reused, or closed after every request.
+    :return: The results of this mode.
+    """
+    loop = asyncio.get_running_loop()
+    connection = b"keep-alive" if keep_alive else b"close"
+    headers = list(args.headers)
+    if args.accept_encoding:
+        headers.append(f"Accept-Encoding: {args.accept_encoding}")
+    extra = b"".join(header.encode() + b"\r\n" for header in headers)
+    requests = [b"GET %s HTTP/1.1\r\nHost: %s\r\nConnection: %s\r\n%s\r\n"
+                % (path.encode(), args.address.encode(), connection, extra) for path in args.paths]
+    depth = max(1, args.pipeline) if keep_alive else 1
+    tally = Tally()
+    deadline = time.perf_counter() + args.duration
+
+    async def client(index: int) -> None:
+        reader: ResponseReader | None = None
+        sent = index
+        while time.perf_counter() < deadline:
+            start = time.perf_counter_ns()
+            try:
+                if reader is None or reader.transport.is_closing():
+                    _, reader = await loop.create_connection(ResponseReader, args.address, args.port)
+                    tally.connects += 1
+                waiters = [reader.request(requests[(sent + k) % len(requests)]) for k in range(depth)]
+                sent += depth
+                results = await asyncio.gather(*waiters)
+            except OSError:
+                tally.errors += 1
+                reader = None
+                await asyncio.sleep(0.01)
+                continue
+            elapsed = time.perf_counter_ns() - start
+            for status, size, encoding, close in results:
+                tally.latency_ns.append(elapsed)
+                tally.statuses[status] = tally.statuses.get(status, 0) + 1
+                tally.encodings[encoding] = tally.encodings.get(encoding, 0) + 1
+                tally.bytes += size
+                if close or not keep_alive:
+                    reader.transport.close()
+        if reader is not None:
+            reader.transport.close()
+
+    cpu_start = sampler.cpu_seconds()
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(args.connections)))
+    elapsed = time.perf_counter() - start
+    cpu_end = sampler.cpu_seconds()
+    count = len(tally.latency_ns)
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    return {
+        "requests": count,
+        "requests_per_sec": count / elapsed if elapsed else None,
+        "connections_opened": tally.connects,
+        "errors": tally.errors,
+        "statuses": {str(status): n for status, n in sorted(tally.statuses.items())},
+        "content_encodings": tally.encodings,
+        "bytes_per_request": tally.bytes / count if count else None,
+        "server_cpu_ms_per_request": cpu * 1e3 / count if cpu is not None and count else None,
+        "latency_ms": latency_summary(tally.latency_ns),
+    }
+
+
+async def run_async(args: Namespace) -> dict:
+    sampler = ProcessSampler(args.server_pid)
+    sampler.start()
+    modes = ("keep-alive", "close") if args.mode == "both" else (args.mode,)
+    start = time.perf_counter()
+    results = {mode: await run_mode(args, mode == "keep-alive", sampler) for mode in modes}
+    elapsed = time.perf_counter() - start
+    if len(results) == 2 and results["close"]["requests_per_sec"]:
+        results["keep_alive_speedup"] = (results["keep-alive"]["requests_per_sec"]
+                                         / results["close"]["requests_per_sec"])
+    return {
+        "benchmark": "http",
+        "params": {key: value for key, value in vars(args).items() if key not in ("func", "output")},
+        "elapsed_sec": elapsed,
+        "results": results,
+        "server": sampler.stop(),
+    }
+
+
+def run(args: Namespace) -> dict:
+    """
+    Measure requests/sec with and without keep-alive, optionally against a freshly spawned
+    server.
+    :return: The JSON-serialisable report.
+    """
+    args.paths = args.paths or DEFAULT_PATHS
+    server = None
+    if args.spawn:
+        server = spawn_server([sys.executable, "-m", "a5_http_server", "-a", args.address,
+                               "-p", str(args.port), "-d", args.directory, "-w", str(args.workers)])
+        args.server_pid = server.pid
+    try:
+        return asyncio.run(run_async(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
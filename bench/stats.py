@@ -0,0 +1,167 @@
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Iterable
+
+
+def percentiles(samples: list[float], points: Iterable[float] = (50, 99, 99.9)) -> dict[str, float | None]:
+    """
+    Nearest-rank percentiles of a sample list.
+    :param samples: The measured values; sorted in place.
+    :param points: The percentiles to report.
+    :return: A mapping like {"p50": ..., "p99": ..., "p999": ...}; values are None without samples.
+    """
+    samples.sort()
+    result: dict[str, float | None] = {}
+    for point in points:
+        key = "p" + f"{point:g}".replace(".", "")
+        if not samples:
+            result[key] = None
+            continue
+        rank = min(len(samples) - 1, max(0, int(len(samples) * point / 100.0 + 0.5) - 1))
+        result[key] = samples[rank]
+    return result
+
+
+def latency_summary(samples_ns: list[int]) -> dict[str, float | None]:
+    """
+    :param samples_ns: Latencies in nanoseconds.
+    :return: p50/p99/p999 and max in milliseconds.
+    """
+    summary = {key: (value / 1e6 if value is not None else None)
+               for key, value in percentiles(samples_ns).items()}
+    summary["max"] = samples_ns[-1] / 1e6 if samples_ns else None
+    summary["count"] = len(samples_ns)
+    return summary
+
+
+class ProcessSampler:
+    """
+    Samples the resident set size and CPU time of a process and its direct children (the
+    workers of a pre-forked server) through /proc while a benchmark runs. On systems without
+    /proc the sampler reports None values.
+    """
+
+    def __init__(self, pid: int | None, interval: float = 0.25) -> None:
+        self.pid: int | None = pid
+        self.interval: float = interval
+        self.peak_rss_kb: int | None = None
+        self.start_rss_kb: int | None = None
+        self.start_cpu: float | None = None
+        self._task: asyncio.Task | None = None
+
+    def pids(self) -> list[int]:
+        """
+        :return: The sampled process and its direct children.
+        """
+        if self.pid is None:
+            return []
+        pids = [self.pid]
+        try:
+            with open(f"/proc/{self.pid}/task/{self.pid}/children") as children:
+                pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+        return pids
+
+    def rss_kb(self) -> int | None:
+        """
+        :return: The summed VmRSS of the processes in KiB, or None if unavailable.
+        """
+        total = None
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as status:
+                    for line in status:
+                        if line.startswith("VmRSS:"):
+                            total = (total or 0) + int(line.split()[1])
+                            break
+            except OSError:
+                pass
+        return total
+
+    def cpu_seconds(self) -> float | None:
+        """
+        :return: The summed user + system CPU time of the processes in seconds, or None.
+        """
+        total = None
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/stat") as stat:
+                    fields = stat.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            # utime and stime are fields 14 and 15 of the stat line, counted from the pid
+            total = (total or 0.0) + (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        return total
+
+    def start(self) -> None:
+        self.start_rss_kb = self.peak_rss_kb = self.rss_kb()
+        self.start_cpu = self.cpu_seconds()
+        if self.pid is not None:
+            self._task = asyncio.get_running_loop().create_task(self._sample())
+
+    async def _sample(self) -> None:
+        while True:
+            rss = self.rss_kb()
+            if rss is not None and (self.peak_rss_kb is None or rss > self.peak_rss_kb):
+                self.peak_rss_kb = rss
+            await asyncio.sleep(self.interval)
+
+    def stop(self) -> dict[str, float | int | None]:
+        """
+        Stop sampling.
+        :return: The RSS at start, end and peak in KiB and the CPU seconds used in between.
+        """
+        if self._task is not None:
+            self._task.cancel()
+        end_rss = self.rss_kb()
+        if end_rss is not None and (self.peak_rss_kb is None or end_rss > self.peak_rss_kb):
+            self.peak_rss_kb = end_rss
+        end_cpu = self.cpu_seconds()
+        cpu = end_cpu - self.start_cpu if end_cpu is not None and self.start_cpu is not None else None
+        return {
+            "rss_start_kb": self.start_rss_kb,
+            "rss_end_kb": end_rss,
+            "rss_peak_kb": self.peak_rss_kb,
+            "cpu_seconds": cpu,
+        }
+
+
+def spawn_server(command: list[str], settle: float = 1.0) -> subprocess.Popen:
+    """
+    Start the server under test as a child process.
+    :param command: The command line, e.g. [sys.executable, "-m", "a3_chat_server", ...].
+    :param settle: Seconds to wait for the server to bind its socket.
+    :return: The running process.
+    """
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(settle)
+    if process.poll() is not None:
+        raise RuntimeError(f"Server exited early with status {process.returncode}: {' '.join(command)}")
+    return process
+
+
+def write_report(report: dict, path: str | None) -> None:
+    """
+    Attach host metadata to a report and write it as JSON.
+    :param report: The benchmark results.
+    :param path: The output file, or None for stdout.
+    """
+    report.setdefault("meta", {}).update({
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    })
+    text = json.dumps(report, indent=2)
+    if path is None:
+        print(text)
+    else:
+        with open(path, "w") as output:
+            output.write(text + "\n")
+        print(f"Wrote {path}", file=sys.stderr)
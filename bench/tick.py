@@ -0,0 +1,106 @@
+import math
+import random
+import time
+from argparse import ArgumentParser, Namespace
+
+from a8_game.protocol import KIND_PLAYER
+from a8_game.server import Client, GameServer
+from a8_game.world import numpy
+from bench.stats import percentiles
+
+# Largest world the 16-bit WELCOME fields can describe
+MAX_WORLD_SIZE = 65535
+
+
+def add_arguments(parser: ArgumentParser) -> None:
+    """
+    Register the options of the game tick benchmark on a (sub)parser.
+    """
+    parser.add_argument("-e", "--entities", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="Entity counts to measure")
+    parser.add_argument("-c", "--clients", type=int, default=100, help="Players, each sent a snapshot per tick")
+    parser.add_argument("-n", "--ticks", type=int, default=100, help="Ticks measured per entity count")
+    parser.add_argument("--warmup", type=int, default=10, help="Ticks run before measuring")
+    parser.add_argument("--tick-rate", type=int, default=30, help="Tick rate the budget is derived from")
+    parser.add_argument("--density", type=float, default=50.0,
+                        help="Entities per 1000 x 1000 units; the world grows with the entity count")
+    parser.add_argument("--view-distance", type=float, default=400.0, help="How far players see")
+    parser.add_argument("--backend", choices=("numpy", "array", "both"), default="both" if numpy else "array",
+                        help="Storage of the world's columns")
+    parser.add_argument("--all", action="store_true",
+                        help="Also measure sending every client the whole world, where it fits in a snapshot")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the world's random generator")
+
+
+def measure(args: Namespace, entities: int, use_numpy: bool, view_distance: float) -> dict:
+    """
+    Run a server without sockets for `args.warmup + args.ticks` ticks, encoding a snapshot for
+    every player each tick. Players acknowledge every snapshot at once and change direction
+    now and then.
+    :return: Durations of the simulation step and of the snapshots per tick, and sizes.
+    """
+    size = min(MAX_WORLD_SIZE, int(1000 * math.sqrt(entities / args.density)))
+    server = GameServer("127.0.0.1", 0, args.tick_rate, entities - args.clients, size, size,
+                        max_clients=args.clients, seed=args.seed, view_distance=view_distance, use_numpy=use_numpy)
+    clients = [Client(("bot", number), server.world.spawn(KIND_PLAYER), 0.0) for number in range(args.clients)]
+    steer = random.Random(args.seed)
+    step_times: list[float] = []
+    snapshot_times: list[float] = []
+    total_times: list[float] = []
+    sent = 0
+    for tick in range(args.warmup + args.ticks):
+        for client in clients:
+            if steer.random() < 0.1:
+                server.world.steer(client.entity_id, steer.randint(-127, 127), steer.randint(-127, 127))
+        started = time.perf_counter()
+        server.step()
+        stepped = time.perf_counter()
+        everything = None if server.grid is not None else server.world.states()
+        encoded: dict[int, list[bytes]] = {}
+        size_this_tick = 0
+        for client in clients:
+            size_this_tick += sum(len(datagram) for datagram in server.snapshot(client, everything, encoded))
+            client.acked = server.tick
+        finished = time.perf_counter()
+        if tick >= args.warmup:
+            step_times.append((stepped - started) * 1000)
+            snapshot_times.append((finished - stepped) * 1000)
+            total_times.append((finished - started) * 1000)
+            sent += size_this_tick
+    budget = 1000 / args.tick_rate
+    total = percentiles(total_times, (50, 99))
+    return {
+        "world_size": size,
+        "step_ms": percentiles(step_times, (50, 99)),
+        "snapshots_ms": percentiles(snapshot_times, (50, 99)),
+        "tick_ms": total,
+        "headroom": 1 - total["p99"] / budget,
+        "visible_per_client": server.counters["visible"] / server.counters["ticks"] / args.clients,
+        "bytes_per_client_per_tick": sent / args.ticks / args.clients,
+    }
+
+
+def run(args: Namespace) -> dict:
+    """
+    Measure the tick time of the game server against the number of entities, for each storage
+    backend, with and optionally without area of interest filtering.
+    :return: The JSON-serialisable report.
+    """
+    backends = ("numpy", "array") if args.backend == "both" else (args.backend,)
+    results = []
+    for use_numpy in (backend == "numpy" for backend in backends):
+        for entities in args.entities:
+            result = {"backend": "numpy" if use_numpy else "array", "entities": entities,
+                      **measure(args, entities, use_numpy, args.view_distance)}
+            if args.all:
+                try:
+                    result["whole_world"] = measure(args, entities, use_numpy, 0)
+                except ValueError:
+                    # The whole world takes more datagrams than a snapshot can have
+                    result["whole_world"] = None
+            results.append(result)
+    return {
+        "benchmark": "tick",
+        "params": {key: value for key, value in vars(args).items() if key not in ("func", "output")},
+        "results": results,
+    }
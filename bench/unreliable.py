@@ -0,0 +1,143 @@
+import multiprocessing
+import selectors
+import signal
+import socket
+import time
+from argparse import ArgumentParser, Namespace
+
+from a7_unreliable_chat.lossy_proxy import LossyProxy, add_impairment_arguments, impairment_from_arguments
+from a7_unreliable_chat.transport import DEFAULT_RTO, Connection
+from bench.stats import latency_summary
+
+RECV_SIZE = 65536
+
+
+def add_arguments(parser: ArgumentParser) -> None:
+    """
+    Register the options of the unreliable chat transport benchmark on a (sub)parser.
+    """
+    parser.add_argument("-l", "--loss", type=float, nargs="+", default=[0.0, 0.01, 0.05, 0.1],
+                        help="Drop probabilities to sweep (in both directions)")
+    parser.add_argument("-w", "--window", dest="windows", type=int, nargs="+", default=[1, 4, 16, 64],
+                        help="Send windows to sweep")
+    parser.add_argument("-n", "--messages", type=int, default=1000, help="Messages per run")
+    parser.add_argument("-s", "--size", type=int, default=64, help="Message size in bytes")
+    parser.add_argument("--rto", type=float, default=DEFAULT_RTO, help="Initial retransmission timeout")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds after which a run is abandoned")
+    add_impairment_arguments(parser)
+    parser.set_defaults(delay=0.005, jitter=0.001, seed=1)
+
+
+def serve_proxy(proxy: LossyProxy, ready) -> None:
+    """
+    Run the proxy in a child process, reporting its port and then its counters through `ready`.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: proxy.stop())
+    proxy.bind()
+    ready.send(proxy.port)
+    proxy.serve_forever()
+    ready.send(proxy.stats())
+
+
+def transfer(args: Namespace, window: int, proxy_address: tuple[str, int], receiver: socket.socket) -> dict:
+    """
+    Send `args.messages` messages through a transport connection to a receiving connection
+    behind the proxy, keeping `window` more messages queued than are in flight.
+    :return: Goodput, message latencies and the sender's transport statistics.
+    """
+    sender_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender_sock.connect(proxy_address)
+    sender_sock.setblocking(False)
+    sender = Connection(window, args.rto, max_transmissions=0)
+    recipient = Connection(window, args.rto, max_transmissions=0)
+    selector = selectors.DefaultSelector()
+    selector.register(sender_sock, selectors.EVENT_READ, sender)
+    selector.register(receiver, selectors.EVENT_READ, recipient)
+    # Replies go to whichever proxy socket the last datagram came from
+    peer = None
+    buffer = bytearray(RECV_SIZE)
+    view = memoryview(buffer)
+    padding = b"x" * args.size
+    submitted = delivered = 0
+    samples: list[int] = []
+    started = time.perf_counter()
+    deadline = started + args.timeout
+    try:
+        while delivered < args.messages and time.perf_counter() < deadline:
+            while submitted < args.messages and len(sender.queue) < window:
+                header = b"%d %d " % (submitted, time.perf_counter_ns())
+                sender.send(header + padding[len(header):])
+                submitted += 1
+            now = time.monotonic()
+            for frame in sender.poll(now):
+                sender_sock.send(frame)
+            if peer is not None:
+                for frame in recipient.poll(now):
+                    receiver.sendto(frame, peer)
+            deadlines = [d for d in (sender.next_deadline(), recipient.next_deadline()) if d is not None]
+            timeout = min([0.5] + [d - now for d in deadlines])
+            for key, _ in selector.select(max(0.0, timeout)):
+                connection = key.data
+                while True:
+                    try:
+                        if connection is recipient:
+                            size, peer = receiver.recvfrom_into(buffer)
+                        else:
+                            size = sender_sock.recv_into(buffer)
+                    except (BlockingIOError, ConnectionRefusedError):
+                        break
+                    for message in connection.receive(view[:size], time.monotonic()):
+                        received_at = time.perf_counter_ns()
+                        samples.append(received_at - int(message.split(b" ", 2)[1]))
+                        delivered += 1
+    finally:
+        selector.close()
+        sender_sock.close()
+    elapsed = time.perf_counter() - started
+    stats = sender.stats()
+    return {
+        "delivered": delivered,
+        "complete": delivered == args.messages,
+        "seconds": elapsed,
+        "goodput_msgs_per_sec": delivered / elapsed,
+        "goodput_bytes_per_sec": delivered * args.size / elapsed,
+        "latency_ms": latency_summary(samples),
+        # Frames sent per message delivered, beyond the first
+        "retransmission_overhead": stats["retransmits"] / delivered if delivered else None,
+        "transport": stats,
+    }
+
+
+def run(args: Namespace) -> dict:
+    """
+    Sweep drop rates and send windows, transferring messages through a LossyProxy for every
+    combination.
+    :return: The JSON-serialisable report.
+    """
+    context = multiprocessing.get_context("fork")
+    runs = []
+    for loss in args.loss:
+        for window in args.windows:
+            receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            receiver.bind(("127.0.0.1", 0))
+            receiver.setblocking(False)
+            proxy = LossyProxy("127.0.0.1", 0, receiver.getsockname(), impairment_from_arguments(args, drop=loss),
+                               seed=args.seed)
+            ready, child_end = context.Pipe(duplex=False)
+            process = context.Process(target=serve_proxy, args=(proxy, child_end))
+            process.start()
+            child_end.close()
+            try:
+                port = ready.recv()
+                result = transfer(args, window, ("127.0.0.1", port), receiver)
+            finally:
+                process.terminate()
+                receiver.close()
+            result["proxy"] = ready.recv()
+            process.join()
+            runs.append({"loss": loss, "window": window, **result})
+    return {
+        "benchmark": "unreliable",
+        "params": {key: value for key, value in vars(args).items() if key not in ("func", "output")},
+        "results": runs,
+    }
@@ -1,6 +1,10 @@
 import os
+import struct
+import time
+import zlib
 from argparse import Namespace, ArgumentParser
-from zipfile import ZipFile
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile, ZipInfo
 
 
 def parse_arguments() -> Namespace:
@@ -9,9 +13,12 @@ def parse_arguments() -> Namespace:
         description="Export assignment for submission in CodeGrade.",
     )
     parser.add_argument(
-        "assignment", type=str, help="Assignment name",
+        "assignments", type=str, nargs="+", metavar="assignment", help="Assignment names",
         choices=[f"a{i}" for i in [1, 3, 5, 6, 7]]
     )
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="Processes compressing files, default one per CPU"
+    )
     return parser.parse_args()
 
 
@@ -24,19 +31,162 @@ ASSIGNMENT_MAP: dict[str, str] = {
     "a8": "a8_game"
 }
 
+# Packages shared between assignments, bundled into every archive next to the assignment files
+SHARED_PACKAGES: list[str] = ["lab_common"]
+
+# Root __main__.py of every archive: the assignment keeps its package directory, so that its
+# imports of itself and of the shared packages resolve, and `python <archive or directory>`
+# runs it as `python -m <package>` would
+LAUNCHER: str = """import runpy
+
+runpy.run_module("{package}", run_name="__main__", alter_sys=True)
+"""
+
+# Formats that are compressed already; deflating them again costs time and saves nothing
+STORED_EXTENSIONS: frozenset[str] = frozenset({
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".ico", ".gz", ".br", ".zip", ".woff", ".woff2", ".mp3", ".mp4",
+})
+
+# Local file header of a zip entry: signature, version, flags, method, time, date, CRC-32,
+# compressed size, size, file name length and extra field length
+LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+def collect(assignment_dir: str) -> list[tuple[str, str]]:
+    """
+    :return: (path, name in the archive) of every file to export, in a stable order. Files keep
+             their package directory, the assignment's as well as the shared ones.
+    """
+    entries = []
+    for directory in [assignment_dir] + SHARED_PACKAGES:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for file in sorted(files):
+                if ".pyc" in file or "__pycache__" in root: continue
+                file_path = os.path.join(root, file)
+                entries.append((file_path, os.path.relpath(file_path)))
+    return entries
+
+
+def pack(path: str, compress_type: int) -> tuple[int, bytes]:
+    """
+    Read and compress one file, in a process of the pool.
+    :return: The CRC-32 of the file and the data to store for it.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    crc = zlib.crc32(data)
+    if compress_type == ZIP_DEFLATED:
+        # Raw deflate stream, as ZipFile itself writes it
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return crc, data
+
+
+def previous_entries(path: str) -> dict[str, ZipInfo]:
+    """
+    :return: The entries of an earlier archive by name, none if it is missing or damaged.
+    """
+    try:
+        with ZipFile(path) as archive:
+            return {info.filename: info for info in archive.infolist()}
+    except (OSError, BadZipFile):
+        return {}
+
+
+def unchanged(info: ZipInfo, old: ZipInfo | None, path: str) -> bool:
+    """
+    :return: Whether the earlier entry holds the current contents of the file, compressed the
+             same way. Zip timestamps have a resolution of two seconds, so a timestamp that
+             differs only there counts as the same; any other difference is settled by the CRC.
+    """
+    if old is None or old.file_size != info.file_size or old.compress_type != info.compress_type:
+        return False
+    year, month, day, hour, minute, second = info.date_time
+    if old.date_time == (year, month, day, hour, minute, second - second % 2):
+        return True
+    with open(path, "rb") as file:
+        return zlib.crc32(file.read()) == old.CRC
+
+
+def read_raw(file, info: ZipInfo) -> bytes:
+    """
+    :return: The stored, still compressed, data of an entry of an open archive file.
+    """
+    file.seek(info.header_offset)
+    signature, *_, name_length, extra_length = LOCAL_HEADER.unpack(file.read(LOCAL_HEADER.size))
+    if signature != LOCAL_HEADER_SIGNATURE:
+        raise BadZipFile(f"Bad local header for {info.filename}")
+    file.seek(name_length + extra_length, os.SEEK_CUR)
+    return file.read(info.compress_size)
+
+
+def write_raw(archive: ZipFile, info: ZipInfo, data: bytes) -> None:
+    """
+    Append an entry whose data is compressed already. ZipFile only writes data it compresses
+    itself, so this does what ZipFile.write() does after compressing.
+    """
+    info.header_offset = archive.fp.tell()
+    archive.fp.write(info.FileHeader())
+    archive.fp.write(data)
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+    archive.start_dir = archive.fp.tell()
+    archive._didModify = True
+
+
+def build(assignment: str, pool: Executor) -> str:
+    """
+    Write the archive of an assignment. Files are compressed in the pool while the archive is
+    written in order, and entries whose file did not change are copied from the previous
+    archive without being compressed again.
+    :return: A summary of the archive and the time it took.
+    """
+    started = time.perf_counter()
+    target = f"{assignment}.zip"
+    old_entries = previous_entries(target)
+    jobs: list[tuple[ZipInfo, ZipInfo | None, Future | None]] = []
+    for path, name in collect(ASSIGNMENT_MAP[assignment]):
+        info = ZipInfo.from_file(path, name)
+        stored = os.path.splitext(path)[1].lower() in STORED_EXTENSIONS
+        info.compress_type = ZIP_STORED if stored else ZIP_DEFLATED
+        old = old_entries.get(name)
+        if unchanged(info, old, path):
+            jobs.append((info, old, None))
+        else:
+            jobs.append((info, None, pool.submit(pack, path, info.compress_type)))
+
+    reused = 0
+    temporary = f"{target}.tmp"
+    with ZipFile(temporary, "w") as archive, open(target if old_entries else os.devnull, "rb") as previous:
+        for info, old, job in jobs:
+            if job is None:
+                data = read_raw(previous, old)
+                info.CRC = old.CRC
+                reused += 1
+            else:
+                info.CRC, data = job.result()
+            info.compress_size = len(data)
+            write_raw(archive, info, data)
+        archive.writestr("__main__.py", LAUNCHER.format(package=ASSIGNMENT_MAP[assignment]), ZIP_DEFLATED)
+    os.replace(temporary, target)
+    return (f"{target}: {len(jobs)} files ({reused} unchanged), {os.path.getsize(target)} bytes "
+            f"in {time.perf_counter() - started:.2f}s")
+
 
 def main() -> None:
     global ASSIGNMENT_MAP
     args: Namespace = parse_arguments()
-    assert args.assignment in ASSIGNMENT_MAP
+    assignments = list(dict.fromkeys(args.assignments))
+    assert all(assignment in ASSIGNMENT_MAP for assignment in assignments)
 
-    assignment_dir: str = ASSIGNMENT_MAP[args.assignment]
-    with ZipFile(f"{args.assignment}.zip", "w") as zipf:
-        for root, _, files in os.walk(assignment_dir):
-            for file in files:
-                if ".pyc" in file or "__pycache__" in root: continue
-                file_path = os.path.join(root, file)
-                zipf.write(file_path, os.path.relpath(file_path, assignment_dir))
+    started = time.perf_counter()
+    with ProcessPoolExecutor(args.jobs) as pool, ThreadPoolExecutor(len(assignments)) as builders:
+        for summary in builders.map(lambda assignment: build(assignment, pool), assignments):
+            print(summary)
+    if len(assignments) > 1:
+        print(f"{len(assignments)} archives in {time.perf_counter() - started:.2f}s")
 
 
 if __name__ == "__main__":
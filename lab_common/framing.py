@@ -0,0 +1,115 @@
+import socket
+from typing import Iterator
+
+DEFAULT_MAX_LINE_LENGTH = 1 << 20
+
+
+class LineTooLongError(ValueError):
+    """
+    Raised when more than the allowed number of bytes arrive without a newline.
+    """
+
+
+class LineFramer:
+    """
+    Incremental splitter for newline-terminated protocol lines.
+
+    Bytes are received straight into one reusable bytearray. Only the bytes that arrived since
+    the previous scan are searched for a newline, so a line split over many segments is never
+    re-scanned, and every complete line in a segment is returned instead of only the first one.
+    A partial line at the end stays in the buffer for the next receive. Consumed bytes are
+    reclaimed by moving the (short) tail to the front only when the free space runs out, and
+    the buffer only grows when a single line does not fit.
+
+    Usage:
+        framer = LineFramer()
+        while framer.recv_into(sock):
+            for line in framer.lines():
+                ...
+    """
+
+    __slots__ = ("max_line_length", "_buffer", "_view", "_start", "_end", "_scanned")
+
+    def __init__(self, max_line_length: int = DEFAULT_MAX_LINE_LENGTH, buffer_size: int = 4096) -> None:
+        """
+        :param max_line_length: The longest line accepted, excluding the newline.
+        :param buffer_size: The initial buffer size; it grows up to max_line_length + 1 on demand.
+        """
+        self.max_line_length: int = max_line_length
+        self._buffer: bytearray = bytearray(buffer_size)
+        self._view: memoryview = memoryview(self._buffer)
+        self._start: int = 0    # First byte not yet returned as part of a line
+        self._end: int = 0      # End of the received data
+        self._scanned: int = 0  # No newline exists in [_start, _scanned)
+
+    def __len__(self) -> int:
+        """
+        :return: The number of buffered bytes that are not part of a returned line yet.
+        """
+        return self._end - self._start
+
+    def recv_into(self, sock: socket.socket, size: int = 65536) -> int:
+        """
+        Receive from a socket directly into the free space of the buffer.
+        :param sock: The socket to read from.
+        :param size: The maximum number of bytes to read.
+        :return: The number of bytes received; 0 means the peer closed the connection.
+        :raises BlockingIOError: If the socket is non-blocking and has no data.
+        """
+        # Compact or grow once less than a quarter of the buffer is free
+        self._reserve(min(size, max(len(self._buffer) // 4, 1)))
+        received = sock.recv_into(self._view[self._end:self._end + size])
+        self._end += received
+        return received
+
+    def feed(self, data: bytes) -> None:
+        """
+        Append bytes obtained elsewhere, e.g. from a datagram or a test.
+        :param data: The bytes to append.
+        """
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def lines(self) -> Iterator[bytes]:
+        """
+        Yield every complete line that is buffered, without its line terminator.
+        The generator may be abandoned early; the remaining lines are yielded on the next call.
+        :raises LineTooLongError: If the incomplete tail exceeds max_line_length.
+        """
+        buffer = self._buffer
+        while True:
+            newline = buffer.find(b"\n", self._scanned, self._end)
+            if newline == -1:
+                break
+            line_end = newline
+            if line_end > self._start and buffer[line_end - 1] == 0x0D:  # Tolerate CRLF
+                line_end -= 1
+            if line_end - self._start > self.max_line_length:
+                raise LineTooLongError(f"Line exceeds {self.max_line_length} bytes")
+            line = bytes(self._view[self._start:line_end])
+            self._start = self._scanned = newline + 1
+            yield line
+        self._scanned = self._end
+        if self._end - self._start > self.max_line_length:
+            raise LineTooLongError(f"Line exceeds {self.max_line_length} bytes")
+        if self._start == self._end:
+            self._start = self._end = self._scanned = 0
+
+    def _reserve(self, size: int) -> None:
+        # Make room for `size` more bytes after _end
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if len(self._buffer) - pending < size:
+            new_size = len(self._buffer)
+            while new_size - pending < size:
+                new_size *= 2
+            self._view.release()
+            self._buffer.extend(bytes(new_size - len(self._buffer)))
+            self._view = memoryview(self._buffer)
+        if self._start:
+            # memoryview assignment copies overlapping ranges safely
+            self._view[:pending] = self._view[self._start:self._end]
+            self._scanned -= self._start
+            self._start, self._end = 0, pending
@@ -0,0 +1,15 @@
+def raise_fd_limit() -> None:
+    """
+    Raise the soft open-file limit to the hard limit so a process can hold as many
+    sockets as the system allows (the default soft limit is often 1024).
+    """
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
@@ -0,0 +1,150 @@
+import os
+import socket
+from collections import deque
+from itertools import islice
+
+try:
+    IOV_MAX: int = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class SendQueue:
+    """
+    Write-coalescing queue of outgoing frames.
+
+    Frames are kept as memoryviews over the caller's bytes, so queueing never copies them.
+    A flush hands up to IOV_MAX frames to the kernel in one vectored sendmsg() call; after a
+    short write the partially sent frame is re-sliced as a memoryview, again without copying
+    its tail.
+
+    Frames pushed as droppable may be discarded with drop_oldest() while none of their bytes
+    have been sent, which lets a bounded queue shed load without cutting a frame in half.
+    The other frames are counted separately, so that they can be bounded by other means.
+    """
+
+    __slots__ = ("_frames", "_droppable", "_bytes", "_partial", "_kept", "_kept_bytes")
+
+    def __init__(self) -> None:
+        self._frames: deque[memoryview] = deque()
+        # Whether each frame may be dropped
+        self._droppable: deque[bool] = deque()
+        self._bytes: int = 0
+        # Whether the first frame has been sent in part
+        self._partial: bool = False
+        # Frames that may not be dropped and their unsent bytes
+        self._kept: int = 0
+        self._kept_bytes: int = 0
+
+    def __len__(self) -> int:
+        """
+        :return: The number of bytes waiting to be sent.
+        """
+        return self._bytes
+
+    def __bool__(self) -> bool:
+        return self._bytes > 0
+
+    @property
+    def frames(self) -> int:
+        """
+        :return: The number of (partially) unsent frames.
+        """
+        return len(self._frames)
+
+    @property
+    def kept(self) -> int:
+        """
+        :return: The number of (partially) unsent frames that may not be dropped.
+        """
+        return self._kept
+
+    @property
+    def kept_bytes(self) -> int:
+        """
+        :return: The unsent bytes of the frames that may not be dropped.
+        """
+        return self._kept_bytes
+
+    def push(self, data: bytes | memoryview, droppable: bool = False) -> None:
+        """
+        Queue a frame; the queue keeps a reference to it until it has been sent.
+        :param data: The frame to send. A memoryview is queued as it is, so one view can be
+                     shared by the queues of many connections.
+        :param droppable: Whether drop_oldest() may discard the frame.
+        """
+        if data:
+            self._frames.append(data if type(data) is memoryview else memoryview(data))
+            self._droppable.append(droppable)
+            self._bytes += len(data)
+            if not droppable:
+                self._kept += 1
+                self._kept_bytes += len(data)
+
+    def drop_oldest(self) -> int:
+        """
+        Discard the oldest droppable frame that has not been sent in part.
+        :return: Its size in bytes, 0 if there is no such frame.
+        """
+        droppable = self._droppable
+        for index in range(1 if self._partial else 0, len(droppable)):
+            if droppable[index]:
+                size = len(self._frames[index])
+                del self._frames[index]
+                del droppable[index]
+                self._bytes -= size
+                return size
+        return 0
+
+    def flush(self, sock: socket.socket) -> int:
+        """
+        Send as much of the queue as the socket accepts with one system call.
+        :param sock: The socket to write to; usually non-blocking.
+        :return: The number of bytes sent, 0 if the socket is not writable.
+        :raises OSError: On connection errors other than EAGAIN/EINTR.
+        """
+        if not self._frames:
+            return 0
+        try:
+            if hasattr(sock, "sendmsg"):
+                sent = sock.sendmsg(list(islice(self._frames, IOV_MAX)))
+            else:  # Windows has no sendmsg()
+                sent = sock.send(b"".join(islice(self._frames, IOV_MAX)))
+        except (BlockingIOError, InterruptedError):
+            return 0
+        self.consume(sent)
+        return sent
+
+    def consume(self, count: int) -> None:
+        """
+        Drop bytes from the front of the queue after they were written.
+        :param count: The number of bytes written.
+        """
+        self._bytes -= count
+        frames = self._frames
+        while count:
+            head = frames[0]
+            if len(head) <= count:
+                count -= len(head)
+                frames.popleft()
+                if not self._droppable.popleft():
+                    self._kept -= 1
+                    self._kept_bytes -= len(head)
+                self._partial = False
+            else:
+                frames[0] = head[count:]
+                if not self._droppable[0]:
+                    self._kept_bytes -= count
+                self._partial = True
+                count = 0
+
+    def clear(self) -> None:
+        """
+        Drop every queued frame.
+        """
+        self._frames.clear()
+        self._droppable.clear()
+        self._bytes = 0
+        self._partial = False
+        self._kept = 0
+        self._kept_bytes = 0